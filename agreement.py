@@ -0,0 +1,355 @@
+# Évaluation Médicale IA - Accord entre l'IA et les évaluateurs humains
+#
+# Pour toute la cohorte : ICC(2,1) (IA + 2 évaluateurs, et évaluateurs seuls),
+# kappa de Cohen pondéré (quadratique) sur notes regroupées par classes de
+# BIN_WIDTH points, limites d'accord de Bland–Altman et, pour app4.py, les
+# critères de la grille liés au désaccord IA / humains (les évaluateurs ne
+# notant que la note finale, un critère est comparé à l'écart humain - IA).
+#
+# Tous ces indicateurs se déduisent de statistiques suffisantes additives
+# (n, sommes, matrice des produits croisés, matrices de confusion) : chaque
+# nouvelle ligne est ajoutée, une ligne remplacée est d'abord retirée. L'état
+# est conservé dans analytics.db avec le dernier rowid lu : le tableau de
+# bord ne relit que les lignes arrivées depuis son dernier affichage. Après
+# une purge de la base source (table purges), les ids sont réutilisés : tout
+# est recalculé.
+
+import copy
+import json
+import os
+import threading
+
+import numpy as np
+from scipy import sparse, stats
+
+from db import DB_PATH, Database
+
+ANALYTICS_DB_PATH = os.path.join(os.path.dirname(DB_PATH), "analytics.db")
+RATERS = ("IA", "Évaluateur 1", "Évaluateur 2")
+PAIRS = ((0, 1), (0, 2), (1, 2))
+MAX_SCORE = 20.0
+BIN_WIDTH = 2.0
+N_BINS = int(MAX_SCORE // BIN_WIDTH)
+LOA_Z = 1.96
+
+ANALYTICS_MIGRATIONS = [
+    (1, [
+        '''
+        CREATE TABLE accord_etat (
+            source TEXT PRIMARY KEY,
+            etat TEXT NOT NULL,
+            dernier_rowid INTEGER NOT NULL,
+            purge INTEGER NOT NULL DEFAULT 0
+        )''',
+        # Valeurs déjà comptées par clé (étudiant ou run) : une ligne remplacée est retirée
+        '''
+        CREATE TABLE accord_lignes (
+            source TEXT NOT NULL,
+            cle TEXT NOT NULL,
+            valeurs TEXT NOT NULL,
+            PRIMARY KEY (source, cle)
+        )''',
+    ]),
+]
+
+# ---------------------------
+# STATISTIQUES SUFFISANTES
+# ---------------------------
+def score_bins(scores: np.ndarray) -> np.ndarray:
+    return np.clip((scores // BIN_WIDTH).astype(int), 0, N_BINS - 1)
+
+class AgreementStats:
+    """Sommes additives d'où se déduisent ICC, kappa et Bland–Altman (trois notateurs)."""
+
+    # Par critère, sur les runs où il est noté : n, Σs, Σs², Σh, Σh², Σsh, Σg, Σg², Σsg
+    # (s = score du critère, h = moyenne des évaluateurs, g = écart humains - IA)
+    CRIT_ROWS = ("n", "s", "ss", "h", "hh", "sh", "g", "gg", "sg")
+
+    def __init__(self):
+        self.n = 0
+        self.sums = np.zeros(3)
+        self.cross = np.zeros((3, 3))                     # Σ x_j x_l
+        self.confusion = np.zeros((len(PAIRS), N_BINS, N_BINS))
+        self.criteria = {}                                # libellé -> colonne
+        self.crit = np.zeros((len(self.CRIT_ROWS), 0))
+
+    def update(self, notes: np.ndarray, sign: int = 1):
+        """Ajoute (sign=1) ou retire (sign=-1) des lignes [note IA, éval. 1, éval. 2]."""
+        if not len(notes):
+            return
+        self.n += sign * len(notes)
+        self.sums += sign * notes.sum(axis=0)
+        self.cross += sign * notes.T @ notes
+        bins = score_bins(notes)
+        for p, (j, l) in enumerate(PAIRS):
+            np.add.at(self.confusion[p], (bins[:, j], bins[:, l]), sign)
+
+    def update_criteria(self, notes: np.ndarray, criteria: list[dict], sign: int = 1):
+        """Ajoute (ou retire) les scores par critère des runs correspondant à `notes`."""
+        for scores in criteria:
+            for label in scores:
+                self.criteria.setdefault(label, len(self.criteria))
+        if self.crit.shape[1] < len(self.criteria):
+            self.crit = np.pad(self.crit, ((0, 0), (0, len(self.criteria) - self.crit.shape[1])))
+        rows = [r for r, scores in enumerate(criteria) for _ in scores]
+        cols = [self.criteria[label] for scores in criteria for label in scores]
+        values = [score for scores in criteria for score in scores.values()]
+        shape = (len(criteria), len(self.criteria))
+        present = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=shape)
+        s = sparse.csr_matrix((np.asarray(values, dtype=float), (rows, cols)), shape=shape)
+        h = notes[:, 1:].mean(axis=1)
+        g = h - notes[:, 0]
+        self.crit += sign * np.vstack([
+            present.T @ np.ones(len(criteria)), s.T @ np.ones(len(criteria)),
+            s.multiply(s).T @ np.ones(len(criteria)),
+            present.T @ h, present.T @ h ** 2, s.T @ h,
+            present.T @ g, present.T @ g ** 2, s.T @ g,
+        ])
+
+    def to_json(self) -> str:
+        return json.dumps({"n": self.n, "sums": self.sums.tolist(), "cross": self.cross.tolist(),
+                           "confusion": self.confusion.tolist(), "criteria": self.criteria,
+                           "crit": self.crit.tolist()})
+
+    @classmethod
+    def from_json(cls, payload: str) -> "AgreementStats":
+        data, state = json.loads(payload), cls()
+        state.n = data["n"]
+        state.sums, state.cross = np.array(data["sums"]), np.array(data["cross"])
+        state.confusion = np.array(data["confusion"])
+        state.criteria = data["criteria"]
+        state.crit = np.array(data["crit"]).reshape(len(cls.CRIT_ROWS), len(state.criteria))
+        return state
+
+    # ---------------------------
+    # INDICATEURS
+    # ---------------------------
+    def icc(self, raters: tuple = (0, 1, 2)) -> dict:
+        """ICC(2,1) de Shrout & Fleiss (effets aléatoires, accord absolu) et son test F."""
+        n, k = self.n, len(raters)
+        if n < 2:
+            return {"icc": None, "p": None}
+        idx = np.ix_(raters, raters)
+        sums, cross = self.sums[list(raters)], self.cross[idx]
+        correction = sums.sum() ** 2 / (n * k)
+        ss_total = np.trace(cross) - correction
+        ss_rows = cross.sum() / k - correction
+        ss_cols = (sums ** 2).sum() / n - correction
+        ms_rows = ss_rows / (n - 1)
+        ms_cols = ss_cols / (k - 1)
+        ms_error = (ss_total - ss_rows - ss_cols) / ((n - 1) * (k - 1))
+        denominator = ms_rows + (k - 1) * ms_error + k * (ms_cols - ms_error) / n
+        if denominator <= 0:
+            return {"icc": None, "p": None}
+        p = stats.f.sf(ms_rows / ms_error, n - 1, (n - 1) * (k - 1)) if ms_error > 0 else 0.0
+        return {"icc": float((ms_rows - ms_error) / denominator), "p": float(p)}
+
+    def weighted_kappa(self, pair: int) -> float:
+        """Kappa de Cohen à pondération quadratique sur les classes de BIN_WIDTH points."""
+        observed = self.confusion[pair]
+        total = observed.sum()
+        if total == 0:
+            return None
+        expected = np.outer(observed.sum(axis=1), observed.sum(axis=0)) / total
+        i, j = np.indices(observed.shape)
+        weights = (i - j) ** 2 / (N_BINS - 1) ** 2
+        disagreement = (weights * expected).sum()
+        return float(1.0 - (weights * observed).sum() / disagreement) if disagreement else 1.0
+
+    def bland_altman(self, contrast) -> dict:
+        """Biais et limites d'accord de la différence `contrast · notes` (ex. IA - éval. 1)."""
+        c = np.asarray(contrast, dtype=float)
+        if self.n < 2:
+            return {"biais": None, "ecart_type": None, "limite_basse": None, "limite_haute": None}
+        total, total_sq = c @ self.sums, c @ self.cross @ c
+        bias = total / self.n
+        sd = np.sqrt(max(total_sq - self.n * bias ** 2, 0.0) / (self.n - 1))
+        return {"biais": float(bias), "ecart_type": float(sd),
+                "limite_basse": float(bias - LOA_Z * sd), "limite_haute": float(bias + LOA_Z * sd)}
+
+    def pearson(self, j: int, l: int) -> float:
+        if self.n < 2:
+            return None
+        mean = self.sums / self.n
+        cov = self.cross / self.n - np.outer(mean, mean)
+        denominator = np.sqrt(cov[j, j] * cov[l, l])
+        return float(cov[j, l] / denominator) if denominator > 0 else None
+
+    def criteria_table(self) -> list[dict]:
+        """Par critère : score IA moyen, corrélation avec la note humaine et avec l'écart
+        humains - IA (un critère fortement corrélé à l'écart concentre le désaccord)."""
+        n, s, ss, h, hh, sh, g, gg, sg = self.crit
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean_s = s / n
+            var_s = ss / n - mean_s ** 2
+            corr_h = (sh / n - mean_s * h / n) / np.sqrt(var_s * (hh / n - (h / n) ** 2))
+            corr_g = (sg / n - mean_s * g / n) / np.sqrt(var_s * (gg / n - (g / n) ** 2))
+        table = []
+        for label, col in self.criteria.items():
+            if n[col] < 1:
+                continue
+            clean = lambda x: float(x[col]) if np.isfinite(x[col]) else None
+            table.append({"critère": label, "n": int(round(n[col])), "score_ia_moyen": clean(mean_s),
+                          "corr_note_humaine": clean(corr_h), "corr_ecart_humains_ia": clean(corr_g)})
+        return sorted(table, key=lambda row: -abs(row["corr_ecart_humains_ia"] or 0))
+
+    def report(self) -> dict:
+        pairs = []
+        for p, (j, l) in enumerate(PAIRS):
+            contrast = np.zeros(3)
+            contrast[j], contrast[l] = 1, -1
+            pairs.append({"paire": f"{RATERS[j]} / {RATERS[l]}", "pearson": self.pearson(j, l),
+                          "kappa_pondere": self.weighted_kappa(p), **self.bland_altman(contrast)})
+        return {
+            "n": self.n,
+            "icc_tous": self.icc((0, 1, 2)),
+            "icc_humains": self.icc((1, 2)),
+            "paires": pairs,
+            "ia_vs_humains": self.bland_altman((1, -0.5, -0.5)),
+            "criteres": self.criteria_table(),
+        }
+
+# ---------------------------
+# SOURCES
+# ---------------------------
+def _notes_rows(db: Database, after: int) -> list[tuple]:
+    """app3.py (evaluation.db) : une ligne par étudiant, remplacée à chaque sauvegarde."""
+    rows = db.query("SELECT rowid, id_etudiant, note_ia, eval1, eval2 FROM evaluations "
+                    "WHERE rowid > ? AND note_ia IS NOT NULL AND eval1 IS NOT NULL AND eval2 IS NOT NULL "
+                    "ORDER BY rowid", (after,))
+    return [(rowid, key, [ia, e1, e2], None) for rowid, key, ia, e1, e2 in rows]
+
+def _ecos_rows(db: Database, after: int) -> list[tuple]:
+    """app4.py (evaluations.db) : évaluations humaines reliées à leur run (la plus récente
+    compte pour un run), avec les scores par critère du run."""
+    rows = db.query('''
+        SELECT h.id, r.id, r.note_finale, h.eval1, h.eval2
+        FROM evaluations_humaines h
+        JOIN evaluation_run r ON r.id = COALESCE(
+            h.run_id, (SELECT MAX(id) FROM evaluation_run WHERE id_etudiant = h.id_etudiant))
+        WHERE h.id > ? AND r.note_finale IS NOT NULL AND h.eval1 IS NOT NULL AND h.eval2 IS NOT NULL
+        ORDER BY h.id''', (after,))
+    criteria = {}
+    run_ids = list({row[1] for row in rows})
+    for start in range(0, len(run_ids), 500):
+        batch = run_ids[start:start + 500]
+        for run_id, label, score in db.query(
+                "SELECT ec.run_id, c.libelle, ec.score FROM evaluation_critere ec "
+                "JOIN criteres c ON c.id = ec.critere_id "
+                f"WHERE ec.run_id IN ({', '.join('?' * len(batch))}) AND ec.score IS NOT NULL", batch):
+            criteria.setdefault(run_id, {})[label] = score
+    return [(rowid, str(run_id), [ia, e1, e2], criteria.get(run_id, {}))
+            for rowid, run_id, ia, e1, e2 in rows]
+
+SOURCES = {
+    "notes": (_notes_rows, "SELECT MAX(rowid) FROM evaluations"),
+    "ecos": (_ecos_rows, "SELECT MAX(id) FROM evaluations_humaines"),
+}
+
+class AgreementTracker:
+    """Maintient AgreementStats à jour pour une base source ("notes" : app3, "ecos" : app4)."""
+
+    def __init__(self, source_db: Database, source: str, path: str = ANALYTICS_DB_PATH):
+        self.source_db = source_db
+        self.source = source
+        self.fetch, self.max_rowid_sql = SOURCES[source]
+        self.db = Database(path, ANALYTICS_MIGRATIONS)
+        self.source_version = None
+        # Partagé entre les sessions Streamlit (cache_resource) : un seul refresh à la fois
+        self.lock = threading.Lock()
+        state = self.db.query("SELECT etat, dernier_rowid, purge FROM accord_etat WHERE source = ?", (source,))
+        self.stats, self.last_rowid, self.purge = (AgreementStats.from_json(state[0][0]), state[0][1],
+                                                   state[0][2]) if state else (AgreementStats(), 0, 0)
+
+    def reset(self, purge: int = None):
+        with self.lock, self.db.transaction() as conn:
+            self._reset(conn, purge)
+
+    def _reset(self, conn, purge: int = None):
+        self.stats, self.last_rowid = AgreementStats(), 0
+        if purge is not None:
+            self.purge = purge
+        conn.execute("DELETE FROM accord_lignes WHERE source = ?", (self.source,))
+        conn.execute("INSERT OR REPLACE INTO accord_etat VALUES (?, ?, ?, ?)",
+                     (self.source, self.stats.to_json(), self.last_rowid, self.purge))
+
+    def _load(self, conn):
+        """Reprend l'état enregistré s'il a avancé sans ce tracker (autre processus)."""
+        saved = conn.execute("SELECT dernier_rowid, purge FROM accord_etat WHERE source = ?",
+                             (self.source,)).fetchone()
+        if saved is not None and tuple(saved) != (self.last_rowid, self.purge):
+            etat = conn.execute("SELECT etat FROM accord_etat WHERE source = ?", (self.source,)).fetchone()[0]
+            self.stats, (self.last_rowid, self.purge) = AgreementStats.from_json(etat), saved
+
+    def refresh(self) -> AgreementStats:
+        """Intègre les lignes arrivées depuis le dernier appel ; sans écriture dans la base
+        source depuis, ne lit rien. Lecture, mise à jour et enregistrement se font d'un bloc
+        (verrou entre sessions, transaction entre processus) ; les statistiques renvoyées ne
+        sont plus modifiées ensuite, un refresh suivant travaille sur une copie."""
+        with self.lock:
+            version = self.source_db.version()
+            if version == self.source_version:
+                return self.stats
+            with self.db.transaction() as conn:
+                self._load(conn)
+                # Base purgée (ids réutilisés, les clés déjà comptées ne désignent plus les mêmes
+                # lignes) ou lignes supprimées : recalcul complet
+                purge = self.source_db.query("SELECT COALESCE(MAX(id), 0) FROM purges")[0][0]
+                if purge != self.purge or \
+                        (self.source_db.query(self.max_rowid_sql)[0][0] or 0) < self.last_rowid:
+                    self._reset(conn, purge)
+                rows = self.fetch(self.source_db, self.last_rowid)
+                if rows:
+                    # Une clé déjà comptée (sauvegarde remplacée) : ses anciennes valeurs sont retirées
+                    latest = {key: (notes, criteria) for _, key, notes, criteria in rows}
+                    keys = list(latest)
+                    previous = {}
+                    for start in range(0, len(keys), 500):
+                        batch = keys[start:start + 500]
+                        previous.update(conn.execute(
+                            f"SELECT cle, valeurs FROM accord_lignes WHERE source = ? "
+                            f"AND cle IN ({', '.join('?' * len(batch))})", (self.source, *batch)))
+                    stats = copy.deepcopy(self.stats)
+                    self._apply(stats, [json.loads(previous[key]) for key in keys if key in previous], -1)
+                    self._apply(stats, [latest[key] for key in keys], 1)
+                    conn.executemany("INSERT OR REPLACE INTO accord_lignes VALUES (?, ?, ?)",
+                                     [(self.source, key, json.dumps(latest[key])) for key in keys])
+                    conn.execute("INSERT OR REPLACE INTO accord_etat VALUES (?, ?, ?, ?)",
+                                 (self.source, stats.to_json(), rows[-1][0], self.purge))
+                    self.stats, self.last_rowid = stats, rows[-1][0]
+            self.source_version = version
+            return self.stats
+
+    @staticmethod
+    def _apply(stats: AgreementStats, entries: list, sign: int):
+        if not entries:
+            return
+        notes = np.array([entry[0] for entry in entries], dtype=float)
+        stats.update(notes, sign)
+        if entries[0][1] is not None:
+            stats.update_criteria(notes, [entry[1] for entry in entries], sign)
+
+# ---------------------------
+# TABLEAU DE BORD (Streamlit)
+# ---------------------------
+def agreement_dashboard(tracker: AgreementTracker):
+    """Affiche les indicateurs d'accord de la cohorte (à appeler dans une app Streamlit)."""
+    import pandas as pd
+    import streamlit as st
+
+    report = tracker.refresh().report()
+    if report["n"] < 2:
+        st.info("Pas encore assez d'évaluations doublement notées pour mesurer l'accord.")
+        return
+    fmt = lambda value: "—" if value is None else f"{value:.2f}"
+    col_n, col_all, col_humans, col_bias = st.columns(4)
+    col_n.metric("Évaluations", report["n"])
+    col_all.metric("ICC IA + évaluateurs", fmt(report["icc_tous"]["icc"]))
+    col_humans.metric("ICC évaluateurs", fmt(report["icc_humains"]["icc"]))
+    ia = report["ia_vs_humains"]
+    col_bias.metric("Biais IA - humains", fmt(ia["biais"]),
+                    help=f"Limites d'accord (Bland–Altman) : {fmt(ia['limite_basse'])} à {fmt(ia['limite_haute'])}")
+    st.dataframe(pd.DataFrame(report["paires"]).set_index("paire"), use_container_width=True)
+    if report["criteres"]:
+        st.markdown("**Critères liés au désaccord IA / évaluateurs**")
+        st.dataframe(pd.DataFrame(report["criteres"]), hide_index=True, use_container_width=True)
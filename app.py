@@ -1,17 +1,35 @@
 import streamlit as st
-import json
-import tempfile
-import os
-from docx import Document
 from datetime import datetime
-from openai import OpenAI
-import numpy as np
-from scipy.io.wavfile import write
+
+# openai et evaluation (numpy, scipy, av) ne sont importés que sur les chemins qui
+# s'en servent : les reruns (chaque interaction) n'en paient jamais le coût
+from prompt import build_messages
+from rubric import RubricError, compile_rubric
+from uploads import spooled_upload, sweep_uploads
 
 # Configuration page
 st.set_page_config(page_title="Évaluation Médicale IA", page_icon="🧠")
 st.title("🧠 Évaluation Médicale IA Automatisée")
 
+# Cache des transcriptions Whisper (partagé entre les sessions)
+@st.cache_resource
+def get_transcription_cache():
+    from cache import TranscriptionCache
+    return TranscriptionCache()
+
+# Client OpenAI : un par jeu d'identifiants et par processus
+@st.cache_resource
+def get_client(api_key: str, organization: str, project: str):
+    from openai import OpenAI
+    return OpenAI(api_key=api_key, organization=organization, project=project)
+
+# Une fois par processus : fichiers temporaires laissés par un processus interrompu
+@st.cache_resource
+def sweep_abandoned_uploads():
+    return sweep_uploads()
+
+sweep_abandoned_uploads()
+
 # API KEY + ORG + PROJECT
 openai_api_key = st.text_input("🔐 Clé API OpenAI (Whisper + GPT-4)", type="password")
 openai_org = st.text_input("🏢 ID d'organisation OpenAI (org-...)")
@@ -19,11 +37,7 @@ openai_project = st.text_input("📁 ID de projet OpenAI (proj_...)")
 
 client = None
 if openai_api_key and openai_org and openai_project:
-    client = OpenAI(
-        api_key=openai_api_key,
-        organization=openai_org,
-        project=openai_project
-    )
+    client = get_client(openai_api_key, openai_org, openai_project)
 
 # Initialiser les states
 if "transcript" not in st.session_state:
@@ -46,14 +60,10 @@ if clinical_file is not None:
 rubric_docx = st.file_uploader("📋 Charger la grille d'évaluation (.docx)", type=["docx"])
 rubric = []
 if rubric_docx is not None:
-    doc = Document(rubric_docx)
-    for para in doc.paragraphs:
-        text = para.text.strip()
-        if text and any(char.isdigit() for char in text[:2]):
-            parts = text.split(" ", 1)
-            if len(parts) == 2:
-                points = 2 if "2" in parts[0] else 1
-                rubric.append({"critère": parts[1], "points": points})
+    try:
+        rubric = compile_rubric(rubric_docx.getvalue(), rubric_docx.name).to_list()
+    except RubricError as e:
+        st.error(f"Grille illisible : {e}")
     with st.expander("📊 Grille d'évaluation", expanded=False):
         st.json(rubric)
 
@@ -143,19 +153,12 @@ st.components.v1.html(recorder_html(), height=220)
 audio_file = st.file_uploader("📤 Charger l'enregistrement généré ci-dessus ou un autre fichier (.wav, .mp3, .m4a)", type=["wav", "mp3", "m4a"])
 
 if audio_file and client and st.button("🔈 Transcrire avec Whisper"):
-    ext = os.path.splitext(audio_file.name)[1]
-    with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as tmp_file:
-        tmp_file.write(audio_file.read())
-        tmp_path = tmp_file.name
     try:
-        with open(tmp_path, "rb") as f:
-            transcript = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=f,
-                language="fr"
-            )
-        st.session_state.transcript = transcript.text
-        os.remove(tmp_path)
+        from evaluation import transcribe
+        # Copie par blocs dans un fichier temporaire, supprimé même si Whisper échoue
+        with spooled_upload(audio_file) as (tmp_path, audio_hash):
+            st.session_state.transcript = transcribe(client, tmp_path, cache=get_transcription_cache(),
+                                                     audio_hash=audio_hash)
         st.success("✅ Transcription réussie")
     except Exception as e:
         st.error(f"❌ Erreur : {e}")
@@ -163,6 +166,16 @@ if audio_file and client and st.button("🔈 Transcrire avec Whisper"):
 if st.session_state.transcript:
     st.text_area("📝 Texte transcrit :", value=st.session_state.transcript, height=200)
 
+# Consignes GPT-4 (préfixe stable du prompt, identique pour tous les étudiants)
+INSTRUCTIONS = """Tu es examinateur médical.
+
+Ta tâche :
+1. Évalue chaque critère individuellement avec justification.
+2. Donne un score total (sur 18).
+3. Évalue la qualité de la synthèse (0 à 1) et de la prise en charge (0 à 1).
+4. Donne un score final sur 20.
+5. Rédige un commentaire global (max 5 lignes)."""
+
 # Évaluation GPT-4
 if st.button("🧠 Évaluer la réponse avec GPT-4"):
     if not (clinical_text and rubric and st.session_state.transcript):
@@ -170,25 +183,12 @@ if st.button("🧠 Évaluer la réponse avec GPT-4"):
     elif not client:
         st.warning("Veuillez entrer votre clé API OpenAI.")
     else:
-        prompt = f"""
-Tu es examinateur médical. Voici :
-- ID étudiant : {student_id}
-- Cas clinique : {clinical_text}
-- Réponse de l'étudiant : {st.session_state.transcript}
-- Grille d'évaluation : {json.dumps(rubric, ensure_ascii=False)}
-
-Ta tâche :
-1. Évalue chaque critère individuellement avec justification.
-2. Donne un score total (sur 18).
-3. Évalue la qualité de la synthèse (0 à 1) et de la prise en charge (0 à 1).
-4. Donne un score final sur 20.
-5. Rédige un commentaire global (max 5 lignes).
-"""
+        messages = build_messages(INSTRUCTIONS, clinical_text, rubric, st.session_state.transcript)
         with st.spinner("GPT-4 réfléchit..."):
             try:
                 response = client.chat.completions.create(
                     model="gpt-4",
-                    messages=[{"role": "user", "content": prompt}],
+                    messages=messages,
                     temperature=0.3
                 )
                 st.session_state.evaluation = response.choices[0].message.content
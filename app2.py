@@ -1,18 +1,36 @@
 import streamlit as st
-import json
-import tempfile
 import os
-import pandas as pd
-from docx import Document
 from datetime import datetime
-from openai import OpenAI
-import numpy as np
-from scipy.io.wavfile import write
+
+# openai et evaluation (numpy, scipy, av) ne sont importés que sur les chemins qui
+# s'en servent : les reruns (chaque interaction) n'en paient jamais le coût
+from prompt import build_messages
+from rubric import RubricError, compile_rubric
+from uploads import spooled_upload, sweep_uploads
 
 # Configuration page
 st.set_page_config(page_title="Évaluation Médicale IA", page_icon="🧠")
 st.title("🧠 Évaluation Médicale IA Automatisée")
 
+# Cache des transcriptions Whisper (partagé entre les sessions)
+@st.cache_resource
+def get_transcription_cache():
+    from cache import TranscriptionCache
+    return TranscriptionCache()
+
+# Client OpenAI : un par jeu d'identifiants et par processus
+@st.cache_resource
+def get_client(api_key: str, organization: str, project: str):
+    from openai import OpenAI
+    return OpenAI(api_key=api_key, organization=organization, project=project)
+
+# Une fois par processus : fichiers temporaires laissés par un processus interrompu
+@st.cache_resource
+def sweep_abandoned_uploads():
+    return sweep_uploads()
+
+sweep_abandoned_uploads()
+
 # Barre latérale pour les identifiants OpenAI
 with st.sidebar:
     st.header("🔐 Identifiants OpenAI")
@@ -33,11 +51,7 @@ if st.session_state.get("reset"):
 
 client = None
 if openai_api_key and openai_org and openai_project:
-    client = OpenAI(
-        api_key=openai_api_key,
-        organization=openai_org,
-        project=openai_project
-    )
+    client = get_client(openai_api_key, openai_org, openai_project)
 
 # Initialiser les states
 if "transcript" not in st.session_state:
@@ -63,14 +77,10 @@ if clinical_file is not None:
 rubric_docx = st.file_uploader("📋 Charger la grille d'évaluation (.docx)", type=["docx"])
 rubric = []
 if rubric_docx is not None:
-    doc = Document(rubric_docx)
-    for para in doc.paragraphs:
-        text = para.text.strip()
-        if text and any(char.isdigit() for char in text[:2]):
-            parts = text.split(" ", 1)
-            if len(parts) == 2:
-                points = 2 if "2" in parts[0] else 1
-                rubric.append({"critère": parts[1], "points": points})
+    try:
+        rubric = compile_rubric(rubric_docx.getvalue(), rubric_docx.name).to_list()
+    except RubricError as e:
+        st.error(f"Grille illisible : {e}")
     with st.expander("📊 Grille d'évaluation", expanded=False):
         st.json(rubric)
 
@@ -160,19 +170,12 @@ st.components.v1.html(recorder_html(), height=220)
 audio_file = st.file_uploader("📤 Charger l'enregistrement généré ci-dessus ou un autre fichier (.wav, .mp3, .m4a)", type=["wav", "mp3", "m4a"])
 
 if audio_file and client and st.button("🔈 Transcrire avec Whisper"):
-    ext = os.path.splitext(audio_file.name)[1]
-    with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as tmp_file:
-        tmp_file.write(audio_file.read())
-        tmp_path = tmp_file.name
     try:
-        with open(tmp_path, "rb") as f:
-            transcript = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=f,
-                language="fr"
-            )
-        st.session_state.transcript = transcript.text
-        os.remove(tmp_path)
+        from evaluation import transcribe
+        # Copie par blocs dans un fichier temporaire, supprimé même si Whisper échoue
+        with spooled_upload(audio_file) as (tmp_path, audio_hash):
+            st.session_state.transcript = transcribe(client, tmp_path, cache=get_transcription_cache(),
+                                                     audio_hash=audio_hash)
         st.success("✅ Transcription réussie")
     except Exception as e:
         st.error(f"❌ Erreur : {e}")
@@ -180,19 +183,8 @@ if audio_file and client and st.button("🔈 Transcrire avec Whisper"):
 if st.session_state.transcript:
     st.text_area("📝 Texte transcrit :", value=st.session_state.transcript, height=200)
 
-# Évaluation GPT-4
-if st.button("🧠 Évaluer la réponse avec GPT-4"):
-    if not (clinical_text and rubric and st.session_state.transcript):
-        st.warning("Merci de remplir tous les champs requis avant l'évaluation.")
-    elif not client:
-        st.warning("Veuillez entrer votre clé API OpenAI.")
-    else:
-        prompt = f"""
-Tu es un examinateur médical rigoureux. Voici :
-- ID étudiant : {student_id}
-- Cas clinique : {clinical_text}
-- Réponse de l'étudiant : {st.session_state.transcript}
-- Grille d'évaluation : {json.dumps(rubric, ensure_ascii=False)}
+# Consignes GPT-4 (préfixe stable du prompt, identique pour tous les étudiants)
+INSTRUCTIONS = """Tu es un examinateur médical rigoureux.
 
 Ta tâche est d'évaluer la réponse de l'étudiant selon les critères suivants :
 1. Évalue chaque critère individuellement avec justification sans inventer de données.
@@ -200,13 +192,21 @@ Ta tâche est d'évaluer la réponse de l'étudiant selon les critères suivants
 3. Évalue la qualité de la synthèse (0 à 1) et de la prise en charge (0 à 1).
 4. Donne un score final sur 20.
 5. Rédige un commentaire global (maximum 5 lignes).
-N'invente jamais d'informations absentes de la réponse de l'étudiant.
-"""
+N'invente jamais d'informations absentes de la réponse de l'étudiant."""
+
+# Évaluation GPT-4
+if st.button("🧠 Évaluer la réponse avec GPT-4"):
+    if not (clinical_text and rubric and st.session_state.transcript):
+        st.warning("Merci de remplir tous les champs requis avant l'évaluation.")
+    elif not client:
+        st.warning("Veuillez entrer votre clé API OpenAI.")
+    else:
+        messages = build_messages(INSTRUCTIONS, clinical_text, rubric, st.session_state.transcript)
         with st.spinner("GPT-4 réfléchit..."):
             try:
                 response = client.chat.completions.create(
                     model="gpt-4",
-                    messages=[{"role": "user", "content": prompt}],
+                    messages=messages,
                     temperature=0.0
                 )
                 st.session_state.evaluation = response.choices[0].message.content
@@ -231,6 +231,7 @@ if st.session_state.evaluation:
         "note_eval1": note_eval1,
         "note_eval2": note_eval2
     }
+    import pandas as pd
     df = pd.DataFrame([row])
 
     if not os.path.exists("resultats_etudiants.csv"):
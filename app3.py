@@ -1,34 +1,89 @@
 import streamlit as st
 import json
-import tempfile
-import os
-import sqlite3
-from docx import Document
-from datetime import datetime
-from openai import OpenAI
-import pandas as pd
+from datetime import datetime, timedelta
+
+# pandas, agreement (scipy.stats) et live (WebRTC) ne sont importés qu'à l'affichage
+# des vues qui s'en servent ; le client OpenAI est créé une fois (get_client)
+from archive import AudioArchive
+from cache import EvaluationCache, TranscriptionCache
+from evaluation import GPT_MODEL, MalformedResponse, evaluate, evaluation_key, transcribe
+from db import NOTES_DB_PATH, NOTES_MIGRATIONS, Database, fetch_history_page, record_purge
+from metrics import MetricsStore, mark_cached, set_recorder, stage
+from prompt import build_messages
+from rubric import RubricError, compile_rubric
+from uploads import spooled_upload
 
 # Configuration de la page
 st.set_page_config(page_title="Évaluation Médicale IA", page_icon="🧠")
 st.title("Évaluation ECOS IA")
 
-# Création dossier audios
-AUDIO_DIR = "audios"
-os.makedirs(AUDIO_DIR, exist_ok=True)
+# Cache des transcriptions Whisper (partagé entre les sessions)
+@st.cache_resource
+def get_transcription_cache():
+    return TranscriptionCache()
 
-# Connexion base SQLite
-DB_PATH = "evaluation.db"
-conn = sqlite3.connect(DB_PATH)
-c = conn.cursor()
-c.execute('''
-CREATE TABLE IF NOT EXISTS evaluations (
-    id_etudiant TEXT PRIMARY KEY,
-    note_ia REAL,
-    eval1 REAL,
-    eval2 REAL
-)
-''')
-conn.commit()
+@st.cache_resource
+def get_evaluation_cache():
+    return EvaluationCache()
+
+@st.cache_resource
+def get_audio_archive():
+    return AudioArchive()
+
+# Mesures par étape (metrics.db, consultables dans app4) ; une fois par processus
+@st.cache_resource
+def get_metrics_store():
+    store = MetricsStore()
+    set_recorder(store)
+    return store
+
+get_metrics_store()
+
+# Version des consignes ci-dessous (clé du cache des évaluations)
+PROMPT_VERSION = "app3-2"
+
+# Consignes GPT-4 : préfixe stable du prompt, identique pour tous les étudiants
+INSTRUCTIONS = """Tu es un examinateur médical rigoureux et impartial.
+
+Ta mission est d'évaluer la réponse orale de l'étudiant selon les règles suivantes :
+
+1. Pour chaque critère de la grille, indique clairement s'il est observé (score positif) ou non observé (score nul), en justifiant uniquement à partir des propos précis de l'étudiant.
+2. Calcule le score total sur 18 points selon la grille fournie.
+3. Attribue une note de synthèse (0 à 1) et une note de prise en charge (0 à 1).
+4. Calcule une note finale sur 20.
+5. Fournis un commentaire global justifiant la note finale (maximum 5 lignes).
+
+⚠️ N'invente aucune information absente de la réponse de l'étudiant. Si une information n'est pas explicitement mentionnée, considère-la comme absente.
+
+Retourne STRICTEMENT et EXCLUSIVEMENT un JSON conforme à ce format :
+{
+  "notes": [{"critère": "...", "score": 1, "justification": "..."}],
+  "synthese": 0.5,
+  "prise_en_charge": 1.0,
+  "note_finale": 19,
+  "commentaire": "Très bonne réponse."
+}
+
+Aucun texte supplémentaire hors du JSON ne doit être ajouté."""
+
+
+# Connexion base SQLite (unique par processus, schéma migré une seule fois)
+@st.cache_resource
+def get_db():
+    return Database(NOTES_DB_PATH, NOTES_MIGRATIONS)
+
+db = get_db()
+
+@st.cache_resource
+def get_agreement_tracker():
+    from agreement import AgreementTracker
+    return AgreementTracker(db, "notes")
+
+# Client OpenAI : un par jeu d'identifiants et par processus
+@st.cache_resource
+def get_client(api_key: str, organization: str, project: str):
+    from openai import OpenAI
+    return OpenAI(api_key=api_key, organization=organization, project=project)
 
 
 
@@ -39,7 +94,7 @@ with st.sidebar:
     openai_org = st.text_input("ID Organisation", help="ex: org-xxxxx")
     openai_project = st.text_input("ID Projet", help="ex: proj_xxxx")
     if st.button("🧹 Réinitialiser la session"):
-        for key in ["transcript", "result_json", "student_id"]:
+        for key in ["transcripts", "result_json", "student_id"]:
             if key in st.session_state:
                 del st.session_state[key]
         st.success("✅ Session réinitialisée. Saisis un nouvel étudiant.")
@@ -55,10 +110,9 @@ with st.sidebar:
         confirm = st.checkbox("Je confirme vouloir effacer toutes les données définitivement.")
         if confirm and st.button("✅ Confirmer la suppression"):
             try:
-                c.execute("DELETE FROM evaluations")
-                c.execute("DELETE FROM etudiants")
-                c.execute("DELETE FROM evaluateurs")
-                conn.commit()
+                with db.transaction() as conn:
+                    conn.execute("DELETE FROM evaluations")
+                    record_purge(conn)
                 st.success("✅ Toutes les données ont été effacées avec succès.")
                 st.session_state["confirm_delete"] = False  # réinitialisation
                 st.rerun()
@@ -70,16 +124,16 @@ with st.sidebar:
 # OpenAI client
 client = None
 if openai_api_key and openai_org and openai_project:
-    client = OpenAI(api_key=openai_api_key, organization=openai_org, project=openai_project)
+    client = get_client(openai_api_key, openai_org, openai_project)
 
 # Initialiser les states
-st.session_state.setdefault("transcript", "")
+# Transcriptions par étudiant : celle d'un étudiant n'est jamais évaluée sous l'identifiant d'un autre
+transcripts = st.session_state.setdefault("transcripts", {})
 st.session_state.setdefault("result_json", "")
 st.session_state.setdefault("student_id", "")
 
 # ID étudiant
-student_id = st.text_input("🆔 Identifiant de l'étudiant", value=st.session_state.student_id)
-st.session_state.student_id = student_id
+student_id = st.text_input("🆔 Identifiant de l'étudiant", key="student_id")
 
 # Cas clinique
 clinical_file = st.file_uploader("📄 Charger le cas clinique (.txt)", type=["txt"])
@@ -95,10 +149,10 @@ rubric_json = st.file_uploader("📋 Charger la grille d'évaluation (.json)", t
 rubric = []
 if rubric_json is not None:
     try:
-        rubric_data = json.load(rubric_json)
-        rubric = rubric_data.get("grille_observation", [])
-        synthese_options = rubric_data.get("synthese", {})
-        prise_en_charge_options = rubric_data.get("prise_en_charge", {})
+        compiled = compile_rubric(rubric_json.getvalue(), rubric_json.name)
+        rubric = compiled.to_list()
+        synthese_options = compiled.synthese
+        prise_en_charge_options = compiled.prise_en_charge
 
         with st.expander("📊 Grille d'évaluation (critères)", expanded=False):
             st.json(rubric)
@@ -111,7 +165,7 @@ if rubric_json is not None:
             for k, v in prise_en_charge_options.items():
                 st.markdown(f"- **{k}** : {v}")
 
-    except Exception as e:
+    except RubricError as e:
         st.error(f"Erreur lors du chargement du fichier JSON : {e}")
 
 
@@ -119,6 +173,14 @@ if rubric_json is not None:
 
 st.markdown("## Enregistrement audio (max 8 min)")
 
+# Mode direct : transcription pendant que l'étudiant parle (streamlit-webrtc)
+if st.toggle("🔴 Transcription en direct (WebRTC)"):
+    if client:
+        from live import live_recorder
+        live_recorder(student_id, client)
+    else:
+        st.warning("⚠️ Renseigne les identifiants OpenAI pour la transcription en direct.")
+
 # Injection de l'ID étudiant directement dans le HTML
 html_code = f"""
 <script>
@@ -217,71 +279,41 @@ st.components.v1.html(html_code, height=350)
 # 📤 Upload audio manuel
 audio_file = st.file_uploader("📤 Charger un fichier audio (.wav, .mp3, .m4a)", type=["wav", "mp3", "m4a"])
 if audio_file and client and st.button("🔈 Transcrire avec Whisper"):
-    ext = os.path.splitext(audio_file.name)[1]
-    save_path = os.path.join(AUDIO_DIR, f"{student_id}{ext}")
-    with open(save_path, "wb") as f_out:
-        f_out.write(audio_file.read())
     try:
-        with open(save_path, "rb") as f:
-            transcript = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=f,
-                language="fr"
-            )
-        st.session_state.transcript = transcript.text
+        with spooled_upload(audio_file) as (tmp_path, audio_hash):
+            transcripts[student_id] = transcribe(client, tmp_path, cache=get_transcription_cache(),
+                                                 audio_hash=audio_hash)
+            # Archivé en Opus sous son empreinte : une nouvelle tentative n'écrase plus la précédente
+            get_audio_archive().put(tmp_path, student_id, original_name=audio_file.name,
+                                    source_hash=audio_hash)
         st.success("✅ Transcription réussie")
     except Exception as e:
         st.error(f"Erreur Whisper : {e}")
 
-if st.session_state.transcript:
-    st.text_area("📝 Transcription", value=st.session_state.transcript, height=200)
+transcript = transcripts.get(student_id, "")
+if transcript:
+    st.text_area("📝 Transcription", value=transcript, height=200)
 
 # GPT-4 : évaluation
+force_eval = st.checkbox("🔁 Forcer la ré-évaluation (ignorer le cache)")
 if st.button("🧠 Évaluation"):
-    if not (clinical_text and rubric and st.session_state.transcript):
+    if not (clinical_text and rubric and transcript):
         st.warning("⚠️ Remplis tous les champs nécessaires.")
     else:
-        prompt = f"""
-        Tu es un examinateur médical rigoureux et impartial.
-
-        Voici les éléments à considérer :
-        - ID étudiant : {student_id}
-        - Cas clinique : {clinical_text}
-        - Réponse de l'étudiant : {st.session_state.transcript}
-        - Grille d'évaluation : {json.dumps(rubric, ensure_ascii=False)}
-
-        Ta mission est d'évaluer la réponse orale de l'étudiant selon les règles suivantes :
-
-        1. Pour chaque critère de la grille, indique clairement s'il est observé (score positif) ou non observé (score nul), en justifiant uniquement à partir des propos précis de l'étudiant.
-        2. Calcule le score total sur 18 points selon la grille fournie.
-        3. Attribue une note de synthèse (0 à 1) et une note de prise en charge (0 à 1).
-        4. Calcule une note finale sur 20.
-        5. Fournis un commentaire global justifiant la note finale (maximum 5 lignes).
-
-        ⚠️ N'invente aucune information absente de la réponse de l'étudiant. Si une information n'est pas explicitement mentionnée, considère-la comme absente.
-
-        Retourne STRICTEMENT et EXCLUSIVEMENT un JSON conforme à ce format :
-        {{
-          "notes": [{{"critère": "...", "score": 1, "justification": "..."}}],
-          "synthese": 0.5,
-          "prise_en_charge": 1.0,
-          "note_finale": 19,
-          "commentaire": "Très bonne réponse."
-        }}
-
-        Aucun texte supplémentaire hors du JSON ne doit être ajouté.
-        """
+        messages = build_messages(INSTRUCTIONS, clinical_text, rubric, transcript,
+                                  completion_tokens=1000)
 
         try:
-            response = client.chat.completions.create(
-                model="gpt-4",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.0,
-                max_tokens=1000
-            )
-
-            result_json = response.choices[0].message.content.strip()
-            result = json.loads(result_json)
+            cache_key = evaluation_key(clinical_text, rubric, transcript,
+                                       temperature=0.0, prompt_version=PROMPT_VERSION)
+            with stage("gpt4", GPT_MODEL):
+                result = None if force_eval else get_evaluation_cache().get(cache_key)
+                if result is None:
+                    # Sortie structurée, réparation locale / ciblée et réessais sur erreurs transitoires
+                    result = evaluate(client, messages, temperature=0.0, max_tokens=1000)
+                    get_evaluation_cache().put(cache_key, result)
+                else:
+                    mark_cached()
 
             # Afficher la note finale de l'IA
             # Afficher la note finale de l'IA
@@ -302,15 +334,15 @@ if st.button("🧠 Évaluation"):
 
             # Bouton de sauvegarde en SQLite
             if st.button("💾 Sauvegarder les résultats"):
-                c.execute("""
-                    INSERT OR REPLACE INTO evaluations (id_etudiant, note_ia, eval1, eval2)
-                    VALUES (?, ?, ?, ?)
-                """, (student_id, result['note_finale'], eval1, eval2))
-                conn.commit()
+                with stage("sqlite"), db.transaction() as conn:
+                    conn.execute("""
+                        INSERT OR REPLACE INTO evaluations (id_etudiant, note_ia, eval1, eval2, date_evaluation)
+                        VALUES (?, ?, ?, ?, ?)
+                    """, (student_id, result['note_finale'], eval1, eval2, datetime.now().isoformat()))
                 st.success("✅ Résultats enregistrés avec succès dans SQLite !")
 
-        except json.JSONDecodeError:
-            st.error("❌ GPT-4 n'a pas retourné un JSON valide. Réessaie.")
+        except MalformedResponse as e:
+            st.error(f"❌ Réponse GPT-4 invalide malgré la réparation automatique : {e}")
         except Exception as e:
             st.error(f"❌ Erreur GPT-4 : {e}")
             
@@ -326,24 +358,67 @@ if st.session_state.result_json:
         eval2 = st.number_input("Note évaluateur 2 (sur 20)", min_value=0.0, max_value=20.0, step=0.25)
 
         if st.button("💾 Sauvegarder en base"):
-            c.execute("INSERT OR IGNORE INTO etudiants VALUES (?, ?)", (student_id, datetime.now().isoformat()))
-            for note in result["notes"]:
-                c.execute("""
+            with stage("sqlite"), db.transaction() as conn:
+                conn.execute("INSERT OR IGNORE INTO etudiants VALUES (?, ?)", (student_id, datetime.now().isoformat()))
+                conn.executemany("""
                     INSERT INTO evaluations VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
+                """, [(
                     student_id, note["critère"], note["score"], note["justification"],
                     result.get("synthese", 0), result.get("prise_en_charge", 0),
                     result.get("note_finale", 0), result.get("commentaire", "")
-                ))
-            c.execute("INSERT OR REPLACE INTO evaluateurs VALUES (?, ?, ?)", (student_id, eval1, eval2))
-            conn.commit()
+                ) for note in result["notes"]])
+                conn.execute("INSERT OR REPLACE INTO evaluateurs VALUES (?, ?, ?)", (student_id, eval1, eval2))
             st.success("✅ Résultats sauvegardés dans la base SQLite.")
     except Exception as e:
         st.error(f"Erreur de parsing JSON : {e}")
 
-# Historique
+# Historique (paginé : seule la page affichée est lue en base)
+@st.cache_data(max_entries=1, show_spinner="Préparation de l'export...")
+def export_history_csv(db_version) -> bytes:
+    return db.export_csv("SELECT * FROM evaluations ORDER BY rowid DESC")
+
 st.markdown("### 🧾 Historique des évaluations")
 if st.checkbox("📂 Afficher le tableau des résultats"):
-    df_eval = pd.read_sql_query("SELECT * FROM evaluations", conn)
-    st.dataframe(df_eval)
-    st.download_button("⬇️ Télécharger les évaluations", df_eval.to_csv(index=False), file_name="evaluations.csv")
+    col_id, col_dates, col_scores = st.columns(3)
+    filters = {
+        "student_prefix": col_id.text_input("🔎 Identifiant (début)"),
+        "score_min": None,
+        "score_max": None,
+    }
+    dates = col_dates.date_input("📅 Période", value=())
+    if len(dates) == 2:
+        filters["date_min"], filters["date_max"] = dates[0], dates[1] + timedelta(days=1)
+    score_range = col_scores.slider("🎯 Note IA", 0.0, 20.0, (0.0, 20.0), step=0.5)
+    if score_range != (0.0, 20.0):
+        filters["score_min"], filters["score_max"] = score_range
+
+    # Pile des curseurs : réinitialisée dès que les filtres changent
+    if st.session_state.get("history_filters") != filters:
+        st.session_state.history_filters = filters
+        st.session_state.history_cursors = [None]
+    cursors = st.session_state.history_cursors
+
+    columns, rows, next_cursor = fetch_history_page(db, before_rowid=cursors[-1], **filters)
+    import pandas as pd
+    st.dataframe(pd.DataFrame(rows, columns=columns), hide_index=True)
+
+    col_prev, col_page, col_next = st.columns([1, 2, 1])
+    if col_prev.button("⬅️ Précédent", disabled=len(cursors) == 1):
+        cursors.pop()
+        st.rerun()
+    col_page.caption(f"Page {len(cursors)}")
+    if col_next.button("Suivant ➡️", disabled=next_cursor is None):
+        cursors.append(next_cursor)
+        st.rerun()
+
+    if st.button("📦 Préparer l'export CSV"):
+        st.session_state.history_export = True
+    if st.session_state.get("history_export"):
+        st.download_button("⬇️ Télécharger les évaluations", export_history_csv(db.version()),
+                           file_name="evaluations.csv", mime="text/csv")
+
+# Accord IA / évaluateurs sur toute la cohorte (mis à jour de façon incrémentale)
+st.markdown("### 📈 Accord IA / évaluateurs")
+if st.checkbox("📊 Afficher les indicateurs d'accord"):
+    from agreement import agreement_dashboard
+    agreement_dashboard(get_agreement_tracker())
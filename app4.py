@@ -1,24 +1,26 @@
 # Évaluation Médicale IA - Fusion des versions pro et audio
 
 import streamlit as st
-import json
-import sqlite3
-import hashlib
-import tempfile
 import os
-from datetime import datetime
-from openai import OpenAI
+import time
 from werkzeug.utils import secure_filename
-from pydantic import BaseModel, ValidationError
-import pandas as pd
-import re
+
+# agreement (scipy.stats) et live (WebRTC) ne sont importés qu'à l'ouverture des vues
+# qui s'en servent ; le client OpenAI est créé une fois par identifiants (get_client)
+from archive import AudioArchive
+from cache import EvaluationCache, TranscriptionCache
+from evaluation import SHARD_SIZE
+from db import Database, purge, save_human_evaluation
+from jobs import ACTIVE, FAILED, PENDING, POLL_SECONDS, JobPool, JobQueue
+from metrics import MetricsStore, set_recorder, stage
+from rubric import RubricError, compile_rubric
 
 # ---------------------------
 # CONFIGURATION
 # ---------------------------
 AUDIO_DIR = "audios"
 os.makedirs(AUDIO_DIR, exist_ok=True)
-DB_PATH = "evaluations.db"
+METRICS_WINDOW_S = 24 * 3600
 
 st.set_page_config(
     page_title="Évaluation Médicale IA",
@@ -31,59 +33,50 @@ st.title("📋 Évaluation ECOS par Intelligence Artificielle")
 # ---------------------------
 # BASE DE DONNÉES
 # ---------------------------
-def init_db():
-    with sqlite3.connect(DB_PATH) as conn:
-        c = conn.cursor()
-        c.execute('''
-        CREATE TABLE IF NOT EXISTS etudiants (
-            id_etudiant TEXT PRIMARY KEY,
-            date_evaluation DATETIME,
-            hash_identification TEXT
-        )''')
-
-        c.execute('''
-        CREATE TABLE IF NOT EXISTS evaluations_ia (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            id_etudiant TEXT,
-            critere TEXT,
-            score REAL,
-            justification TEXT,
-            synthese REAL,
-            prise_en_charge REAL,
-            note_finale REAL,
-            commentaire TEXT,
-            FOREIGN KEY(id_etudiant) REFERENCES etudiants(id_etudiant)
-        )''')
-
-        c.execute('''
-        CREATE TABLE IF NOT EXISTS evaluations_humaines (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            id_etudiant TEXT,
-            eval1 REAL,
-            eval2 REAL,
-            timestamp DATETIME,
-            FOREIGN KEY(id_etudiant) REFERENCES etudiants(id_etudiant)
-        )''')
-        conn.commit()
-
-init_db()
-
-# ---------------------------
-# VALIDATION
-# ---------------------------
-class EvaluationResult(BaseModel):
-    notes: list[dict]
-    synthese: float
-    prise_en_charge: float
-    note_finale: float
-    commentaire: str
+@st.cache_resource
+def get_db():
+    # Connexion unique par processus ; le schéma est migré à la première création
+    return Database()
+
+@st.cache_resource
+def get_transcription_cache():
+    return TranscriptionCache()
+
+@st.cache_resource
+def get_evaluation_cache():
+    return EvaluationCache()
+
+@st.cache_resource
+def get_audio_archive():
+    return AudioArchive()
+
+@st.cache_resource
+def get_agreement_tracker():
+    # Statistiques d'accord tenues à jour au fil des nouvelles évaluations humaines
+    from agreement import AgreementTracker
+    return AgreementTracker(get_db(), "ecos")
+
+# Client OpenAI : un par jeu d'identifiants et par processus
+@st.cache_resource
+def get_client(api_key: str, organization: str, project: str):
+    from openai import OpenAI
+    return OpenAI(api_key=api_key, organization=organization, project=project)
+
+@st.cache_resource
+def get_metrics_store():
+    # Actif pour tout le processus : les workers du JobPool enregistrent aussi leurs étapes
+    store = MetricsStore()
+    set_recorder(store)
+    return store
+
+@st.cache_data(max_entries=1, show_spinner="Préparation de l'export...")
+def export_evaluations_csv(db_version) -> bytes:
+    # `db_version` (voir Database.version) sert de clé : le cache expire à chaque écriture
+    return get_db().export_csv("SELECT * FROM evaluations_ia ORDER BY id")
 
 # ---------------------------
 # OUTILS
 # ---------------------------
-def hash_identification(raw_id):
-    return hashlib.sha256(raw_id.encode()).hexdigest()
-
 def safe_filename(student_id: str) -> str:
     return secure_filename(f"student_{student_id}")
 
@@ -103,16 +96,20 @@ def sidebar():
 
         if st.session_state.get("confirm_purge"):
             if st.checkbox("✅ Confirmer suppression"):
-                with sqlite3.connect(DB_PATH) as conn:
-                    conn.execute("DELETE FROM evaluations_ia")
-                    conn.execute("DELETE FROM evaluations_humaines")
-                    conn.execute("DELETE FROM etudiants")
-                    st.success("Toutes les données ont été supprimées.")
-                    st.session_state.confirm_purge = False
-
-        st.download_button("⬇️ Exporter les évaluations",
-                           data=pd.read_sql("SELECT * FROM evaluations_ia", sqlite3.connect(DB_PATH)).to_csv(),
-                           file_name="evaluations.csv")
+                with get_db().transaction() as conn:
+                    purge(conn)
+                get_job_pool().queue.purge()
+                st.success("Toutes les données ont été supprimées.")
+                st.session_state.confirm_purge = False
+
+        # Export construit uniquement à la demande, puis mis en cache jusqu'à la prochaine écriture
+        if st.button("📦 Préparer l'export CSV"):
+            st.session_state.export_requested = True
+        if st.session_state.get("export_requested"):
+            st.download_button("⬇️ Exporter les évaluations",
+                               data=export_evaluations_csv(get_db().version()),
+                               file_name="evaluations.csv",
+                               mime="text/csv")
 
     return api_key, org, project
 
@@ -162,32 +159,118 @@ def audio_recorder_html(student_id):
     st.components.v1.html(html, height=150)
 
 # ---------------------------
-# GPT-4 ÉVALUATION
+# TRAVAUX D'ÉVALUATION
 # ---------------------------
-def evaluate_with_gpt4(client: OpenAI, prompt: str) -> dict:
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.1,
-            max_tokens=1500
-        )
-        result_json = response.choices[0].message.content.strip()
-        json_match = re.search(r"\{.*\}", result_json, re.DOTALL)
-        if not json_match:
-            raise ValueError("Format JSON manquant")
-        parsed = json.loads(json_match.group())
-        validated = EvaluationResult(**parsed)
-        return validated.dict()
-    except Exception as e:
-        st.error(f"Erreur GPT/JSON : {str(e)}")
-        st.stop()
+@st.cache_resource
+def get_job_pool():
+    # Un pool de workers par processus : les reruns Streamlit le retrouvent tel quel
+    return JobPool(JobQueue(), get_db(), transcription_cache=get_transcription_cache(),
+                   evaluation_cache=get_evaluation_cache(), archive=get_audio_archive()).start()
+
+def render_note(container, crit):
+    local_mark = "🧮 " if crit.get("local") else ""
+    container.markdown(f"- {local_mark}**{crit.get('critère', '?')}** : {crit.get('score', '?')}\n"
+                       f"> _{crit.get('justification', '')}_")
+    for excerpt in crit.get("extraits") or []:
+        container.caption(f"[{excerpt['id']}] {excerpt['texte']}")
+
+STAGE_LABELS = {
+    "transcription": "🔈 Transcription Whisper",
+    "evaluation": "🧩 Évaluation des critères",
+    "enregistrement": "💾 Enregistrement",
+}
+
+@st.fragment(run_every=POLL_SECONDS)
+def job_progress(job_id: int):
+    """Suit un travail en cours ; seule cette zone est réexécutée à chaque interrogation."""
+    job = get_job_pool().queue.get(job_id)
+    if job["statut"] not in ACTIVE:
+        st.rerun()
+    if job["statut"] == PENDING:
+        st.info("⏳ En file d'attente...")
+    else:
+        st.info(f"{STAGE_LABELS.get(job['etape'], job['etape'])} en cours...")
+    # Chaque critère s'affiche dès que GPT-4 a fini de l'écrire (streaming)
+    for crit in job["notes"] or []:
+        render_note(st, crit)
+
+def show_job(job: dict, student_id: str, client=None):
+    pool = get_job_pool()
+    if job["statut"] in ACTIVE:
+        if client is not None:
+            # Travail soumis avant un redémarrage : il reprend avec les identifiants de cette session
+            pool.attach(job["id"], client)
+        elif not pool.has_client(job["id"]):
+            st.info("🔑 Renseignez les identifiants OpenAI pour lancer ce travail.")
+        job_progress(job["id"])
+        return
+    if job["statut"] == FAILED:
+        st.error(f"❌ Évaluation interrompue : {job['erreur']}")
+        if job["transcription"] is None and not (job["audio_path"] and os.path.exists(job["audio_path"])):
+            st.warning("⚠️ L'audio de ce travail n'est plus disponible : soumettez-le à nouveau.")
+        elif client is None:
+            st.warning("⚠️ Renseignez les identifiants OpenAI pour reprendre l'évaluation.")
+        elif st.button("🔁 Reprendre l'évaluation"):
+            # Repart de la dernière étape terminée (transcription déjà faite = pas de nouvel appel Whisper)
+            pool.retry(job["id"], client)
+            st.rerun()
+        return
+
+    result = job["resultat"]
+    st.subheader(f"📊 Note finale : {result['note_finale']} / 20")
+    for crit in result["notes"]:
+        render_note(st, crit)
+    st.success("✅ Résultats enregistrés")
+    if job["erreur"]:
+        st.warning(f"⚠️ {job['erreur']}")
+    for recording in get_audio_archive().recordings(run_id=job["run_id"])[:1]:
+        if os.path.exists(recording["path"]):  # blob éventuellement évincé par la rétention
+            st.audio(recording["path"], format="audio/ogg")
+
+    # Hors du bouton « Évaluer » : bouger un curseur ne relance rien
+    eval1 = st.slider("Évaluateur 1", 0.0, 20.0, step=0.5, key=f"eval1_{job['id']}")
+    eval2 = st.slider("Évaluateur 2", 0.0, 20.0, step=0.5, key=f"eval2_{job['id']}")
+    if st.button("💾 Enregistrer les notes des évaluateurs"):
+        with stage("sqlite"), get_db().transaction() as conn:
+            save_human_evaluation(conn, student_id, eval1, eval2, job["run_id"])
+        st.success("✅ Notes des évaluateurs enregistrées")
+
+def metrics_panel(store: MetricsStore):
+    """Durées p50/p95, tokens et coût par étape sur les dernières 24 h, et exports."""
+    since = time.time() - METRICS_WINDOW_S
+    summary = store.summary(since)
+    if not summary:
+        st.info("Aucune mesure sur les dernières 24 h.")
+        return
+    st.dataframe([{
+        "Étape": etape, "Exécutions": s["n"], "p50 (s)": round(s["p50_s"], 2), "p95 (s)": round(s["p95_s"], 2),
+        "Cache": int(s["cache"]), "Échecs": s["echecs"], "Réessais": int(s["reessais"]),
+        "Audio (min)": round(s["audio_s"] / 60, 1),
+        "Tokens": int(s["prompt_tokens"] + s["completion_tokens"]), "Coût (USD)": round(s["cout_usd"], 3),
+    } for etape, s in summary.items()], hide_index=True, use_container_width=True)
+    col1, col2 = st.columns(2)
+    col1.download_button("⬇️ Prometheus", data=store.to_prometheus(since), file_name="metrics.prom",
+                         mime="text/plain")
+    col2.download_button("⬇️ JSON", data=store.to_json(since), file_name="metrics.json",
+                         mime="application/json")
 
 # ---------------------------
 # MAIN
 # ---------------------------
 def main():
     api_key, org, project = sidebar()
+    metrics_store = get_metrics_store()
+    pool = get_job_pool()
+    # Chaque travail est exécuté avec les identifiants de l'examinateur qui le soumet (jamais écrits sur disque)
+    client = get_client(api_key, org, project) if all([api_key, org, project]) else None
+
+    if st.sidebar.toggle("📈 Accord IA / évaluateurs"):
+        with st.expander("📈 Accord IA / évaluateurs (cohorte)", expanded=True):
+            from agreement import agreement_dashboard
+            agreement_dashboard(get_agreement_tracker())
+    if st.sidebar.toggle("⏱️ Performances (24 h)"):
+        with st.expander("⏱️ Durées, tokens et coût par étape", expanded=True):
+            metrics_panel(metrics_store)
 
     student_id = st.text_input("🆔 Identifiant étudiant")
     if not student_id:
@@ -197,68 +280,52 @@ def main():
     rubric_file = st.file_uploader("📋 Grille d'évaluation (JSON)", type=["json"])
 
     with st.expander("🎙️ Enregistrement audio"):
-        audio_recorder_html(student_id)
-        audio_file = st.file_uploader("📤 Audio", type=["wav", "mp3"])
-
-    if st.button("🧠 Évaluer") and all([api_key, org, project, audio_file, clinical_case, rubric_file]):
-        with st.spinner("Analyse en cours..."):
-            client = OpenAI(api_key=api_key, organization=org, project=project)
-
-            clinical_text = clinical_case.read().decode("utf-8")
-            rubric = json.load(rubric_file).get("grille_observation", [])
-
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp:
-                tmp.write(audio_file.read())
-                with open(tmp.name, "rb") as f:
-                    transcript = client.audio.transcriptions.create(
-                        model="whisper-1",
-                        file=f,
-                        language="fr"
-                    )
-            transcript_text = transcript.text
-
-            prompt = f"""
-            Tu es un examinateur médical rigoureux. Voici ta tâche :
-            1. Évalue chaque critère (notes[]) avec score (0 ou 1) et justification.
-            2. Donne une **note de synthèse** : un **nombre décimal entre 0 et 1** (ex: 0.5).
-            3. Donne une **note de prise en charge** : un **nombre décimal entre 0 et 1**.
-            4. Calcule une **note finale** sur 20 (nombre décimal).
-            5. Rédige un **commentaire global** (5 lignes max).
-            ⚠️ Toutes les valeurs doivent être des **nombres** pour les notes, pas du texte. Retourne un JSON strict sans texte autour, comme :
-            {{
-              "notes": [{{"critère": "...", "score": 1, "justification": "..."}}],
-              "synthese": 0.75,
-              "prise_en_charge": 1.0,
-              "note_finale": 18.5,
-              "commentaire": "Très bonne réponse globale."
-            }}
-            Cas : {clinical_text}
-            Réponse de l'étudiant : {transcript_text}
-            Grille : {json.dumps(rubric, ensure_ascii=False)}
-            """
-
-            result = evaluate_with_gpt4(client, prompt)
-
-            st.subheader(f"📊 Note finale : {result['note_finale']} / 20")
-            for crit in result["notes"]:
-                st.markdown(f"- **{crit['critère']}** : {crit['score']}\n> _{crit['justification']}_")
-
-            eval1 = st.slider("Évaluateur 1", 0.0, 20.0, step=0.5)
-            eval2 = st.slider("Évaluateur 2", 0.0, 20.0, step=0.5)
-
-            with sqlite3.connect(DB_PATH) as conn:
-                conn.execute("INSERT OR IGNORE INTO etudiants VALUES (?, ?, ?)",
-                             (student_id, datetime.now(), hash_identification(student_id)))
-                for note in result["notes"]:
-                    conn.execute("INSERT INTO evaluations_ia VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?)", (
-                        student_id, note["critère"], note["score"], note["justification"],
-                        result["synthese"], result["prise_en_charge"],
-                        result["note_finale"], result["commentaire"]
-                    ))
-                conn.execute("INSERT INTO evaluations_humaines VALUES (NULL, ?, ?, ?, ?)",
-                             (student_id, eval1, eval2, datetime.now()))
-                conn.commit()
-            st.success("✅ Résultats enregistrés")
+        if st.toggle("🔴 Transcription en direct (WebRTC)"):
+            if client is not None:
+                from live import live_recorder
+                live_recorder(student_id, client)
+            else:
+                st.warning("⚠️ Renseignez les identifiants OpenAI pour la transcription en direct.")
+        else:
+            audio_recorder_html(student_id)
+        audio_file = st.file_uploader("📤 Audio", type=["wav", "mp3", "m4a"])
+
+    # Sans fichier audio, la transcription de l'enregistrement en direct de cet étudiant est utilisée
+    live_transcript = st.session_state.get("transcripts", {}).get(student_id, "")
+    if live_transcript and not audio_file:
+        st.text_area("📝 Transcription", value=live_transcript, height=200, disabled=True)
+
+    force = st.checkbox("🔁 Forcer la ré-évaluation (ignorer le cache)")
+    sharded = st.checkbox(f"⚡ Noter la grille par lots de {SHARD_SIZE} critères en parallèle",
+                          help="Plus rapide pour les grandes grilles (15 critères et plus)")
+    local = st.checkbox("🧮 Pré-noter localement les critères littéraux",
+                        help="Les critères clairement mentionnés sont notés sans GPT-4, "
+                             "avec l'extrait de la transcription en preuve")
+    evidence = st.checkbox("🔎 N'envoyer que les extraits pertinents à GPT-4",
+                           help="Chaque critère reçoit ses extraits les plus proches de la transcription "
+                                "et la justification cite les extraits utilisés")
+    if st.button("🧠 Évaluer") and all([api_key, org, project, audio_file or live_transcript,
+                                       clinical_case, rubric_file]):
+        clinical_text = clinical_case.getvalue().decode("utf-8")
+        try:
+            rubric = compile_rubric(rubric_file.getvalue(), rubric_file.name).to_list()
+        except RubricError as e:
+            st.error(f"Grille illisible : {e}")
+            return
+
+        # Le bouton ne fait que soumettre le travail : les workers font les appels réseau
+        shard_size = SHARD_SIZE if sharded and len(rubric) > SHARD_SIZE else None
+        st.session_state.job_id = pool.submit(
+            student_id, clinical_text, rubric, audio=audio_file,
+            transcript=None if audio_file else live_transcript,
+            shard_size=shard_size, local=local, evidence=evidence, force=force, client=client)
+
+    # Travail de cette session, ou dernier travail de l'étudiant (après un rechargement de page)
+    job = pool.queue.get(st.session_state.job_id) if st.session_state.get("job_id") else None
+    if job is None or job["id_etudiant"] != student_id:
+        job = pool.queue.latest(student_id)
+    if job is not None:
+        show_job(job, student_id, client)
 
 if __name__ == "__main__":
     main()
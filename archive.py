@@ -0,0 +1,153 @@
+# Évaluation Médicale IA - Archive des enregistrements (Opus, adressée par contenu)
+#
+# Chaque enregistrement est conservé une seule fois, sous l'empreinte SHA-256
+# du fichier reçu, ré-encodé en Ogg/Opus mono 16 kHz (audio.encode_opus) :
+# ~2 Mo pour 8 minutes au lieu de ~90 Mo en WAV. Un même fichier téléversé
+# deux fois (nouvelle tentative, double clic) ne crée pas de second blob, et
+# une nouvelle tentative d'un étudiant n'écrase plus la précédente : la table
+# enregistrements relie étudiant (et run d'évaluation, s'il existe) au blob.
+# L'archive est bornée en âge et en taille (enforce_retention, appelée à
+# chaque ajout) ; les blobs les moins récemment utilisés partent en premier.
+
+import os
+import tempfile
+import time
+
+from evaluation import hash_file
+from db import DB_PATH, Database
+
+ARCHIVE_DB_PATH = os.path.join(os.path.dirname(DB_PATH), "archive.db")
+ARCHIVE_DIR = os.path.join("audios", "archive")
+ARCHIVE_MAX_AGE_DAYS = 365
+ARCHIVE_MAX_BYTES = 5 << 30
+ARCHIVE_EXT = ".ogg"
+
+ARCHIVE_MIGRATIONS = [
+    (1, [
+        '''
+        CREATE TABLE blobs (
+            hash TEXT PRIMARY KEY,
+            taille INTEGER NOT NULL,
+            taille_originale INTEGER NOT NULL,
+            duree_s REAL,
+            created_at REAL,
+            last_used REAL
+        )''',
+        "CREATE INDEX idx_blobs_last_used ON blobs(last_used)",
+        '''
+        CREATE TABLE enregistrements (
+            id INTEGER PRIMARY KEY,
+            id_etudiant TEXT NOT NULL,
+            run_id INTEGER,
+            blob_hash TEXT NOT NULL REFERENCES blobs(hash) ON DELETE CASCADE,
+            nom_original TEXT,
+            created_at REAL
+        )''',
+        # Un même blob n'est relié qu'une fois à un étudiant (et à un run, ou à aucun)
+        "CREATE UNIQUE INDEX idx_enregistrements_unique "
+        "ON enregistrements(id_etudiant, blob_hash, COALESCE(run_id, -1))",
+        "CREATE INDEX idx_enregistrements_etudiant ON enregistrements(id_etudiant, id)",
+        "CREATE INDEX idx_enregistrements_run ON enregistrements(run_id)",
+        "CREATE INDEX idx_enregistrements_blob ON enregistrements(blob_hash)",
+    ]),
+]
+
+class AudioArchive:
+    """Blobs Opus sur disque (ARCHIVE_DIR/ab/abcd...ogg) et leur index dans archive.db."""
+
+    def __init__(self, db_path: str = ARCHIVE_DB_PATH, root: str = ARCHIVE_DIR,
+                 max_age_days: float = ARCHIVE_MAX_AGE_DAYS, max_bytes: int = ARCHIVE_MAX_BYTES):
+        self.db = Database(db_path, ARCHIVE_MIGRATIONS)
+        self.root = root
+        self.max_age = max_age_days * 86400
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, blob_hash: str) -> str:
+        return os.path.join(self.root, blob_hash[:2], blob_hash + ARCHIVE_EXT)
+
+    def _encode(self, source_path: str, blob_hash: str) -> tuple[int, float]:
+        """Ré-encode `source_path` en Opus (écriture atomique) ; renvoie (taille, durée)."""
+        from audio import SAMPLE_RATE, decode_audio, encode_opus  # av, numpy : seulement à l'archivage
+        samples = decode_audio(source_path)
+        path = self.path(blob_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, part_path = tempfile.mkstemp(suffix=".part", dir=os.path.dirname(path))
+        os.close(fd)
+        try:
+            encode_opus(samples, part_path)
+            os.replace(part_path, path)
+        except BaseException:
+            os.remove(part_path)
+            raise
+        return os.path.getsize(path), len(samples) / SAMPLE_RATE
+
+    def put(self, source_path: str, student_id: str, run_id: int = None, original_name: str = None,
+            source_hash: str = None) -> dict:
+        """Archive un enregistrement et le relie à l'étudiant (et au run) ; renvoie
+        {"id", "hash", "path"}. Un contenu déjà archivé n'est pas ré-encodé.
+
+        Lève audio.AudioError si le fichier est illisible.
+        """
+        blob_hash = source_hash or hash_file(source_path)
+        now = time.time()
+        encoded = None
+        if not self.db.query("SELECT 1 FROM blobs WHERE hash = ?", (blob_hash,)) \
+                or not os.path.exists(self.path(blob_hash)):
+            # Encodage hors transaction : il peut prendre plusieurs secondes
+            encoded = self._encode(source_path, blob_hash)
+        with self.db.transaction() as conn:
+            if encoded:
+                conn.execute("INSERT INTO blobs VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(hash) DO UPDATE "
+                             "SET taille = excluded.taille, duree_s = excluded.duree_s",
+                             (blob_hash, encoded[0], os.path.getsize(source_path), encoded[1], now, now))
+            conn.execute("UPDATE blobs SET last_used = ? WHERE hash = ?", (now, blob_hash))
+            conn.execute("INSERT OR IGNORE INTO enregistrements (id_etudiant, run_id, blob_hash, "
+                         "nom_original, created_at) VALUES (?, ?, ?, ?, ?)",
+                         (student_id, run_id, blob_hash, original_name, now))
+            recording_id = conn.execute(
+                "SELECT id FROM enregistrements WHERE id_etudiant = ? AND blob_hash = ? AND run_id IS ?",
+                (student_id, blob_hash, run_id)).fetchone()[0]
+        self.enforce_retention()
+        return {"id": recording_id, "hash": blob_hash, "path": self.path(blob_hash)}
+
+    def recordings(self, student_id: str = None, run_id: int = None) -> list[dict]:
+        """Enregistrements d'un étudiant ou d'un run, du plus récent au plus ancien."""
+        clauses, params = [], []
+        if student_id is not None:
+            clauses.append("e.id_etudiant = ?")
+            params.append(student_id)
+        if run_id is not None:
+            clauses.append("e.run_id = ?")
+            params.append(run_id)
+        rows = self.db.query(
+            "SELECT e.id, e.id_etudiant, e.run_id, e.blob_hash, e.nom_original, e.created_at, b.duree_s "
+            "FROM enregistrements e JOIN blobs b ON b.hash = e.blob_hash "
+            f"WHERE {' AND '.join(clauses) or '1'} ORDER BY e.id DESC", params)
+        columns = ("id", "id_etudiant", "run_id", "hash", "nom_original", "created_at", "duree_s")
+        return [{**dict(zip(columns, row)), "path": self.path(row[3])} for row in rows]
+
+    def stats(self) -> dict:
+        blobs, size, original = self.db.query(
+            "SELECT COUNT(*), COALESCE(SUM(taille), 0), COALESCE(SUM(taille_originale), 0) FROM blobs")[0]
+        recordings = self.db.query("SELECT COUNT(*) FROM enregistrements")[0][0]
+        return {"blobs": blobs, "enregistrements": recordings, "octets": size, "octets_originaux": original}
+
+    def enforce_retention(self) -> int:
+        """Supprime les blobs inutilisés depuis `max_age_days`, puis les moins récemment utilisés
+        tant que l'archive dépasse `max_bytes`. Renvoie le nombre de blobs supprimés."""
+        expired = [row[0] for row in self.db.query("SELECT hash FROM blobs WHERE last_used < ?",
+                                                   (time.time() - self.max_age,))]
+        # Puis tout blob au-delà de max_bytes en cumulant les tailles depuis le plus récent
+        expired += [row[0] for row in self.db.query('''
+            SELECT hash FROM (
+                SELECT hash, SUM(taille) OVER (ORDER BY last_used DESC, hash) AS cumul FROM blobs
+            ) WHERE cumul > ?''', (self.max_bytes,)) if row[0] not in expired]
+        if not expired:
+            return 0
+        with self.db.transaction() as conn:
+            conn.executemany("DELETE FROM blobs WHERE hash = ?", [(blob_hash,) for blob_hash in expired])
+        for blob_hash in expired:
+            if os.path.exists(self.path(blob_hash)):
+                os.remove(self.path(blob_hash))
+        return len(expired)
@@ -0,0 +1,181 @@
+# Évaluation Médicale IA - Prétraitement audio avant Whisper
+#
+# Décodage de n'importe quel format (av/ffmpeg), passage en mono 16 kHz,
+# suppression des silences de début/fin et raccourcissement des longues
+# pauses (détecteur d'énergie numpy), puis ré-encodage en Opus. Un WAV stéréo
+# 48 kHz de 8 minutes (~90 Mo) tient ainsi en moins de 2 Mo, sous la limite
+# de 25 Mo de Whisper. Les enregistrements vides ou silencieux sont rejetés
+# avant tout appel à l'API.
+
+import os
+import tempfile
+
+import av
+import numpy as np
+
+SAMPLE_RATE = 16000
+FRAME_MS = 30
+SILENCE_DB = -35.0       # seuil relatif au niveau des trames les plus fortes
+MIN_SPEECH_DBFS = -50.0  # en dessous, l'enregistrement est considéré silencieux
+MAX_PAUSE_S = 1.0        # les pauses plus longues sont raccourcies à cette durée
+PADDING_S = 0.15         # marge conservée autour de la parole
+OPUS_BITRATE = 24000
+MIN_DURATION_S = 0.5
+CHUNK_S = 60.0           # durée nominale d'un segment transcrit en parallèle
+OVERLAP_S = 2.0          # recouvrement entre segments consécutifs
+SEARCH_S = 10.0          # fenêtre de recherche d'un silence pour placer la coupure
+
+class AudioError(ValueError):
+    """Enregistrement illisible, vide ou silencieux."""
+
+# ---------------------------
+# DÉCODAGE / ENCODAGE
+# ---------------------------
+def decode_audio(path: str, sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+    """Décode un fichier audio en float32 mono à `sample_rate` Hz."""
+    try:
+        container = av.open(path)
+    except av.FFmpegError as e:
+        raise AudioError(f"Fichier audio illisible : {e}") from e
+    with container:
+        if not container.streams.audio:
+            raise AudioError("Aucune piste audio dans le fichier")
+        resampler = av.AudioResampler(format="flt", layout="mono", rate=sample_rate)
+        chunks = []
+        for frame in container.decode(container.streams.audio[0]):
+            chunks.extend(out.to_ndarray().reshape(-1) for out in resampler.resample(frame))
+        chunks.extend(out.to_ndarray().reshape(-1) for out in resampler.resample(None))
+    if not chunks:
+        return np.zeros(0, dtype=np.float32)
+    return np.concatenate(chunks).astype(np.float32, copy=False)
+
+def encode_opus(samples: np.ndarray, path: str, sample_rate: int = SAMPLE_RATE,
+                bitrate: int = OPUS_BITRATE):
+    """Encode un signal mono float32 en Ogg/Opus (format accepté par Whisper)."""
+    with av.open(path, "w", format="ogg") as container:
+        stream = container.add_stream("libopus", rate=sample_rate, layout="mono")
+        stream.bit_rate = bitrate
+        frame = av.AudioFrame.from_ndarray(samples.reshape(1, -1).astype(np.float32),
+                                           format="flt", layout="mono")
+        frame.sample_rate = sample_rate
+        for packet in stream.encode(frame):
+            container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+
+# ---------------------------
+# DÉTECTION DE SILENCE
+# ---------------------------
+def frame_energy_db(samples: np.ndarray, sample_rate: int = SAMPLE_RATE,
+                    frame_ms: int = FRAME_MS) -> np.ndarray:
+    """Énergie RMS (dBFS) de chaque trame complète de `frame_ms` ms."""
+    size = sample_rate * frame_ms // 1000
+    count = len(samples) // size
+    frames = samples[:count * size].reshape(count, size)
+    rms = np.sqrt(np.mean(np.square(frames, dtype=np.float64), axis=1))
+    return 20 * np.log10(rms + 1e-10)
+
+def voiced_frames(samples: np.ndarray, sample_rate: int = SAMPLE_RATE,
+                  frame_ms: int = FRAME_MS) -> np.ndarray:
+    """Masque booléen des trames contenant de la parole."""
+    energy = frame_energy_db(samples, sample_rate, frame_ms)
+    if energy.size == 0:
+        return np.zeros(0, dtype=bool)
+    threshold = max(np.percentile(energy, 95) + SILENCE_DB, MIN_SPEECH_DBFS)
+    return energy > threshold
+
+def trim_silence(samples: np.ndarray, sample_rate: int = SAMPLE_RATE, frame_ms: int = FRAME_MS,
+                 max_pause: float = MAX_PAUSE_S, padding: float = PADDING_S) -> np.ndarray:
+    """Supprime les silences de début/fin et ramène chaque pause à `max_pause` secondes."""
+    voiced = voiced_frames(samples, sample_rate, frame_ms)
+    if not voiced.any():
+        raise AudioError("Enregistrement silencieux : aucune parole détectée")
+
+    # Marge autour de la parole pour ne pas couper les attaques et fins de mots
+    pad = int(padding * 1000 / frame_ms)
+    keep = np.convolve(voiced, np.ones(2 * pad + 1, dtype=bool), mode="same") > 0
+
+    # Dans chaque pause, seules les `max_pause` premières secondes sont conservées
+    index = np.arange(keep.size)
+    last_kept = np.maximum.accumulate(np.where(keep, index, -1))
+    max_frames = int(max_pause * 1000 / frame_ms)
+    keep |= (last_kept >= 0) & (index - last_kept <= max_frames)
+    keep[index > np.flatnonzero(voiced)[-1] + pad] = False
+
+    size = sample_rate * frame_ms // 1000
+    frames = samples[:keep.size * size].reshape(keep.size, size)
+    return frames[keep].reshape(-1)
+
+# ---------------------------
+# DÉCOUPAGE
+# ---------------------------
+def chunk_bounds(samples: np.ndarray, sample_rate: int = SAMPLE_RATE, chunk_s: float = CHUNK_S,
+                 overlap_s: float = OVERLAP_S, search_s: float = SEARCH_S,
+                 frame_ms: int = FRAME_MS) -> list[tuple[int, int]]:
+    """Bornes (début, fin) en échantillons de segments d'environ `chunk_s` secondes.
+
+    Chaque coupure est placée sur la trame la plus silencieuse des `search_s`
+    dernières secondes du segment (au plus un quart du segment), et le segment
+    suivant reprend `overlap_s` secondes avant la coupure.
+    """
+    total = len(samples)
+    chunk, overlap = int(chunk_s * sample_rate), int(overlap_s * sample_rate)
+    if total <= chunk:
+        return [(0, total)]
+    size = sample_rate * frame_ms // 1000
+    energy = frame_energy_db(samples, sample_rate, frame_ms)
+    search_frames = max(1, int(min(search_s, chunk_s / 4) * 1000 / frame_ms))
+    bounds, start = [], 0
+    while start + chunk < total:
+        window_end = (start + chunk) // size
+        window_start = max(start // size + 1, window_end - search_frames)
+        cut = (window_start + int(np.argmin(energy[window_start:window_end]))) * size
+        bounds.append((start, cut))
+        start = max(cut - overlap, start + size)
+    bounds.append((start, total))
+    return bounds
+
+# ---------------------------
+# PIPELINE
+# ---------------------------
+def temp_audio_path(suffix: str = ".ogg") -> str:
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    return path
+
+def load_speech(path: str) -> np.ndarray:
+    """Décode `path` et ne garde que la parole ; lève AudioError si l'enregistrement est inexploitable."""
+    samples = decode_audio(path)
+    if len(samples) < MIN_DURATION_S * SAMPLE_RATE:
+        raise AudioError("Enregistrement vide ou trop court")
+    return trim_silence(samples)
+
+def prepare_audio(path: str, out_path: str = None) -> tuple[str, float]:
+    """Décode, nettoie et ré-encode `path` pour Whisper.
+
+    Renvoie le chemin du fichier Opus produit (temporaire si `out_path` est omis,
+    à supprimer par l'appelant) et la durée de parole conservée, en secondes.
+    """
+    speech = load_speech(path)
+    out_path = out_path or temp_audio_path()
+    try:
+        encode_opus(speech, out_path)
+    except Exception:
+        os.remove(out_path)
+        raise
+    return out_path, len(speech) / SAMPLE_RATE
+
+def prepare_chunks(path: str, chunk_s: float = CHUNK_S) -> tuple[list[str], float]:
+    """Comme `prepare_audio`, mais découpe les longs enregistrements en segments Opus
+    temporaires qui se recouvrent (à supprimer par l'appelant)."""
+    speech = load_speech(path)
+    paths = []
+    try:
+        for start, end in chunk_bounds(speech, chunk_s=chunk_s):
+            paths.append(temp_audio_path())
+            encode_opus(speech[start:end], paths[-1])
+    except Exception:
+        for chunk_path in paths:
+            os.remove(chunk_path)
+        raise
+    return paths, len(speech) / SAMPLE_RATE
@@ -0,0 +1,183 @@
+# Évaluation Médicale IA - Mode batch (toute une session ECOS en ligne de commande)
+#
+# Usage :
+#   python batch.py audios_session/ cas.txt grille.json --workers 8
+#   python batch.py audios_session/ cas.txt grille.json --async --concurrency 16
+#   python batch.py audios_session/ cas.txt grille.json --shard-size 5   (grandes grilles)
+#   python batch.py audios_session/ cas.txt grille.json --metrics session.prom
+#
+# Chaque fichier audio correspond à un étudiant ; l'identifiant est tiré du nom
+# de fichier (le préfixe "audio_" ajouté par l'enregistreur HTML est retiré).
+# Les identifiants OpenAI sont lus dans l'environnement (ou un fichier .env) :
+# OPENAI_API_KEY, OPENAI_ORG_ID, OPENAI_PROJECT_ID.
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from dotenv import load_dotenv
+from openai import OpenAI
+
+import metrics
+from evaluation import evaluate_transcript, sharded_version, transcribe
+from cache import EvaluationCache, TranscriptionCache
+from db import DB_PATH, Database, save_evaluation
+from metrics import MetricsStore
+from pipeline import DEFAULT_CONCURRENCY, run_pipeline
+from rubric import RubricError, compile_rubric
+
+AUDIO_EXTENSIONS = (".wav", ".mp3", ".m4a")
+
+# ---------------------------
+# OUTILS
+# ---------------------------
+def student_id_from_path(path: str) -> str:
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return stem[len("audio_"):] if stem.startswith("audio_") else stem
+
+def list_audio_files(audio_dir: str) -> list[str]:
+    return sorted(
+        os.path.join(audio_dir, name)
+        for name in os.listdir(audio_dir)
+        if name.lower().endswith(AUDIO_EXTENSIONS)
+    )
+
+# ---------------------------
+# PIPELINE PAR ÉTUDIANT
+# ---------------------------
+def process_student(client: OpenAI, audio_path: str, clinical_text: str, rubric: list,
+                    cache: TranscriptionCache = None, evaluation_cache: EvaluationCache = None,
+                    force: bool = False, shard_size: int = None, local: bool = False,
+                    evidence: bool = False) -> dict:
+    transcript_text = transcribe(client, audio_path, cache=cache)
+    return evaluate_transcript(client, clinical_text, transcript_text, rubric,
+                               cache=evaluation_cache, force=force, shard_size=shard_size, local=local,
+                               evidence=evidence)
+
+class BatchWriter:
+    """Enregistre les résultats au fil de l'eau, une transaction par étudiant."""
+
+    def __init__(self, db: Database, total: int, clinical_text: str = None, rubric: list = None,
+                 shard_size: int = None, local: bool = False, evidence: bool = False):
+        self.db = db
+        self.clinical_text = clinical_text
+        self.rubric = rubric
+        sharded = bool(shard_size) and rubric is not None and len(rubric) > shard_size
+        self.prompt_version = sharded_version(shard_size if sharded else None, local, evidence)
+        self.total = total
+        self.done = 0
+        self.failures = []
+
+    def __call__(self, student_id: str, result: dict = None, error: Exception = None):
+        if error is not None:
+            self.failures.append((student_id, str(error)))
+            print(f"❌ {student_id} : {error}", file=sys.stderr)
+            return
+        with metrics.stage("sqlite"), self.db.transaction() as conn:
+            save_evaluation(conn, student_id, result, self.clinical_text, self.rubric,
+                            prompt_version=self.prompt_version)
+        self.done += 1
+        print(f"✅ {student_id} : {result['note_finale']} / 20 ({self.done}/{self.total})")
+
+def run_batch(client: OpenAI, audio_files: list[str], clinical_text: str, rubric: list,
+              workers: int = 4, db_path: str = DB_PATH, cache: TranscriptionCache = None,
+              evaluation_cache: EvaluationCache = None, force: bool = False,
+              shard_size: int = None, local: bool = False,
+              evidence: bool = False) -> tuple[int, list[tuple[str, str]]]:
+    """Évalue tous les fichiers en parallèle ; les écritures SQLite restent dans le thread principal."""
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        writer = BatchWriter(Database(db_path), len(audio_files), clinical_text, rubric,
+                             shard_size, local, evidence)
+        futures = {
+            pool.submit(process_student, client, path, clinical_text, rubric, cache,
+                        evaluation_cache, force, shard_size, local, evidence): student_id_from_path(path)
+            for path in audio_files
+        }
+        for future in as_completed(futures):
+            try:
+                writer(futures[future], future.result())
+            except Exception as e:
+                writer(futures[future], error=e)
+    return writer.done, writer.failures
+
+def run_batch_async(audio_files: list[str], clinical_text: str, rubric: list,
+                    concurrency: int = DEFAULT_CONCURRENCY, db_path: str = DB_PATH,
+                    client=None, cache: TranscriptionCache = None,
+                    evaluation_cache: EvaluationCache = None, force: bool = False,
+                    shard_size: int = None, local: bool = False,
+                    evidence: bool = False) -> tuple[int, list[tuple[str, str]]]:
+    """Variante asyncio : transcriptions et évaluations de plusieurs étudiants se chevauchent."""
+    writer = BatchWriter(Database(db_path), len(audio_files), clinical_text, rubric,
+                         shard_size, local, evidence)
+    run_pipeline(audio_files, clinical_text, rubric, concurrency=concurrency, client=client,
+                 cache=cache, evaluation_cache=evaluation_cache, force=force, shard_size=shard_size,
+                 local=local, evidence=evidence,
+                 on_done=lambda path, result, error: writer(student_id_from_path(path), result, error))
+    return writer.done, writer.failures
+
+# ---------------------------
+# MAIN
+# ---------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Évaluation ECOS en lot (Whisper + GPT-4)")
+    parser.add_argument("audio_dir", help="Dossier contenant les enregistrements (.wav, .mp3, .m4a)")
+    parser.add_argument("clinical_case", help="Cas clinique (.txt)")
+    parser.add_argument("rubric", help="Grille d'évaluation (.json, clé grille_observation, ou .docx)")
+    parser.add_argument("--workers", type=int, default=4, help="Nombre d'étudiants traités en parallèle")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="Utiliser le pipeline asyncio (client OpenAI asynchrone)")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="Requêtes simultanées par étape en mode --async")
+    parser.add_argument("--db", default=DB_PATH, help="Base SQLite de destination")
+    parser.add_argument("--no-cache", action="store_true", help="Ignorer les caches (transcriptions, évaluations)")
+    parser.add_argument("--force", action="store_true", help="Forcer la ré-évaluation GPT-4 (met le cache à jour)")
+    parser.add_argument("--shard-size", type=int, default=None,
+                        help="Noter la grille par lots de N critères en parallèle (grandes grilles)")
+    parser.add_argument("--local", action="store_true",
+                        help="Pré-noter localement les critères littéraux (moins d'appels GPT-4)")
+    parser.add_argument("--evidence", action="store_true",
+                        help="N'envoyer à GPT-4 que les extraits pertinents pour chaque critère")
+    parser.add_argument("--metrics", default=None,
+                        help="Exporter les mesures de la session (durées p50/p95, tokens, coût) : "
+                             ".prom (Prometheus) ou .json")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    with open(args.clinical_case, encoding="utf-8") as f:
+        clinical_text = f.read()
+    with open(args.rubric, "rb") as f:
+        try:
+            rubric = compile_rubric(f.read(), args.rubric).to_list()
+        except RubricError as e:
+            parser.error(f"Grille illisible : {e}")
+
+    audio_files = list_audio_files(args.audio_dir)
+    if not audio_files:
+        parser.error(f"Aucun fichier audio dans {args.audio_dir}")
+
+    store, started = MetricsStore(), time.time()
+    metrics.set_recorder(store)
+    cache = None if args.no_cache else TranscriptionCache()
+    evaluation_cache = None if args.no_cache else EvaluationCache()
+    if args.use_async:
+        done, failures = run_batch_async(audio_files, clinical_text, rubric,
+                                         concurrency=args.concurrency, db_path=args.db, cache=cache,
+                                         evaluation_cache=evaluation_cache, force=args.force,
+                                         shard_size=args.shard_size, local=args.local,
+                                         evidence=args.evidence)
+    else:
+        done, failures = run_batch(OpenAI(), audio_files, clinical_text, rubric,
+                                   workers=args.workers, db_path=args.db, cache=cache,
+                                   evaluation_cache=evaluation_cache, force=args.force,
+                                   shard_size=args.shard_size, local=args.local,
+                                   evidence=args.evidence)
+    print(f"📊 {done} évaluation(s) enregistrée(s), {len(failures)} échec(s)")
+    if args.metrics:
+        with open(args.metrics, "w", encoding="utf-8") as f:
+            f.write(store.to_prometheus(started) if args.metrics.endswith(".prom") else store.to_json(started))
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
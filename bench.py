@@ -0,0 +1,340 @@
+# Évaluation Médicale IA - Banc d'essai de bout en bout (sans crédit API)
+#
+# Usage :
+#   python bench.py --students 40 --concurrency 1,4,16
+#   python bench.py --latency 1.5 --jitter 0.5 --error-rate 0.05 --mode async
+#   python bench.py --compare benchmarks/20261001-120000-1b413ea.json
+#
+# Un faux serveur OpenAI local (FakeOpenAI) répond aux appels Whisper et
+# chat.completions avec une latence réglable (plus une gigue), un taux
+# d'erreurs 429 / 500 et des réponses conformes à EvaluationResult. Des
+# enregistrements synthétiques traversent le vrai pipeline (prétraitement
+# audio, transcription, évaluation GPT-4, écriture SQLite : batch.run_batch ou
+# batch.run_batch_async), sans cache, pour chaque niveau de concurrence. On en
+# tire le débit, les latences p50/p95/p99 par étape (metrics.py), le rythme
+# d'écriture SQLite et les réessais. Le rapport JSON (BENCH_DIR) garde le même
+# format d'un commit à l'autre : --compare affiche les écarts avec un rapport
+# précédent.
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import wave
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from openai import AsyncOpenAI, OpenAI
+
+import metrics
+from audio import SAMPLE_RATE
+from batch import run_batch, run_batch_async
+from evaluation import GPT_MODEL, EvaluationResult
+from metrics import MetricsStore
+
+BENCH_DIR = "benchmarks"
+# 2 : les latences par étape ne comptent plus l'attente des créneaux du pipeline asynchrone
+REPORT_VERSION = 2
+BENCH_QUANTILES = (0.5, 0.95, 0.99)
+MODES = ("threads", "async")
+FAKE_TRANSCRIPT = ("Bonjour, je suis l'étudiant. Le patient présente une douleur thoracique depuis "
+                   "deux heures, je demande un ECG et un dosage de la troponine.")
+FAKE_CLINICAL_CASE = "Homme de 58 ans, douleur thoracique constrictive depuis deux heures."
+
+# ---------------------------
+# FAUX SERVEUR OPENAI
+# ---------------------------
+def bench_rubric(n_criteria: int) -> list[dict]:
+    return [{"id": f"C{i}", "critère": f"Critère {i}", "points": 1} for i in range(1, n_criteria + 1)]
+
+def canned_result(rubric: list) -> dict:
+    """Réponse GPT-4 valide pour toute la grille ; elle sert aussi aux lots (ShardResult)
+    et à la synthèse (SummaryResult), les champs en trop étant ignorés."""
+    return EvaluationResult(
+        notes=[{"id": item["id"], "critère": item["critère"], "score": i % 2,
+                "justification": "Mentionné explicitement." if i % 2 else "Non mentionné.", "extraits": []}
+               for i, item in enumerate(rubric, start=1)],
+        synthese=0.5, prise_en_charge=1.0, note_finale=14.5, commentaire="Réponse de référence du banc d'essai.",
+    ).model_dump()
+
+class FakeOpenAI:
+    """Serveur HTTP local imitant /v1/audio/transcriptions et /v1/chat/completions.
+
+    Chaque requête attend `latency` ± `jitter` secondes (un thread par requête, comme
+    l'API), puis échoue avec une probabilité `error_rate` (429 ou 500, que with_backoff
+    réessaie) ou renvoie la réponse canonique.
+    """
+
+    def __init__(self, rubric: list, latency: float = 0.5, jitter: float = 0.1, error_rate: float = 0.0,
+                 whisper_latency: float = None, seed: int = 0):
+        self.latency = latency
+        self.whisper_latency = latency if whisper_latency is None else whisper_latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.content = json.dumps(canned_result(rubric), ensure_ascii=False)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = {"whisper": 0, "gpt": 0}
+        self.errors = 0
+        self.server = None
+
+    def _draw(self, base: float) -> tuple[float, bool]:
+        with self.lock:
+            delay = max(0.0, base + self.random.uniform(-self.jitter, self.jitter))
+            return delay, self.random.random() < self.error_rate
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, payload: dict):
+                body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                kind = "whisper" if self.path.endswith("/audio/transcriptions") else \
+                    "gpt" if self.path.endswith("/chat/completions") else None
+                if kind is None:
+                    return self._send(404, {"error": {"message": f"Route inconnue : {self.path}"}})
+                with fake.lock:
+                    fake.requests[kind] += 1
+                delay, failed = fake._draw(fake.whisper_latency if kind == "whisper" else fake.latency)
+                time.sleep(delay)
+                if failed:
+                    with fake.lock:
+                        fake.errors += 1
+                    status = fake.random.choice((429, 500))
+                    return self._send(status, {"error": {"message": "Erreur simulée", "type": "bench",
+                                                         "code": str(status)}})
+                if kind == "whisper":
+                    return self._send(200, {"text": FAKE_TRANSCRIPT})
+                request = json.loads(body or b"{}")
+                prompt_tokens = sum(len(str(m.get("content", ""))) for m in request.get("messages", [])) // 4
+                self._send(200, {
+                    "id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion", "created": int(time.time()),
+                    "model": request.get("model", GPT_MODEL),
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": fake.content}}],
+                    "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(fake.content) // 4,
+                              "total_tokens": prompt_tokens + len(fake.content) // 4},
+                })
+
+        return Handler
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+
+    def __enter__(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {**self.requests, "erreurs": self.errors}
+
+# ---------------------------
+# ENREGISTREMENTS SYNTHÉTIQUES
+# ---------------------------
+def write_recording(path: str, seconds: float, seed: int = 0):
+    """WAV 16 kHz mono : « phrases » tonales séparées de courtes pauses (passe la détection de parole)."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    voiced = (np.sin(2 * np.pi * 0.4 * t) > -0.6).astype(np.float32)
+    samples = 0.3 * np.sin(2 * np.pi * 220 * t) * (1 + 0.5 * np.sin(2 * np.pi * 3 * t)) * voiced
+    samples += 0.001 * rng.standard_normal(len(t))
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes((np.clip(samples, -1, 1) * 32767).astype("<i2").tobytes())
+
+def make_recordings(directory: str, students: int, seconds: float) -> list[str]:
+    """Un fichier par étudiant (même contenu : aucun cache n'est utilisé pendant le banc)."""
+    template = os.path.join(directory, "template.wav")
+    write_recording(template, seconds)
+    paths = []
+    for i in range(1, students + 1):
+        paths.append(os.path.join(directory, f"audio_BENCH{i:04d}.wav"))
+        os.link(template, paths[-1])
+    return paths
+
+# ---------------------------
+# MESURES
+# ---------------------------
+def stage_latencies(store: MetricsStore) -> dict:
+    rows = store.db.query("SELECT etape, duree_s FROM mesures ORDER BY etape")
+    latencies = {}
+    for etape in dict.fromkeys(row[0] for row in rows):
+        durations = np.array([row[1] for row in rows if row[0] == etape])
+        quantiles = np.quantile(durations, BENCH_QUANTILES)
+        latencies[etape] = {"n": len(durations),
+                            **{f"p{round(q * 100)}_s": float(v) for q, v in zip(BENCH_QUANTILES, quantiles)},
+                            "max_s": float(durations.max())}
+    return latencies
+
+def run_level(mode: str, concurrency: int, audio_files: list[str], rubric: list, server: FakeOpenAI,
+              workdir: str, shard_size: int = None) -> dict:
+    """Traite toute la cohorte à un niveau de concurrence, dans une base SQLite neuve."""
+    tag = f"{mode}-{concurrency}"
+    store = MetricsStore(os.path.join(workdir, f"metrics-{tag}.db"))
+    db_path = os.path.join(workdir, f"evaluations-{tag}.db")
+    before = server.snapshot()
+    metrics.set_recorder(store)
+    start = time.perf_counter()
+    try:
+        # max_retries=0 : seuls les réessais de with_backoff jouent (et sont comptés)
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            if mode == "async":
+                done, failures = run_batch_async(
+                    audio_files, FAKE_CLINICAL_CASE, rubric, concurrency=concurrency, db_path=db_path,
+                    client=AsyncOpenAI(base_url=server.base_url, api_key="bench", max_retries=0),
+                    shard_size=shard_size)
+            else:
+                done, failures = run_batch(
+                    OpenAI(base_url=server.base_url, api_key="bench", max_retries=0), audio_files,
+                    FAKE_CLINICAL_CASE, rubric, workers=concurrency, db_path=db_path, shard_size=shard_size)
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.set_recorder(None)
+    after = server.snapshot()
+    summary = store.summary()
+    return {
+        "mode": mode, "concurrence": concurrency, "etudiants": len(audio_files),
+        "reussis": done, "echecs": len(failures), "duree_s": elapsed,
+        "debit_etudiants_s": done / elapsed,
+        # Écritures par seconde passée dans SQLite (capacité de l'écrivain unique)
+        "ecritures_sqlite_s": done / summary["sqlite"]["total_s"] if summary.get("sqlite") else None,
+        "etapes": stage_latencies(store),
+        "reessais": int(sum(s["reessais"] for s in summary.values())),
+        "requetes": {name: after[name] - before[name] for name in after},
+        "erreurs_exemple": failures[:3],
+    }
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(levels: list[int], modes: tuple = MODES, students: int = 20, audio_seconds: float = 30.0,
+                  criteria: int = 10, latency: float = 0.5, jitter: float = 0.1, error_rate: float = 0.0,
+                  whisper_latency: float = None, shard_size: int = None, seed: int = 0, on_level=None) -> dict:
+    """Exécute le banc pour chaque mode et niveau de concurrence ; renvoie le rapport complet."""
+    parameters = {"etudiants": students, "audio_s": audio_seconds, "criteres": criteria,
+                  "latence_s": latency, "latence_whisper_s": whisper_latency, "gigue_s": jitter,
+                  "taux_erreur": error_rate, "lots": shard_size, "graine": seed}
+    rubric = bench_rubric(criteria)
+    results = []
+    with tempfile.TemporaryDirectory(prefix="eval-med-bench-") as workdir:
+        audio_files = make_recordings(workdir, students, audio_seconds)
+        with FakeOpenAI(rubric, latency, jitter, error_rate, whisper_latency, seed) as server:
+            for mode in modes:
+                for concurrency in levels:
+                    results.append(run_level(mode, concurrency, audio_files, rubric, server, workdir,
+                                             shard_size))
+                    if on_level:
+                        on_level(results[-1])
+    return {"version": REPORT_VERSION, "date": datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(), "python": sys.version.split()[0], "parametres": parameters,
+            "resultats": results}
+
+# ---------------------------
+# AFFICHAGE ET COMPARAISON
+# ---------------------------
+def format_level(result: dict) -> str:
+    stages = result["etapes"]
+    p95 = "  ".join(f"{etape} p95 {stages[etape]['p95_s']:.2f}s"
+                    for etape in ("whisper", "gpt4", "sqlite") if etape in stages)
+    return (f"{result['mode']:>7} x{result['concurrence']:<3} {result['debit_etudiants_s']:6.2f} étudiants/s  "
+            f"{result['reussis']}/{result['etudiants']} ok  {result['reessais']} réessai(s)  {p95}")
+
+def _change(new: float, old: float) -> str:
+    if not old or new is None or math.isnan(old):
+        return "n/a"
+    return f"{(new - old) / old * 100:+.0f} %"
+
+def compare(report: dict, baseline: dict) -> list[str]:
+    """Écarts de débit et de p95 par étape pour les (mode, concurrence) présents dans les deux rapports."""
+    if report["parametres"] != baseline["parametres"]:
+        lines = ["⚠️ Paramètres différents : comparaison indicative."]
+    else:
+        lines = []
+    if report["version"] != baseline.get("version"):
+        lines.append(f"⚠️ Rapport de version {baseline.get('version')} : latences par étape mesurées autrement.")
+    old = {(r["mode"], r["concurrence"]): r for r in baseline["resultats"]}
+    for result in report["resultats"]:
+        previous = old.get((result["mode"], result["concurrence"]))
+        if previous is None:
+            continue
+        parts = [f"débit {_change(result['debit_etudiants_s'], previous['debit_etudiants_s'])}"]
+        for etape, stats in result["etapes"].items():
+            if etape in previous["etapes"]:
+                parts.append(f"{etape} p95 {_change(stats['p95_s'], previous['etapes'][etape]['p95_s'])}")
+        lines.append(f"{result['mode']:>7} x{result['concurrence']:<3} " + "  ".join(parts))
+    return lines
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Banc d'essai du pipeline (faux serveur OpenAI local)")
+    parser.add_argument("--students", type=int, default=20, help="Nombre d'enregistrements par niveau")
+    parser.add_argument("--concurrency", default="1,4,16", help="Niveaux de concurrence (séparés par des virgules)")
+    parser.add_argument("--mode", choices=(*MODES, "both"), default="both",
+                        help="threads (run_batch), async (run_batch_async) ou les deux")
+    parser.add_argument("--audio-seconds", type=float, default=30.0, help="Durée de chaque enregistrement")
+    parser.add_argument("--criteria", type=int, default=10, help="Nombre de critères de la grille")
+    parser.add_argument("--shard-size", type=int, default=None, help="Noter la grille par lots de N critères")
+    parser.add_argument("--latency", type=float, default=0.5, help="Latence simulée d'un appel API (s)")
+    parser.add_argument("--whisper-latency", type=float, default=None, help="Latence Whisper (défaut : --latency)")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Gigue uniforme ± (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Proportion de réponses 429 / 500")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help=f"Rapport JSON (défaut : {BENCH_DIR}/<date>-<commit>.json)")
+    parser.add_argument("--compare", default=None, help="Rapport JSON précédent à comparer")
+    args = parser.parse_args(argv)
+
+    levels = [int(level) for level in args.concurrency.split(",")]
+    report = run_benchmark(levels, MODES if args.mode == "both" else (args.mode,), args.students,
+                           args.audio_seconds, args.criteria, args.latency, args.jitter, args.error_rate,
+                           args.whisper_latency, args.shard_size, args.seed,
+                           on_level=lambda result: print(format_level(result), flush=True))
+
+    out = args.out or os.path.join(
+        BENCH_DIR, f"{datetime.now():%Y%m%d-%H%M%S}-{report['commit'] or 'local'}.json")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"📄 Rapport : {out}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print("\n".join(compare(report, json.load(f))))
+    return 1 if any(result["echecs"] for result in report["resultats"]) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,107 @@
+# Évaluation Médicale IA - Caches persistants (transcriptions Whisper, évaluations GPT-4)
+#
+# Transcriptions : clé = SHA-256 du contenu audio + modèle + langue. Un même
+# fichier re-téléversé (ou un rerun Streamlit) ne repart donc pas chez Whisper.
+# Évaluations : clé = empreinte du cas, de la grille, de la transcription, du
+# modèle, de la température et de la version du prompt (voir evaluation_key).
+# Les caches vivent dans leur propre base SQLite, à côté de evaluations.db.
+
+import json
+import os
+import sqlite3
+import time
+
+from db import DB_PATH
+from evaluation import EvaluationResult
+
+CACHE_PATH = os.path.join(os.path.dirname(DB_PATH), "cache.db")
+MAX_ENTRIES = 5000
+MAX_AGE_DAYS = 90
+
+class _SQLiteCache:
+    """Cache LRU sur disque, borné en nombre d'entrées et en âge."""
+
+    table = None
+    schema = None
+
+    def __init__(self, path: str = CACHE_PATH, max_entries: int = MAX_ENTRIES,
+                 max_age_days: float = MAX_AGE_DAYS):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 86400
+        with self._connect() as conn:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table} ({self.schema})")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{self.table}_last_used "
+                         f"ON {self.table}(last_used)")
+
+    def _connect(self) -> sqlite3.Connection:
+        # Une connexion par opération : utilisable depuis les threads du mode batch.
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _get(self, where: str, params: tuple, column: str):
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(f"SELECT {column}, created_at FROM {self.table} WHERE {where}",
+                               params).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.max_age:
+                conn.execute(f"DELETE FROM {self.table} WHERE {where}", params)
+                return None
+            conn.execute(f"UPDATE {self.table} SET last_used = ? WHERE {where}", (now, *params))
+            return row[0]
+
+    def _put(self, values: tuple):
+        now = time.time()
+        placeholders = ", ".join("?" * (len(values) + 2))
+        with self._connect() as conn:
+            conn.execute(f"INSERT OR REPLACE INTO {self.table} VALUES ({placeholders})",
+                         (*values, now, now))
+            self._evict(conn, now)
+
+    def _evict(self, conn: sqlite3.Connection, now: float):
+        conn.execute(f"DELETE FROM {self.table} WHERE created_at < ?", (now - self.max_age,))
+        conn.execute(f'''
+        DELETE FROM {self.table} WHERE rowid IN (
+            SELECT rowid FROM {self.table} ORDER BY last_used DESC LIMIT -1 OFFSET ?
+        )''', (self.max_entries,))
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute(f"DELETE FROM {self.table}")
+
+class TranscriptionCache(_SQLiteCache):
+    table = "transcriptions"
+    schema = '''
+        audio_hash TEXT,
+        model TEXT,
+        language TEXT,
+        texte TEXT,
+        created_at REAL,
+        last_used REAL,
+        PRIMARY KEY (audio_hash, model, language)'''
+
+    def get(self, audio_hash: str, model: str, language: str):
+        return self._get("audio_hash = ? AND model = ? AND language = ?",
+                         (audio_hash, model, language), "texte")
+
+    def put(self, audio_hash: str, model: str, language: str, text: str):
+        self._put((audio_hash, model, language, text))
+
+class EvaluationCache(_SQLiteCache):
+    table = "evaluations"
+    schema = '''
+        cle TEXT PRIMARY KEY,
+        resultat TEXT,
+        created_at REAL,
+        last_used REAL'''
+
+    def get(self, key: str):
+        payload = self._get("cle = ?", (key,), "resultat")
+        if payload is None:
+            return None
+        return EvaluationResult(**json.loads(payload)).dict()
+
+    def put(self, key: str, result: dict):
+        result = EvaluationResult(**result).dict()
+        self._put((key, json.dumps(result, ensure_ascii=False)))
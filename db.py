@@ -0,0 +1,391 @@
+# Évaluation Médicale IA - Persistance SQLite partagée (app3.py, app4.py, batch.py)
+#
+# Une seule connexion par processus et par base (voir get_db dans les apps,
+# mise en cache avec st.cache_resource), en mode WAL avec un délai d'attente
+# sur verrou : plusieurs postes examinateurs peuvent écrire en même temps sans
+# "database is locked". Le schéma est créé une fois, par migrations
+# versionnées (PRAGMA user_version). Les écritures passent par
+# Database.transaction() : une évaluation complète = une transaction.
+#
+# Schéma (evaluations.db, migration 3) : evaluation_run (une ligne par
+# évaluation, notes globales) -> evaluation_critere (score/justification par
+# critère) -> criteres ; cas_cliniques et grilles dédupliqués par hash. Les
+# requêtes de cohorte ne lisent que evaluation_run. travaux_runs relie le
+# jeton d'un travail de jobs.py au run qu'il a enregistré ; purges compte les
+# purges (les ids repartent de zéro, voir agreement.py).
+
+import csv
+import io
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+from evaluation import GPT_MODEL, PROMPT_VERSION, hash_identification
+
+DB_PATH = "evaluations.db"
+NOTES_DB_PATH = "evaluation.db"   # base de app3.py (table evaluations)
+BUSY_TIMEOUT_MS = 30000
+
+# ---------------------------
+# MIGRATIONS
+# ---------------------------
+# Chaque entrée (version, instructions) est appliquée une seule fois, dans l'ordre.
+# Ne jamais modifier une migration publiée : en ajouter une nouvelle.
+MIGRATIONS = [
+    (1, [
+        '''
+        CREATE TABLE IF NOT EXISTS etudiants (
+            id_etudiant TEXT PRIMARY KEY,
+            date_evaluation DATETIME,
+            hash_identification TEXT
+        )''',
+        '''
+        CREATE TABLE IF NOT EXISTS evaluations_ia (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id_etudiant TEXT,
+            critere TEXT,
+            score REAL,
+            justification TEXT,
+            synthese REAL,
+            prise_en_charge REAL,
+            note_finale REAL,
+            commentaire TEXT,
+            FOREIGN KEY(id_etudiant) REFERENCES etudiants(id_etudiant)
+        )''',
+        '''
+        CREATE TABLE IF NOT EXISTS evaluations_humaines (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id_etudiant TEXT,
+            eval1 REAL,
+            eval2 REAL,
+            timestamp DATETIME,
+            FOREIGN KEY(id_etudiant) REFERENCES etudiants(id_etudiant)
+        )''',
+    ]),
+    (2, [
+        "CREATE INDEX IF NOT EXISTS idx_evaluations_ia_etudiant ON evaluations_ia(id_etudiant)",
+        "CREATE INDEX IF NOT EXISTS idx_evaluations_humaines_etudiant "
+        "ON evaluations_humaines(id_etudiant, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_etudiants_date ON etudiants(date_evaluation)",
+    ]),
+    # Schéma normalisé : une ligne evaluation_run par évaluation, des lignes
+    # critères compactes, cas cliniques et grilles stockés une fois (par hash).
+    # evaluations_ia devient une vue de compatibilité (export CSV).
+    (3, [
+        '''
+        CREATE TABLE cas_cliniques (
+            id INTEGER PRIMARY KEY,
+            hash TEXT UNIQUE NOT NULL,
+            texte TEXT
+        )''',
+        '''
+        CREATE TABLE grilles (
+            id INTEGER PRIMARY KEY,
+            hash TEXT UNIQUE NOT NULL,
+            contenu TEXT
+        )''',
+        '''
+        CREATE TABLE criteres (
+            id INTEGER PRIMARY KEY,
+            libelle TEXT UNIQUE NOT NULL
+        )''',
+        '''
+        CREATE TABLE evaluation_run (
+            id INTEGER PRIMARY KEY,
+            id_etudiant TEXT NOT NULL REFERENCES etudiants(id_etudiant),
+            cas_id INTEGER REFERENCES cas_cliniques(id),
+            grille_id INTEGER REFERENCES grilles(id),
+            date_evaluation DATETIME,
+            synthese REAL,
+            prise_en_charge REAL,
+            note_finale REAL,
+            commentaire TEXT,
+            modele TEXT,
+            version_prompt TEXT
+        )''',
+        "CREATE INDEX idx_evaluation_run_etudiant ON evaluation_run(id_etudiant)",
+        "CREATE INDEX idx_evaluation_run_date ON evaluation_run(date_evaluation)",
+        '''
+        CREATE TABLE evaluation_critere (
+            run_id INTEGER NOT NULL REFERENCES evaluation_run(id) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            critere_id INTEGER NOT NULL REFERENCES criteres(id),
+            score REAL,
+            justification TEXT,
+            PRIMARY KEY (run_id, position)
+        )''',
+        "CREATE INDEX idx_evaluation_critere_critere ON evaluation_critere(critere_id)",
+        "ALTER TABLE evaluations_humaines ADD COLUMN run_id INTEGER REFERENCES evaluation_run(id)",
+        lambda conn: _migrate_evaluations_ia(conn),
+        "DROP TABLE evaluations_ia",
+        '''
+        CREATE VIEW evaluations_ia AS
+        SELECT ec.rowid AS id, r.id_etudiant, c.libelle AS critere, ec.score, ec.justification,
+               r.synthese, r.prise_en_charge, r.note_finale, r.commentaire
+        FROM evaluation_critere ec
+        JOIN evaluation_run r ON r.id = ec.run_id
+        JOIN criteres c ON c.id = ec.critere_id''',
+        # Écrit dans la même transaction que le run : un travail repris après un
+        # crash retrouve son run au lieu d'en enregistrer un second.
+        '''
+        CREATE TABLE travaux_runs (
+            jeton TEXT PRIMARY KEY,
+            run_id INTEGER NOT NULL REFERENCES evaluation_run(id) ON DELETE CASCADE
+        )''',
+        # Une ligne par purge : après une purge, les ids des runs sont réutilisés
+        "CREATE TABLE purges (id INTEGER PRIMARY KEY AUTOINCREMENT, date DATETIME)",
+    ]),
+]
+
+NOTES_MIGRATIONS = [
+    (1, [
+        '''
+        CREATE TABLE IF NOT EXISTS evaluations (
+            id_etudiant TEXT PRIMARY KEY,
+            note_ia REAL,
+            eval1 REAL,
+            eval2 REAL
+        )''',
+    ]),
+    (2, [
+        "ALTER TABLE evaluations ADD COLUMN date_evaluation DATETIME",
+        "CREATE INDEX IF NOT EXISTS idx_evaluations_date ON evaluations(date_evaluation)",
+        "CREATE INDEX IF NOT EXISTS idx_evaluations_note_ia ON evaluations(note_ia)",
+        "CREATE TABLE purges (id INTEGER PRIMARY KEY AUTOINCREMENT, date DATETIME)",
+    ]),
+]
+
+def migrate(conn: sqlite3.Connection, migrations: list = MIGRATIONS):
+    """Applique les migrations dont la version dépasse PRAGMA user_version."""
+    current = conn.execute("PRAGMA user_version").fetchone()[0]
+    for version, statements in migrations:
+        if version <= current:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Une autre instance a pu migrer entre-temps
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+                conn.execute("ROLLBACK")
+                continue
+            for statement in statements:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+# ---------------------------
+# CONNEXION
+# ---------------------------
+def connect(db_path: str = DB_PATH) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_MS / 1000,
+                           check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA foreign_keys = ON")
+    return conn
+
+class Database:
+    """Connexion partagée entre les threads du processus (sessions Streamlit, workers batch)."""
+
+    def __init__(self, db_path: str = DB_PATH, migrations: list = MIGRATIONS):
+        self.path = db_path
+        self.conn = connect(db_path)
+        self.lock = threading.RLock()
+        self.writes = 0  # transactions validées par ce processus
+        with self.lock:
+            migrate(self.conn, migrations)
+
+    @contextmanager
+    def transaction(self):
+        """Transaction d'écriture (BEGIN IMMEDIATE ... COMMIT), sérialisée entre threads."""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+            self.writes += 1
+
+    def version(self) -> tuple[int, int]:
+        """Change dès que la base est modifiée : PRAGMA data_version couvre les autres
+        connexions (autre processus, batch.py), le compteur les écritures de celle-ci."""
+        with self.lock:
+            return self.conn.execute("PRAGMA data_version").fetchone()[0], self.writes
+
+    def query(self, sql: str, params=()) -> list:
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def read_sql(self, sql: str, params=None):
+        import pandas as pd
+        with self.lock:
+            return pd.read_sql_query(sql, self.conn, params=params)
+
+    def export_csv(self, sql: str, params=(), chunk_size: int = 1000) -> bytes:
+        """Résultat d'une requête au format CSV, lu par lots depuis le curseur."""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        with self.lock:
+            cursor = self.conn.execute(sql, params)
+            writer.writerow(column[0] for column in cursor.description)
+            while rows := cursor.fetchmany(chunk_size):
+                writer.writerows(rows)
+        return buffer.getvalue().encode("utf-8")
+
+# ---------------------------
+# ÉCRITURES
+# ---------------------------
+def _get_or_create(conn: sqlite3.Connection, table: str, key_column: str, key, extra: dict = None) -> int:
+    columns = [key_column, *(extra or {})]
+    conn.execute(f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) "
+                 f"VALUES ({', '.join('?' * len(columns))})", (key, *(extra or {}).values()))
+    return conn.execute(f"SELECT id FROM {table} WHERE {key_column} = ?", (key,)).fetchone()[0]
+
+def _criterion_ids(conn: sqlite3.Connection, labels: list[str]) -> dict:
+    conn.executemany("INSERT OR IGNORE INTO criteres (libelle) VALUES (?)", [(label,) for label in labels])
+    ids = {}
+    unique = list(dict.fromkeys(labels))
+    for start in range(0, len(unique), 500):
+        batch = unique[start:start + 500]
+        ids.update(conn.execute(f"SELECT libelle, id FROM criteres WHERE libelle IN ({', '.join('?' * len(batch))})",
+                                batch).fetchall())
+    return ids
+
+def _insert_run(conn: sqlite3.Connection, student_id: str, result: dict, date_evaluation,
+                cas_id: int = None, grille_id: int = None, model: str = None,
+                prompt_version: str = None) -> int:
+    run_id = conn.execute('''
+        INSERT INTO evaluation_run (id_etudiant, cas_id, grille_id, date_evaluation, synthese,
+                                    prise_en_charge, note_finale, commentaire, modele, version_prompt)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', (
+        student_id, cas_id, grille_id, date_evaluation, result["synthese"],
+        result["prise_en_charge"], result["note_finale"], result["commentaire"], model, prompt_version
+    )).lastrowid
+    criterion_ids = _criterion_ids(conn, [note["critère"] for note in result["notes"]])
+    conn.executemany("INSERT INTO evaluation_critere VALUES (?, ?, ?, ?, ?)", [
+        (run_id, position, criterion_ids[note["critère"]], note["score"], note["justification"])
+        for position, note in enumerate(result["notes"])
+    ])
+    return run_id
+
+def save_evaluation(conn: sqlite3.Connection, student_id: str, result: dict,
+                    clinical_text: str = None, rubric: list = None,
+                    model: str = GPT_MODEL, prompt_version: str = PROMPT_VERSION) -> int:
+    """Enregistre une évaluation (dans la transaction courante) et renvoie l'id du run.
+
+    Le cas clinique et la grille utilisés sont conservés une seule fois, dédupliqués par hash.
+    """
+    now = datetime.now()
+    conn.execute("INSERT OR IGNORE INTO etudiants VALUES (?, ?, ?)",
+                 (student_id, now, hash_identification(student_id)))
+    cas_id = grille_id = None
+    if clinical_text is not None:
+        cas_id = _get_or_create(conn, "cas_cliniques", "hash", hash_identification(clinical_text),
+                                {"texte": clinical_text})
+    if rubric is not None:
+        contenu = json.dumps(rubric, ensure_ascii=False, sort_keys=True)
+        grille_id = _get_or_create(conn, "grilles", "hash", hash_identification(contenu), {"contenu": contenu})
+    return _insert_run(conn, student_id, result, now, cas_id, grille_id, model, prompt_version)
+
+def save_human_evaluation(conn: sqlite3.Connection, student_id: str, eval1: float, eval2: float,
+                          run_id: int = None):
+    conn.execute("INSERT INTO evaluations_humaines (id_etudiant, eval1, eval2, timestamp, run_id) "
+                 "VALUES (?, ?, ?, ?, ?)", (student_id, eval1, eval2, datetime.now(), run_id))
+
+def record_purge(conn: sqlite3.Connection):
+    """Note une purge (table purges) : les statistiques calculées sur la base sont à refaire."""
+    conn.execute("INSERT INTO purges (date) VALUES (?)", (datetime.now(),))
+
+def purge(conn: sqlite3.Connection):
+    """Supprime toutes les évaluations (les cas et grilles de référence sont conservés)."""
+    conn.execute("DELETE FROM evaluations_humaines")
+    conn.execute("DELETE FROM travaux_runs")
+    conn.execute("DELETE FROM evaluation_critere")
+    conn.execute("DELETE FROM evaluation_run")
+    conn.execute("DELETE FROM etudiants")
+    record_purge(conn)
+
+def _migrate_evaluations_ia(conn: sqlite3.Connection):
+    """Migration 3 : regroupe les lignes evaluations_ia (une par critère) en runs.
+
+    Les critères d'une même évaluation ont été insérés à la suite, avec les mêmes
+    champs globaux : une nouvelle évaluation commence dès que ceux-ci changent, ou
+    qu'un critère déjà vu revient (même évaluation enregistrée deux fois de suite).
+    """
+    rows = conn.execute('''
+        SELECT ia.id_etudiant, ia.critere, ia.score, ia.justification, ia.synthese,
+               ia.prise_en_charge, ia.note_finale, ia.commentaire, e.date_evaluation
+        FROM evaluations_ia ia LEFT JOIN etudiants e ON e.id_etudiant = ia.id_etudiant
+        ORDER BY ia.id''').fetchall()
+    current_key, result, labels = None, None, set()
+    runs = []
+    for student_id, critere, score, justification, synthese, prise, finale, commentaire, date in rows:
+        key = (student_id, synthese, prise, finale, commentaire)
+        if key != current_key or (critere or "") in labels:
+            current_key, labels = key, set()
+            result = {"synthese": synthese, "prise_en_charge": prise, "note_finale": finale,
+                      "commentaire": commentaire, "notes": []}
+            runs.append((student_id, date, result))
+        labels.add(critere or "")
+        result["notes"].append({"critère": critere or "", "score": score, "justification": justification})
+    for student_id, date, result in runs:
+        conn.execute("INSERT OR IGNORE INTO etudiants (id_etudiant, date_evaluation) VALUES (?, ?)",
+                     (student_id, date))
+        _insert_run(conn, student_id, result, date)
+
+# ---------------------------
+# HISTORIQUE (app3.py)
+# ---------------------------
+HISTORY_PAGE_SIZE = 50
+
+def history_filters(student_prefix: str = "", date_min=None, date_max=None,
+                    score_min=None, score_max=None) -> tuple[str, list]:
+    """Clause WHERE (indexable) et paramètres pour filtrer la table evaluations."""
+    clauses, params = [], []
+    if student_prefix:
+        # Intervalle plutôt que LIKE : utilise l'index de la clé primaire
+        clauses.append("id_etudiant >= ? AND id_etudiant < ?")
+        params += [student_prefix, student_prefix + "\U0010ffff"]
+    if date_min is not None:
+        clauses.append("date_evaluation >= ?")
+        params.append(date_min.isoformat())
+    if date_max is not None:
+        clauses.append("date_evaluation < ?")
+        params.append(date_max.isoformat())
+    if score_min is not None:
+        clauses.append("note_ia >= ?")
+        params.append(score_min)
+    if score_max is not None:
+        clauses.append("note_ia <= ?")
+        params.append(score_max)
+    return " AND ".join(clauses) or "1", params
+
+def fetch_history_page(db: Database, before_rowid: int = None, limit: int = HISTORY_PAGE_SIZE,
+                       **filters) -> tuple[list[str], list[tuple], int]:
+    """Une page de l'historique, de la plus récente à la plus ancienne (pagination par clé).
+
+    Renvoie (colonnes, lignes, curseur de la page suivante ou None).
+    """
+    where, params = history_filters(**filters)
+    if before_rowid is not None:
+        where += " AND rowid < ?"
+        params.append(before_rowid)
+    with db.lock:
+        cursor = db.conn.execute(
+            "SELECT rowid, id_etudiant, note_ia, eval1, eval2, date_evaluation "
+            f"FROM evaluations WHERE {where} ORDER BY rowid DESC LIMIT ?",
+            (*params, limit + 1))
+        columns = [column[0] for column in cursor.description][1:]
+        rows = cursor.fetchall()
+    next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+    return columns, [row[1:] for row in rows[:limit]], next_cursor
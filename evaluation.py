@@ -0,0 +1,692 @@
+# Évaluation Médicale IA - Logique commune (transcription + évaluation GPT-4)
+#
+# Ce module ne dépend pas de Streamlit : il est partagé entre l'interface
+# (app4.py) et le mode batch en ligne de commande (batch.py).
+
+import asyncio
+import json
+import hashlib
+import os
+import random
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from difflib import SequenceMatcher
+from typing import TYPE_CHECKING, Optional
+from pydantic import BaseModel, ValidationError
+
+import metrics
+from prompt import build_messages
+
+# openai, audio (av, numpy), evidence et prescore (numpy, scipy) ne sont importés qu'à
+# l'appel des fonctions qui s'en servent : les apps importent ce module au premier affichage
+if TYPE_CHECKING:
+    from openai import OpenAI
+    from evidence import EvidenceIndex
+
+WHISPER_MODEL = "whisper-1"
+GPT_MODEL = "gpt-4"
+TEMPERATURE = 0.1
+LANGUAGE = "fr"
+MAX_TOKENS = 1500
+# À incrémenter à chaque modification de INSTRUCTIONS ou de build_prompt (invalide le cache).
+PROMPT_VERSION = "ecos-2"
+
+# ---------------------------
+# VALIDATION
+# ---------------------------
+class EvaluationResult(BaseModel):
+    notes: list[dict]
+    synthese: float
+    prise_en_charge: float
+    note_finale: float
+    commentaire: str
+
+# ---------------------------
+# OUTILS
+# ---------------------------
+def hash_identification(raw_id):
+    return hashlib.sha256(raw_id.encode()).hexdigest()
+
+def hash_file(path: str, chunk_size: int = 1 << 20) -> str:
+    """SHA-256 du contenu d'un fichier, lu par blocs."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# ---------------------------
+# WHISPER
+# ---------------------------
+def transcribe_chunk(client: "OpenAI", path: str, language: str = LANGUAGE) -> str:
+    """Un appel Whisper brut, sans prétraitement ni cache."""
+    def call():
+        with open(path, "rb") as f:
+            return client.audio.transcriptions.create(
+                model=WHISPER_MODEL,
+                file=f,
+                language=language
+            )
+    metrics.record(appels=1)
+    return with_backoff(call).text
+
+def _normalize_word(word: str) -> str:
+    return re.sub(r"\W", "", word.lower())
+
+def stitch_transcripts(texts: list[str], max_overlap_words: int = 40, slack: int = 4) -> str:
+    """Recolle les transcriptions de segments qui se recouvrent.
+
+    Le plus long passage commun entre la fin du texte courant et le début du
+    segment suivant est considéré comme le recouvrement : il n'est gardé qu'une fois.
+    Ce passage doit toucher la jointure, à `slack` mots près (mots mal reconnus aux
+    bords d'un segment).
+    """
+    words = texts[0].split() if texts else []
+    for text in texts[1:]:
+        following = text.split()
+        tail = [_normalize_word(w) for w in words[-max_overlap_words:]]
+        head = [_normalize_word(w) for w in following[:max_overlap_words]]
+        match = SequenceMatcher(None, tail, head, autojunk=False).find_longest_match(
+            0, len(tail), 0, len(head))
+        at_seam = len(tail) - (match.a + match.size) <= slack and match.b <= slack
+        if at_seam and (match.size >= 2 or (match.a + match.size == len(tail) and match.b == 0)):
+            words = words[:len(words) - len(tail) + match.a + match.size]
+            following = following[match.b + match.size:]
+        words += following
+    return " ".join(words)
+
+def transcribe(client: "OpenAI", audio_path: str, language: str = LANGUAGE, cache=None,
+               preprocess: bool = True, audio_hash: str = None) -> str:
+    """Transcrit un fichier audio ; avec `cache` (TranscriptionCache), un audio déjà vu n'est pas renvoyé.
+    Avec `preprocess`, l'audio est d'abord nettoyé, compressé et, s'il est long, découpé
+    en segments transcrits en parallèle puis recollés (voir audio.prepare_chunks).
+    `audio_hash` évite de relire le fichier quand son SHA-256 est déjà connu (uploads)."""
+    with metrics.stage("whisper", WHISPER_MODEL):
+        if cache is not None:
+            audio_hash = audio_hash or hash_file(audio_path)
+            text = cache.get(audio_hash, WHISPER_MODEL, language)
+            if text is not None:
+                metrics.mark_cached()
+                return text
+        from audio import prepare_chunks
+        chunk_paths, duration = prepare_chunks(audio_path) if preprocess else ([audio_path], 0.0)
+        metrics.record(audio_s=duration)
+        try:
+            if len(chunk_paths) == 1:
+                text = transcribe_chunk(client, chunk_paths[0], language)
+            else:
+                with ThreadPoolExecutor(max_workers=len(chunk_paths)) as pool:
+                    texts = list(pool.map(metrics.bind(lambda path: transcribe_chunk(client, path, language)),
+                                          chunk_paths))
+                text = stitch_transcripts(texts)
+        finally:
+            for path in chunk_paths:
+                if path != audio_path:
+                    os.remove(path)
+        if cache is not None:
+            cache.put(audio_hash, WHISPER_MODEL, language, text)
+        return text
+
+# ---------------------------
+# GPT-4
+# ---------------------------
+INSTRUCTIONS = """Tu es un examinateur médical rigoureux. Voici ta tâche :
+1. Évalue chaque critère (notes[]) avec score (0 ou 1) et justification.
+2. Donne une **note de synthèse** : un **nombre décimal entre 0 et 1** (ex: 0.5).
+3. Donne une **note de prise en charge** : un **nombre décimal entre 0 et 1**.
+4. Calcule une **note finale** sur 20 (nombre décimal).
+5. Rédige un **commentaire global** (5 lignes max).
+⚠️ Toutes les valeurs doivent être des **nombres** pour les notes, pas du texte. Retourne un JSON strict sans texte autour, comme :
+{
+  "notes": [{"critère": "...", "score": 1, "justification": "..."}],
+  "synthese": 0.75,
+  "prise_en_charge": 1.0,
+  "note_finale": 18.5,
+  "commentaire": "Très bonne réponse globale."
+}"""
+
+def build_prompt(clinical_text: str, transcript_text: str, rubric: list) -> list[dict]:
+    """Messages GPT-4 : consignes, cas et grille en préfixe stable, transcription en dernier."""
+    return build_messages(INSTRUCTIONS, clinical_text, rubric, transcript_text,
+                          model=GPT_MODEL, completion_tokens=MAX_TOKENS)
+
+# ---------------------------
+# SORTIE STRUCTURÉE ET RÉPARATION
+# ---------------------------
+# Modèles acceptant response_format={"type": "json_schema"} ; les autres reçoivent
+# seulement l'exemple de INSTRUCTIONS et passent par la réparation ci-dessous.
+STRUCTURED_OUTPUT_MODELS = ("gpt-4o", "gpt-4.1", "o1", "o3", "o4")
+REPAIR_ATTEMPTS = 2
+REPAIR_MAX_TOKENS = 500
+NOTE_SCHEMA = {
+    "type": "object",
+    "properties": {"id": {"type": "string"}, "critère": {"type": "string"},
+                   "score": {"type": "number"}, "justification": {"type": "string"},
+                   "extraits": {"type": "array", "items": {"type": "string"}}},
+    "required": ["id", "critère", "score", "justification", "extraits"],
+    "additionalProperties": False,
+}
+
+def evaluation_schema(schema: type[BaseModel] = EvaluationResult) -> dict:
+    """Schéma JSON strict dérivé du modèle pydantic (le détail d'un critère est précisé)."""
+    json_schema = schema.model_json_schema()
+    if "notes" in json_schema["properties"]:
+        json_schema["properties"]["notes"]["items"] = NOTE_SCHEMA
+    json_schema["additionalProperties"] = False
+    return json_schema
+
+def response_format(model: str = GPT_MODEL, schema: type[BaseModel] = EvaluationResult):
+    if not model.startswith(STRUCTURED_OUTPUT_MODELS):
+        return None
+    return {"type": "json_schema", "json_schema": {
+        "name": schema.__name__, "strict": True, "schema": evaluation_schema(schema)}}
+
+class MalformedResponse(ValueError):
+    """Réponse GPT-4 invalide ; `partial` garde les champs valides, `fields` liste ceux à redemander."""
+
+    def __init__(self, reason: str, partial: dict = None, fields: list[str] = None,
+                 schema: type[BaseModel] = EvaluationResult):
+        super().__init__(reason)
+        self.reason = reason
+        self.partial = partial
+        self.fields = fields or list(schema.model_fields)
+
+TYPOGRAPHIC_QUOTES = "“”«»"
+
+def _straighten_quotes(text: str) -> str:
+    """Guillemets typographiques servant de délimiteurs JSON -> '"' ; ceux cités à l'intérieur
+    d'une chaîne (« ECG ») sont gardés tels quels."""
+    chars, closing, escaped = [], None, False
+    for char in text:
+        if closing is None:
+            if char == '"' or char in TYPOGRAPHIC_QUOTES:
+                closing = '"' if char == '"' else '"' + TYPOGRAPHIC_QUOTES
+                char = '"'
+        elif escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char in closing:
+            closing, char = None, '"'
+        chars.append(char)
+    return "".join(chars)
+
+def _fix_json(text: str) -> str:
+    text = _straighten_quotes(text)
+    text = re.sub(r",\s*([}\]])", r"\1", text)
+    text = re.sub(r"(?<=[:\[,\s])(True|False|None)(?=\s*[,}\]])",
+                  lambda m: {"True": "true", "False": "false", "None": "null"}[m.group(1)], text)
+    return re.sub(r"(:\s*-?\d+),(\d+)(?=\s*[,}\]])", r"\1.\2", text)
+
+def _close_json(text: str) -> str:
+    """Referme chaîne, objets et tableaux laissés ouverts par une réponse tronquée."""
+    stack, in_string, escaped = [], False, False
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]" and stack:
+            stack.pop()
+    if in_string:
+        text += '"'
+    text = re.sub(r"[,:]\s*$", "", text.rstrip())
+    return text + "".join(reversed(stack))
+
+def load_json_lenient(content: str) -> dict:
+    """json.loads tolérant aux défauts courants : texte ou balises ``` autour, guillemets
+    typographiques, virgules finales, littéraux Python, décimales à virgule, réponse tronquée."""
+    text = re.sub(r"```(?:json)?", "", content).strip()
+    start = text.find("{")
+    if start < 0:
+        raise ValueError("Format JSON manquant")
+    text = text[start:]
+    complete = text[:text.rfind("}") + 1]
+    for candidate in (complete, _fix_json(complete), _close_json(_fix_json(text))):
+        try:
+            return json.loads(candidate)
+        except json.JSONDecodeError as e:
+            error = e
+    raise ValueError(f"JSON invalide : {error}")
+
+def parse_result(content: str, base: dict = None,
+                 schema: type[BaseModel] = EvaluationResult) -> dict:
+    """Extrait et valide le JSON renvoyé par GPT-4, complété par `base` (réponse partielle
+    d'une réparation). Lève MalformedResponse avec les champs encore à redemander."""
+    try:
+        parsed = load_json_lenient(content)
+    except ValueError as e:
+        raise MalformedResponse(str(e), base, None if base is None else
+                                [f for f in schema.model_fields if f not in base], schema) from e
+    if not isinstance(parsed, dict):
+        raise MalformedResponse("La réponse n'est pas un objet JSON", base, schema=schema)
+    merged = {**(base or {}), **parsed}
+    try:
+        return schema(**merged).dict()
+    except ValidationError as e:
+        fields = sorted({str(err["loc"][0]) for err in e.errors() if err["loc"]})
+        partial = {k: v for k, v in merged.items() if k not in fields}
+        raise MalformedResponse(f"Champs invalides : {', '.join(fields)}", partial, fields,
+                                schema) from e
+
+def repair_messages(messages: list[dict], content: str, error: MalformedResponse) -> list[dict]:
+    """Conversation de réparation : ne redemande que les champs invalides (tout le JSON si
+    la réponse était illisible)."""
+    if error.partial:
+        request = (f"Ta réponse est incomplète ou invalide ({error.reason}). Renvoie UNIQUEMENT un "
+                   f"objet JSON contenant les champs {', '.join(error.fields)}, sans texte autour.")
+    else:
+        request = (f"Ta réponse n'est pas un JSON valide ({error.reason}). Renvoie UNIQUEMENT "
+                   f"le JSON complet et corrigé, sans texte autour.")
+    return messages + [{"role": "assistant", "content": content[-4000:]},
+                       {"role": "user", "content": request}]
+
+# ---------------------------
+# RÉESSAIS (ERREURS TRANSITOIRES)
+# ---------------------------
+RETRY_ATTEMPTS = 4
+BACKOFF_BASE_S = 1.0
+BACKOFF_MAX_S = 30.0
+
+def transient_errors() -> tuple:
+    """Erreurs réseau / 429 / 5xx de l'API, ré-essayées par with_backoff."""
+    import openai
+    return openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError
+
+def backoff_delay(attempt: int) -> float:
+    """Attente exponentielle avec gigue : ~1 s, 2 s, 4 s... plafonnée à BACKOFF_MAX_S."""
+    return random.uniform(0.5, 1.0) * min(BACKOFF_MAX_S, BACKOFF_BASE_S * 2 ** attempt)
+
+def with_backoff(call, *args, **kwargs):
+    """Exécute `call`, ré-essayé avec attente exponentielle sur les erreurs réseau / 429 / 5xx."""
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return call(*args, **kwargs)
+        except transient_errors():
+            if attempt == RETRY_ATTEMPTS - 1:
+                raise
+            metrics.record(reessais=1)
+            time.sleep(backoff_delay(attempt))
+
+async def awith_backoff(call, *args, **kwargs):
+    """Version asynchrone de with_backoff (`call` renvoie une coroutine)."""
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return await call(*args, **kwargs)
+        except transient_errors():
+            if attempt == RETRY_ATTEMPTS - 1:
+                raise
+            metrics.record(reessais=1)
+            await asyncio.sleep(backoff_delay(attempt))
+
+class NotesStreamParser:
+    """Découpe au fil de l'eau le tableau "notes" d'une réponse JSON en cours de génération.
+
+    `feed(fragment)` renvoie la liste des critères dont l'objet JSON vient de se fermer.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.pos = 0            # prochain caractère à analyser
+        self.in_notes = False
+        self.done = False
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.start = None       # début de l'objet critère courant
+
+    def feed(self, fragment: str) -> list[dict]:
+        self.buffer += fragment
+        if self.done:
+            return []
+        if not self.in_notes:
+            match = re.search(r'"notes"\s*:\s*\[', self.buffer)
+            if not match:
+                return []
+            self.in_notes = True
+            self.pos = match.end()
+        return self._scan()
+
+    def _scan(self) -> list[dict]:
+        notes = []
+        buffer = self.buffer
+        while self.pos < len(buffer):
+            char = buffer[self.pos]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char == "{":
+                if self.depth == 0:
+                    self.start = self.pos
+                self.depth += 1
+            elif char == "}":
+                self.depth -= 1
+                if self.depth == 0 and self.start is not None:
+                    try:
+                        notes.append(json.loads(buffer[self.start:self.pos + 1]))
+                    except json.JSONDecodeError:
+                        pass
+                    self.start = None
+            elif char == "]" and self.depth == 0:
+                self.done = True
+                self.pos += 1
+                break
+            self.pos += 1
+        return notes
+
+def _create(client: "OpenAI", messages: list[dict], temperature: float = TEMPERATURE,
+            max_tokens: int = MAX_TOKENS, schema: type[BaseModel] = EvaluationResult, **kwargs):
+    fmt = response_format(schema=schema) if schema else None
+    if fmt:
+        kwargs["response_format"] = fmt
+    if kwargs.get("stream"):
+        # Le dernier fragment du flux porte alors l'usage (tokens)
+        kwargs["stream_options"] = {"include_usage": True}
+    metrics.record(appels=1)
+    response = with_backoff(client.chat.completions.create, model=GPT_MODEL, messages=messages,
+                            temperature=temperature, max_tokens=max_tokens, **kwargs)
+    if not kwargs.get("stream"):
+        metrics.record_usage(response)
+    return response
+
+# Une évaluation est une suite de requêtes : réparations ciblées, lots redemandés. Ces suites
+# sont écrites une fois, en générateurs sans entrée/sortie qui produisent les requêtes
+# (messages, max_tokens, schema) et reçoivent le contenu de chaque réponse ; run_steps les
+# exécute ici, pipeline.arun_steps en asynchrone.
+def repair_steps(messages: list[dict], content: str, schema: type[BaseModel] = EvaluationResult):
+    """Valide `content` (après réparation locale) ; sinon redemande au plus REPAIR_ATTEMPTS fois
+    les seuls champs invalides, sans refaire l'évaluation complète."""
+    error = None
+    for attempt in range(REPAIR_ATTEMPTS + 1):
+        try:
+            return parse_result(content, base=error.partial if error else None, schema=schema)
+        except MalformedResponse as e:
+            if attempt == REPAIR_ATTEMPTS:
+                raise
+            error = e
+        content = yield (repair_messages(messages, content, error), REPAIR_MAX_TOKENS,
+                         None if error.partial else schema)
+
+def evaluation_steps(messages: list[dict], max_tokens: int = MAX_TOKENS,
+                     schema: type[BaseModel] = EvaluationResult):
+    content = yield messages, max_tokens, schema
+    return (yield from repair_steps(messages, content, schema))
+
+def run_steps(steps, send):
+    """Exécute une suite de requêtes ; `send(messages, max_tokens, schema)` renvoie le contenu."""
+    try:
+        request = next(steps)
+        while True:
+            request = steps.send(send(*request))
+    except StopIteration as done:
+        return done.value
+
+def sender(client: "OpenAI", temperature: float = TEMPERATURE):
+    def send(messages: list[dict], max_tokens: int, schema: type[BaseModel]) -> str:
+        return _create(client, messages, temperature, max_tokens, schema).choices[0].message.content or ""
+    return send
+
+def evaluate(client: "OpenAI", messages: list[dict], temperature: float = TEMPERATURE,
+             max_tokens: int = MAX_TOKENS, schema: type[BaseModel] = EvaluationResult) -> dict:
+    return run_steps(evaluation_steps(messages, max_tokens, schema), sender(client, temperature))
+
+def stream_evaluate(client: "OpenAI", messages: list[dict], on_note) -> dict:
+    """Comme `evaluate`, mais en streaming : `on_note(critère)` est appelé dès que l'objet
+    JSON d'un critère est complet. Le résultat final est validé par EvaluationResult."""
+    stream = _create(client, messages, stream=True)
+    parser = NotesStreamParser()
+    for chunk in stream:
+        if not chunk.choices:
+            metrics.record_usage(chunk)
+            continue
+        fragment = chunk.choices[0].delta.content or ""
+        for note in parser.feed(fragment):
+            on_note(note)
+    return run_steps(repair_steps(messages, parser.buffer), sender(client))
+
+# ---------------------------
+# ÉVALUATION PAR LOTS DE CRITÈRES
+# ---------------------------
+# Pour les grandes grilles, les critères sont répartis en lots notés en parallèle
+# contre la même transcription, puis un petit appel final produit synthèse, prise
+# en charge, note finale et commentaire à partir des notes obtenues.
+SHARD_SIZE = 5
+SHARD_WORKERS = 4
+NOTE_MAX_TOKENS = 200      # par critère d'un lot
+SUMMARY_MAX_TOKENS = 400
+
+class ShardResult(BaseModel):
+    notes: list[dict]
+
+class SummaryResult(BaseModel):
+    synthese: float
+    prise_en_charge: float
+    note_finale: float
+    commentaire: str
+
+SHARD_INSTRUCTIONS = """Tu es un examinateur médical rigoureux. Évalue UNIQUEMENT les critères de la grille ci-dessous.
+Pour chaque critère, reprends son identifiant (id) et son libellé (critère), donne un score (0 ou 1) et une justification fondée uniquement sur les propos de l'étudiant.
+⚠️ Le score doit être un **nombre**. Retourne un JSON strict sans texte autour, comme :
+{"notes": [{"id": "C1", "critère": "...", "score": 1, "justification": "..."}]}"""
+
+EVIDENCE_SHARD_INSTRUCTIONS = """Tu es un examinateur médical rigoureux. Évalue UNIQUEMENT les critères de la grille ci-dessous.
+La réponse de l'étudiant est fournie sous forme d'extraits numérotés ([E1], [E2]...) : ce sont les passages les plus pertinents pour ces critères.
+Pour chaque critère, reprends son identifiant (id) et son libellé (critère), donne un score (0 ou 1), une justification fondée uniquement sur ces extraits, et la liste des extraits cités (liste vide si aucun).
+⚠️ Le score doit être un **nombre**. Retourne un JSON strict sans texte autour, comme :
+{"notes": [{"id": "C1", "critère": "...", "score": 1, "justification": "...", "extraits": ["E2"]}]}"""
+
+SUMMARY_INSTRUCTIONS = """Tu es un examinateur médical rigoureux. Les critères de la grille ont déjà été notés : les notes sont fournies avant la réponse de l'étudiant.
+1. Donne une **note de synthèse** : un **nombre décimal entre 0 et 1**.
+2. Donne une **note de prise en charge** : un **nombre décimal entre 0 et 1**.
+3. Calcule une **note finale** sur 20 (nombre décimal).
+4. Rédige un **commentaire global** (5 lignes max).
+Retourne un JSON strict sans texte autour, comme :
+{"synthese": 0.75, "prise_en_charge": 1.0, "note_finale": 18.5, "commentaire": "Très bonne réponse globale."}"""
+
+def with_ids(rubric: list) -> list[dict]:
+    """Garantit un identifiant à chaque critère (les grilles compilées en ont déjà)."""
+    return [item if "id" in item else {"id": f"C{i}", **item} for i, item in enumerate(rubric, start=1)]
+
+def shard_rubric(rubric: list, shard_size: int = SHARD_SIZE) -> list[list[dict]]:
+    rubric = with_ids(rubric)
+    return [rubric[i:i + shard_size] for i in range(0, len(rubric), shard_size)]
+
+def build_shard_prompt(clinical_text: str, transcript_text: str, shard: list[dict],
+                       index: "EvidenceIndex" = None) -> list[dict]:
+    """Avec `index`, seuls les extraits pertinents pour les critères du lot sont envoyés."""
+    if index is None:
+        return build_messages(SHARD_INSTRUCTIONS, clinical_text, shard, transcript_text,
+                              model=GPT_MODEL, completion_tokens=NOTE_MAX_TOKENS * len(shard))
+    return build_messages(EVIDENCE_SHARD_INSTRUCTIONS, clinical_text, shard, index.render(shard),
+                          model=GPT_MODEL, completion_tokens=NOTE_MAX_TOKENS * len(shard),
+                          student_label="Extraits de la réponse de l'étudiant")
+
+def build_summary_prompt(clinical_text: str, transcript_text: str, rubric: list,
+                         notes: list[dict]) -> list[dict]:
+    scored = json.dumps([{"id": n["id"], "score": n["score"]} for n in notes], ensure_ascii=False)
+    return build_messages(SUMMARY_INSTRUCTIONS, clinical_text, rubric,
+                          f"{scored}\n\nRéponse de l'étudiant :\n{transcript_text}",
+                          model=GPT_MODEL, completion_tokens=SUMMARY_MAX_TOKENS,
+                          student_label="Notes par critère")
+
+def match_notes(shard: list[dict], notes: list[dict]) -> dict:
+    """Associe les notes renvoyées aux critères du lot (par id, sinon par libellé)."""
+    by_label = {item.get("critère"): item["id"] for item in shard}
+    ids = {item["id"] for item in shard}
+    matched = {}
+    for note in notes:
+        item_id = note.get("id") if note.get("id") in ids else by_label.get(note.get("critère"))
+        if item_id is not None:
+            matched[item_id] = note
+    return matched
+
+def merge_note(item: dict, note: dict, index: "EvidenceIndex" = None) -> dict:
+    merged = {"id": item["id"], "critère": item.get("critère", note.get("critère", "")),
+              "score": note.get("score", 0), "justification": note.get("justification", "")}
+    if index is not None:
+        merged["extraits"] = index.resolve(note.get("extraits"))
+    return merged
+
+def shard_steps(clinical_text: str, transcript_text: str, shard: list[dict],
+                index: "EvidenceIndex" = None):
+    """Note un lot de critères ; ceux que GPT-4 a oubliés sont redemandés une fois."""
+    found, remaining = {}, shard
+    for _ in range(2):
+        result = yield from evaluation_steps(build_shard_prompt(clinical_text, transcript_text, remaining, index),
+                                             NOTE_MAX_TOKENS * len(remaining), ShardResult)
+        found.update(match_notes(remaining, result["notes"]))
+        remaining = [item for item in shard if item["id"] not in found]
+        if not remaining:
+            return [merge_note(item, found[item["id"]], index) for item in shard]
+    raise MalformedResponse(f"Critères non évalués : {', '.join(i['id'] for i in remaining)}",
+                            schema=ShardResult)
+
+def summary_steps(clinical_text: str, transcript_text: str, rubric: list[dict], found: dict):
+    """Synthèse finale à partir des notes de tous les critères ; renvoie le résultat complet."""
+    notes = [found[item["id"]] for item in rubric]
+    summary = yield from evaluation_steps(build_summary_prompt(clinical_text, transcript_text, rubric, notes),
+                                          SUMMARY_MAX_TOKENS, SummaryResult)
+    return EvaluationResult(notes=notes, **summary).dict()
+
+def plan_shards(rubric: list, shard_size: int, decided: dict = None) -> tuple[list[dict], dict, list]:
+    """(grille avec ids, notes déjà connues {id: note}, lots des critères restant à noter)."""
+    rubric = with_ids(rubric)
+    found = dict(decided or {})
+    return rubric, found, shard_rubric([item for item in rubric if item["id"] not in found], shard_size)
+
+def evaluate_shard(client: "OpenAI", clinical_text: str, transcript_text: str,
+                   shard: list[dict], index: "EvidenceIndex" = None) -> list[dict]:
+    return run_steps(shard_steps(clinical_text, transcript_text, shard, index), sender(client))
+
+def evaluate_sharded(client: "OpenAI", clinical_text: str, transcript_text: str, rubric: list,
+                     shard_size: int = SHARD_SIZE, on_note=None, decided: dict = None,
+                     index: "EvidenceIndex" = None) -> dict:
+    """Évalue la grille par lots en parallèle ; `on_note` reçoit les critères de chaque lot
+    dès qu'il est terminé (depuis le thread appelant). Les critères de `decided` ({id: note},
+    voir prescore) sont déjà notés : seuls les autres partent chez GPT-4. Avec `index`, chaque
+    lot ne reçoit que ses extraits (la synthèse finale garde la transcription complète)."""
+    rubric, found, shards = plan_shards(rubric, shard_size, decided)
+    for note in found.values() if on_note else []:
+        on_note(note)
+    if shards:
+        with ThreadPoolExecutor(max_workers=min(SHARD_WORKERS, len(shards))) as pool:
+            futures = [pool.submit(metrics.bind(evaluate_shard), client, clinical_text, transcript_text,
+                                   shard, index)
+                       for shard in shards]
+            for future in as_completed(futures):
+                for note in future.result():
+                    found[note["id"]] = note
+                    if on_note:
+                        on_note(note)
+    return run_steps(summary_steps(clinical_text, transcript_text, rubric, found), sender(client))
+
+# ---------------------------
+# MÉMOÏSATION
+# ---------------------------
+def evaluation_key(clinical_text: str, rubric: list, transcript_text: str,
+                   model: str = GPT_MODEL, temperature: float = TEMPERATURE,
+                   prompt_version: str = PROMPT_VERSION) -> str:
+    parts = [
+        hash_identification(clinical_text),
+        hash_identification(json.dumps(rubric, ensure_ascii=False, sort_keys=True)),
+        hash_identification(transcript_text),
+        model,
+        repr(float(temperature)),
+        prompt_version,
+    ]
+    return hash_identification("|".join(parts))
+
+def sharded_version(shard_size: int = None, local: bool = False, evidence: bool = False) -> str:
+    """Version de prompt (clé de cache) selon le mode d'évaluation."""
+    version = f"{PROMPT_VERSION}/lots{shard_size}" if shard_size else PROMPT_VERSION
+    if local:
+        from prescore import PRESCORE_VERSION
+        version = f"{version}/local-{PRESCORE_VERSION}"
+    if evidence:
+        from evidence import TOP_K
+        version = f"{version}/extraits{TOP_K}"
+    return version
+
+def require_rubric(rubric: list):
+    if not rubric:
+        raise ValueError("Grille vide : aucun critère à évaluer")
+
+def evaluation_plan(clinical_text: str, transcript_text: str, rubric: list, shard_size: int = None,
+                    local: bool = False, evidence: bool = False) -> tuple[str, Optional[int]]:
+    """Clé de cache et taille des lots (None : grille notée en un seul appel)."""
+    sharded = shard_size if shard_size and len(rubric) > shard_size else None
+    key = evaluation_key(clinical_text, rubric, transcript_text,
+                         prompt_version=sharded_version(sharded, local, evidence))
+    return key, sharded or (len(rubric) if local or evidence else None)
+
+def prepare_sharded(rubric: list, transcript_text: str, local: bool = False,
+                    evidence: bool = False) -> tuple[Optional[dict], Optional["EvidenceIndex"]]:
+    """Critères tranchés localement (prescore) et index des extraits, selon le mode."""
+    from evidence import EvidenceIndex
+    from prescore import prescore
+    decided = prescore(with_ids(rubric), transcript_text)[0] if local else None
+    return decided, EvidenceIndex(transcript_text) if evidence else None
+
+def cached_result(cache, key: str, force: bool = False) -> Optional[dict]:
+    result = cache.get(key) if cache is not None and not force else None
+    if result is not None:
+        metrics.mark_cached()
+    return result
+
+def evaluate_transcript(client: "OpenAI", clinical_text: str, transcript_text: str, rubric: list,
+                        cache=None, force: bool = False, on_note=None, shard_size: int = None,
+                        local: bool = False, evidence: bool = False) -> dict:
+    """Évalue une transcription ; avec `cache` (EvaluationCache), un résultat déjà obtenu
+    pour les mêmes entrées est renvoyé sans appel réseau, sauf si `force` est vrai.
+    Avec `on_note`, la réponse est lue en streaming et chaque critère est transmis dès
+    qu'il est complet (y compris depuis le cache). Avec `shard_size`, une grille plus
+    longue est notée par lots en parallèle (voir evaluate_sharded). Avec `local`, les
+    critères littéraux tranchés par prescore ne sont pas envoyés à GPT-4. Avec `evidence`,
+    GPT-4 ne reçoit que les extraits pertinents pour chaque critère (voir EvidenceIndex)."""
+    require_rubric(rubric)
+    with metrics.stage("gpt4", GPT_MODEL):
+        key, shard_size = evaluation_plan(clinical_text, transcript_text, rubric, shard_size, local, evidence)
+        result = cached_result(cache, key, force)
+        if result is not None:
+            for note in result["notes"] if on_note else []:
+                on_note(note)
+            return result
+        if shard_size:
+            decided, index = prepare_sharded(rubric, transcript_text, local, evidence)
+            result = evaluate_sharded(client, clinical_text, transcript_text, rubric, shard_size,
+                                      on_note, decided, index)
+        elif on_note:
+            result = stream_evaluate(client, build_prompt(clinical_text, transcript_text, rubric), on_note)
+        else:
+            result = evaluate(client, build_prompt(clinical_text, transcript_text, rubric))
+        if cache is not None:
+            cache.put(key, result)
+        return result
+        if shard_size or local or evidence:
+            from evidence import EvidenceIndex
+            from prescore import prescore
+            decided = prescore(with_ids(rubric), transcript_text)[0] if local else None
+            index = EvidenceIndex(transcript_text) if evidence else None
+            result = evaluate_sharded(client, clinical_text, transcript_text, rubric,
+                                      shard_size or len(rubric), on_note, decided, index)
+        elif on_note:
+            result = stream_evaluate(client, build_prompt(clinical_text, transcript_text, rubric), on_note)
+        else:
+            result = evaluate(client, build_prompt(clinical_text, transcript_text, rubric))
+        if cache is not None:
+            cache.put(key, result)
+        return result
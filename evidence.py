@@ -0,0 +1,52 @@
+# Évaluation Médicale IA - Index des extraits de la transcription par critère
+#
+# La transcription est découpée en phrases numérotées (E1, E2...), sans
+# horodatage (transcribe ne garde que le texte de Whisper). Pour chaque
+# critère de la grille, les `k` phrases les plus proches (TF-IDF, voir
+# prescore) sont retenues : un lot de critères n'envoie à GPT-4 que ses
+# extraits au lieu de la transcription complète, et chaque justification cite
+# les extraits (ids) sur lesquels elle s'appuie.
+
+import numpy as np
+
+from prescore import split_sentences, terms, tfidf_similarity
+
+TOP_K = 3
+
+class EvidenceIndex:
+    """Phrases de la transcription, interrogeables critère par critère."""
+
+    def __init__(self, transcript_text: str):
+        self.excerpts = [{"id": f"E{i}", "texte": transcript_text[start:end].strip()}
+                         for i, (start, end) in enumerate(split_sentences(transcript_text), start=1)]
+        self.by_id = {excerpt["id"]: excerpt for excerpt in self.excerpts}
+        self.terms = [terms(excerpt["texte"]) for excerpt in self.excerpts]
+
+    def top_k(self, rubric: list[dict], k: int = TOP_K) -> dict[str, list[str]]:
+        """{id du critère: ids des `k` extraits les plus pertinents (similarité non nulle),
+        dans l'ordre du discours}."""
+        if not self.excerpts:
+            return {item["id"]: [] for item in rubric}
+        similarity = tfidf_similarity([terms(item.get("critère", "")) for item in rubric], self.terms)
+        k = min(k, len(self.excerpts))
+        best = np.argpartition(-similarity, k - 1, axis=1)[:, :k]
+        return {item["id"]: [self.excerpts[j]["id"] for j in sorted(best[row]) if similarity[row, j] > 0]
+                for row, item in enumerate(rubric)}
+
+    def render(self, rubric: list[dict], k: int = TOP_K) -> str:
+        """Extraits utiles à `rubric`, numérotés, à la place de la transcription.
+
+        Un critère sans aucun extrait proche (critère de jugement, formulation sans terme
+        médical) ne peut pas être noté sur extraits : toute la transcription est alors envoyée.
+        """
+        hits = self.top_k(rubric, k)
+        wanted = {excerpt_id for ids in hits.values() for excerpt_id in ids}
+        lines = []
+        for excerpt in self.excerpts:
+            if excerpt["id"] in wanted or not all(hits.values()):
+                lines.append(f"[{excerpt['id']}] {excerpt['texte']}")
+        return "\n".join(lines)
+
+    def resolve(self, excerpt_ids: list) -> list[dict]:
+        """Extraits cités par une justification (les ids inconnus sont ignorés)."""
+        return [dict(self.by_id[str(i)]) for i in excerpt_ids or [] if str(i) in self.by_id]
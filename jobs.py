@@ -0,0 +1,370 @@
+# Évaluation Médicale IA - File de travaux d'évaluation (SQLite) et pool de workers
+#
+# Le bouton « Évaluer » de app4.py ne fait plus qu'enregistrer un travail :
+# l'audio est copié par blocs dans JOBS_AUDIO_DIR (voir uploads.store_upload), puis les threads d'un JobPool (un par
+# processus, voir get_job_pool) enchaînent transcription, évaluation GPT-4 et
+# enregistrement dans evaluations.db. Chaque étape terminée est sauvegardée
+# dans jobs.db (point de reprise) : un rerun Streamlit ne refait aucun appel,
+# et après un crash le travail repart de la dernière étape terminée. Un
+# travail dont le pool ne donne plus signe de vie depuis LEASE_SECONDS est
+# repris par un autre pool (redémarrage de l'app, autre poste).
+#
+# Étapes : audio -> transcription -> evaluation -> enregistrement -> termine.
+# À l'enregistrement, l'audio est versé dans l'archive Opus (archive.py) et
+# relié au run ; sa copie dans JOBS_AUDIO_DIR est alors supprimée. Elle est
+# conservée tant qu'un travail en échec peut encore être repris.
+#
+# Chaque travail est exécuté avec le client OpenAI de l'examinateur qui l'a
+# soumis (ou repris) : les clients restent en mémoire dans le JobPool, les clés
+# ne sont jamais écrites dans jobs.db.
+
+import json
+import os
+import threading
+import time
+import uuid
+
+import metrics
+from evaluation import evaluate_transcript, hash_identification, sharded_version, transcribe
+from db import DB_PATH, Database, save_evaluation
+from uploads import store_upload, sweep_uploads
+
+JOBS_DB_PATH = os.path.join(os.path.dirname(DB_PATH), "jobs.db")
+JOBS_AUDIO_DIR = os.path.join("audios", "jobs")
+JOB_WORKERS = 2
+LEASE_SECONDS = 60       # sans battement de cœur depuis ce délai, un travail en cours est repris
+POLL_SECONDS = 1.0
+MAX_ATTEMPTS = 3         # prises en charge successives avant abandon (crash à répétition)
+
+PENDING, RUNNING, DONE, FAILED = "en_attente", "en_cours", "termine", "echec"
+ACTIVE = (PENDING, RUNNING)
+
+# jeton : relie le travail au run qu'il a enregistré (travaux_runs dans evaluations.db)
+JOB_MIGRATIONS = [
+    (1, [
+        '''
+        CREATE TABLE jobs (
+            id INTEGER PRIMARY KEY,
+            id_etudiant TEXT NOT NULL,
+            cle TEXT NOT NULL,
+            jeton TEXT NOT NULL,
+            statut TEXT NOT NULL,
+            etape TEXT NOT NULL,
+            options TEXT NOT NULL,
+            cas_clinique TEXT NOT NULL,
+            grille TEXT NOT NULL,
+            audio_path TEXT,
+            transcription TEXT,
+            notes TEXT,
+            resultat TEXT,
+            run_id INTEGER,
+            erreur TEXT,
+            tentatives INTEGER NOT NULL DEFAULT 0,
+            proprietaire TEXT,
+            heartbeat REAL,
+            created_at REAL,
+            updated_at REAL
+        )''',
+        "CREATE INDEX idx_jobs_statut ON jobs(statut, id)",
+        "CREATE INDEX idx_jobs_etudiant ON jobs(id_etudiant, id)",
+        "CREATE INDEX idx_jobs_cle ON jobs(cle)",
+    ]),
+]
+
+JSON_COLUMNS = ("options", "grille", "notes", "resultat")
+
+class LeaseLost(Exception):
+    """Le travail a été repris par un autre pool (battement de cœur trop ancien)."""
+
+# ---------------------------
+# FILE DE TRAVAUX
+# ---------------------------
+class JobQueue:
+    """Travaux d'évaluation et leurs points de reprise, dans jobs.db."""
+
+    def __init__(self, db_path: str = JOBS_DB_PATH, audio_dir: str = JOBS_AUDIO_DIR):
+        self.db = Database(db_path, JOB_MIGRATIONS)
+        self.audio_dir = audio_dir
+        os.makedirs(audio_dir, exist_ok=True)
+        sweep_uploads(audio_dir, "*.part")
+
+    def _row(self, cursor_row, columns) -> dict:
+        job = dict(zip(columns, cursor_row))
+        for column in JSON_COLUMNS:
+            job[column] = json.loads(job[column]) if job[column] is not None else None
+        return job
+
+    def _select(self, where: str, params=()) -> list[dict]:
+        with self.db.lock:
+            cursor = self.db.conn.execute(f"SELECT * FROM jobs WHERE {where}", params)
+            columns = [column[0] for column in cursor.description]
+            return [self._row(row, columns) for row in cursor.fetchall()]
+
+    def get(self, job_id: int) -> dict:
+        jobs = self._select("id = ?", (job_id,))
+        return jobs[0] if jobs else None
+
+    def latest(self, student_id: str) -> dict:
+        """Dernier travail soumis pour un étudiant (pour le retrouver après un rechargement de page)."""
+        jobs = self._select("id_etudiant = ? ORDER BY id DESC LIMIT 1", (student_id,))
+        return jobs[0] if jobs else None
+
+    def counts(self) -> dict:
+        return dict(self.db.query("SELECT statut, COUNT(*) FROM jobs GROUP BY statut"))
+
+    def submit(self, student_id: str, clinical_text: str, rubric: list, audio=None,
+               audio_ext: str = None, transcript: str = None, shard_size: int = None,
+               local: bool = False, evidence: bool = False, force: bool = False) -> int:
+        """Enregistre un travail (étape audio comprise) et renvoie son id.
+
+        `audio` est un fichier binaire ouvert (ou un fichier téléversé), copié par blocs dans
+        JOBS_AUDIO_DIR. Sans `force`, un travail identique (mêmes entrées et options) en cours ou terminé est
+        renvoyé tel quel : un double clic ou un rerun ne déclenche aucun nouvel appel.
+        """
+        if audio is None and not transcript:
+            raise ValueError("Ni audio ni transcription à évaluer")
+        options = {"shard_size": shard_size, "local": local, "evidence": evidence, "force": force}
+        audio_path = None
+        if audio is None:
+            source = hash_identification(transcript)
+        else:
+            # Nommé par le contenu : une même soumission ne duplique pas le fichier
+            audio_path, source = store_upload(audio, self.audio_dir, audio_ext)
+        cle = hash_identification(json.dumps(
+            [student_id, source, clinical_text, rubric, sharded_version(shard_size, local, evidence)],
+            ensure_ascii=False, sort_keys=True))
+        if not force:
+            existing = self._select("cle = ? AND statut != ? ORDER BY id DESC LIMIT 1", (cle, FAILED))
+            if existing:
+                if existing[0]["statut"] not in ACTIVE:
+                    self.release_audio({"id": None, "audio_path": audio_path})
+                return existing[0]["id"]
+
+        now = time.time()
+        with self.db.transaction() as conn:
+            return conn.execute('''
+                INSERT INTO jobs (id_etudiant, cle, statut, etape, options, cas_clinique, grille,
+                                  audio_path, transcription, jeton, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', (
+                student_id, cle, PENDING, "transcription" if transcript is None else "evaluation",
+                json.dumps(options), clinical_text, json.dumps(rubric, ensure_ascii=False),
+                audio_path, transcript if audio is None else None, uuid.uuid4().hex, now, now,
+            )).lastrowid
+
+    def claim(self, owner: str, job_ids: list[int]) -> dict:
+        """Prend le plus ancien travail en attente (ou abandonné par un pool disparu) parmi
+        `job_ids`, les travaux pour lesquels le pool a un client."""
+        now = time.time()
+        with self.db.transaction() as conn:
+            # Un travail qui a fait tomber son worker MAX_ATTEMPTS fois n'est plus repris
+            exhausted = conn.execute("SELECT id, audio_path FROM jobs WHERE statut = ? AND heartbeat < ? "
+                                     "AND tentatives >= ?", (RUNNING, now - LEASE_SECONDS, MAX_ATTEMPTS)).fetchall()
+            conn.execute("UPDATE jobs SET statut = ?, erreur = ?, updated_at = ? "
+                         "WHERE statut = ? AND heartbeat < ? AND tentatives >= ?",
+                         (FAILED, "Abandonné : le traitement s'est interrompu à chaque tentative",
+                          now, RUNNING, now - LEASE_SECONDS, MAX_ATTEMPTS))
+            row = conn.execute(f"SELECT id FROM jobs WHERE id IN ({', '.join('?' * len(job_ids))}) "
+                               "AND (statut = ? OR (statut = ? AND heartbeat < ?)) ORDER BY id LIMIT 1",
+                               (*job_ids, PENDING, RUNNING, now - LEASE_SECONDS)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE jobs SET statut = ?, proprietaire = ?, heartbeat = ?, updated_at = ?, "
+                             "tentatives = tentatives + 1, erreur = NULL WHERE id = ?",
+                             (RUNNING, owner, now, now, row[0]))
+        for job_id, audio_path in exhausted:
+            self.release_audio({"id": job_id, "audio_path": audio_path})
+        return self.get(row[0]) if row is not None else None
+
+    def checkpoint(self, job_id: int, owner: str, **fields):
+        """Sauvegarde le résultat d'une étape, si le travail appartient toujours à `owner`."""
+        for column in JSON_COLUMNS:
+            if column in fields:
+                fields[column] = json.dumps(fields[column], ensure_ascii=False)
+        now = time.time()
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        with self.db.transaction() as conn:
+            updated = conn.execute(f"UPDATE jobs SET {assignments}, heartbeat = ?, updated_at = ? "
+                                   "WHERE id = ? AND proprietaire = ? AND statut = ?",
+                                   (*fields.values(), now, now, job_id, owner, RUNNING)).rowcount
+        if not updated:
+            raise LeaseLost(job_id)
+
+    def heartbeat(self, owner: str):
+        with self.db.transaction() as conn:
+            conn.execute("UPDATE jobs SET heartbeat = ? WHERE proprietaire = ? AND statut = ?",
+                         (time.time(), owner, RUNNING))
+
+    def retry(self, job_id: int):
+        """Remet en file un travail en échec ; il repart de sa dernière étape terminée."""
+        with self.db.transaction() as conn:
+            conn.execute("UPDATE jobs SET statut = ?, erreur = NULL, tentatives = 0, updated_at = ? "
+                         "WHERE id = ? AND statut = ?", (PENDING, time.time(), job_id, FAILED))
+
+    def purge(self):
+        """Oublie les travaux terminés ou en échec (après db.purge, leurs runs n'existent plus)."""
+        with self.db.transaction() as conn:
+            paths = [row[0] for row in conn.execute("SELECT DISTINCT audio_path FROM jobs WHERE statut NOT IN (?, ?) "
+                                                    "AND audio_path IS NOT NULL", ACTIVE)]
+            conn.execute("DELETE FROM jobs WHERE statut NOT IN (?, ?)", ACTIVE)
+        for path in paths:
+            self.release_audio({"id": None, "audio_path": path})
+
+    def release_audio(self, job: dict):
+        """Supprime l'audio d'un travail terminé ou abandonné, sauf s'il sert encore à un autre
+        travail actif ou en échec qui peut être repris."""
+        path = job["audio_path"]
+        if path and not self.db.query("SELECT 1 FROM jobs WHERE audio_path = ? AND id IS NOT ? "
+                                      "AND (statut IN (?, ?) OR (statut = ? AND tentatives < ?)) LIMIT 1",
+                                      (path, job["id"], *ACTIVE, FAILED, MAX_ATTEMPTS)):
+            if os.path.exists(path):
+                os.remove(path)
+
+# ---------------------------
+# WORKERS
+# ---------------------------
+class JobPool:
+    """Threads qui exécutent les travaux de la file, étape par étape.
+
+    Chaque travail est exécuté avec le client OpenAI fourni à sa soumission (submit) ou
+    à sa reprise (retry, attach). Les clients restent en mémoire, jamais dans jobs.db :
+    un travail sans client dans ce processus (après un redémarrage) attend qu'on lui en
+    fournisse un.
+    """
+
+    def __init__(self, queue: JobQueue, db: Database, workers: int = JOB_WORKERS,
+                 transcription_cache=None, evaluation_cache=None, archive=None):
+        self.queue = queue
+        self.db = db
+        self.archive = archive
+        self.workers = workers
+        self.clients = {}  # id du travail -> client OpenAI de l'examinateur
+        self.clients_lock = threading.Lock()
+        self.transcription_cache = transcription_cache
+        self.evaluation_cache = evaluation_cache
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.threads = []
+
+    def start(self):
+        self.threads = [threading.Thread(target=self._loop, daemon=True, name=f"job-worker-{i}")
+                        for i in range(self.workers)]
+        self.threads.append(threading.Thread(target=self._heartbeat, daemon=True, name="job-heartbeat"))
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self, timeout: float = None):
+        self.stopping.set()
+        self.wakeup.set()
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def attach(self, job_id: int, client, replace: bool = False):
+        """Fournit le client d'un travail en file (sans remplacer celui qu'il a déjà, sauf `replace`)."""
+        job = self.queue.get(job_id)
+        if job is None or job["statut"] not in ACTIVE:
+            return
+        with self.clients_lock:
+            if replace:
+                self.clients[job_id] = client
+            else:
+                self.clients.setdefault(job_id, client)
+        self.wakeup.set()
+
+    def has_client(self, job_id: int) -> bool:
+        with self.clients_lock:
+            return job_id in self.clients
+
+    def submit(self, *args, client, **kwargs) -> int:
+        """Enregistre un travail (voir JobQueue.submit), exécuté avec `client`."""
+        job_id = self.queue.submit(*args, **kwargs)
+        self.attach(job_id, client)
+        return job_id
+
+    def retry(self, job_id: int, client):
+        """Remet en file un travail en échec, exécuté avec le client de l'examinateur qui le reprend."""
+        self.queue.retry(job_id)
+        self.attach(job_id, client, replace=True)
+
+    def _release(self, job: dict):
+        with self.clients_lock:
+            self.clients.pop(job["id"], None)
+
+    def _heartbeat(self):
+        while not self.stopping.wait(LEASE_SECONDS / 3):
+            self.queue.heartbeat(self.owner)
+
+    def _loop(self):
+        while not self.stopping.is_set():
+            with self.clients_lock:
+                job_ids = list(self.clients)
+            job = self.queue.claim(self.owner, job_ids) if job_ids else None
+            if job is None:
+                self.wakeup.wait(POLL_SECONDS)
+                self.wakeup.clear()
+                continue
+            try:
+                self.run(job)
+            except LeaseLost:
+                pass
+            except Exception as e:
+                try:
+                    self.queue.checkpoint(job["id"], self.owner, statut=FAILED, erreur=str(e) or repr(e))
+                except LeaseLost:
+                    continue
+                # Le client est redonné à la reprise ; l'audio est gardé tant qu'elle reste possible
+                self._release(job)
+                if job["tentatives"] >= MAX_ATTEMPTS:
+                    self.queue.release_audio(job)
+
+    def run(self, job: dict):
+        """Exécute les étapes restantes d'un travail, en sauvegardant chacune."""
+        save = lambda **fields: self.queue.checkpoint(job["id"], self.owner, **fields)
+        options = job["options"]
+        with self.clients_lock:
+            client = self.clients[job["id"]]
+        if job["transcription"] is None:
+            save(etape="transcription")
+            job["transcription"] = transcribe(client, job["audio_path"], cache=self.transcription_cache)
+            save(transcription=job["transcription"], etape="evaluation")
+
+        if job["resultat"] is None:
+            notes = []
+
+            def on_note(note):
+                notes.append(note)
+                save(notes=notes)
+
+            save(etape="evaluation", notes=[])
+            job["resultat"] = evaluate_transcript(
+                client, job["cas_clinique"], job["transcription"], job["grille"],
+                cache=self.evaluation_cache, force=options["force"], on_note=on_note,
+                shard_size=options["shard_size"], local=options["local"], evidence=options["evidence"])
+            save(resultat=job["resultat"], etape="enregistrement")
+
+        if job["run_id"] is None:
+            # jobs.db et evaluations.db sont deux bases : le lien jeton -> run est écrit dans
+            # la transaction du run, et une reprise après crash retrouve le run déjà enregistré
+            with metrics.stage("sqlite"), self.db.transaction() as conn:
+                row = conn.execute("SELECT run_id FROM travaux_runs WHERE jeton = ?", (job["jeton"],)).fetchone()
+                if row is None:
+                    run_id = save_evaluation(
+                        conn, job["id_etudiant"], job["resultat"], job["cas_clinique"], job["grille"],
+                        prompt_version=sharded_version(options["shard_size"], options["local"],
+                                                       options["evidence"]))
+                    conn.execute("INSERT INTO travaux_runs (jeton, run_id) VALUES (?, ?)", (job["jeton"], run_id))
+                job["run_id"] = row[0] if row is not None else run_id
+            save(run_id=job["run_id"])
+
+        # L'évaluation est enregistrée : un échec de l'archivage ne la remet pas en cause
+        warning = None
+        if self.archive is not None and job["audio_path"]:
+            try:
+                # Idempotent : une reprise après crash ne crée ni second blob ni second lien
+                self.archive.put(job["audio_path"], job["id_etudiant"], job["run_id"])
+            except Exception as e:
+                warning = f"Audio non archivé (conservé dans {job['audio_path']}) : {str(e) or repr(e)}"
+        save(statut=DONE, etape=DONE, erreur=warning)
+        self._release(job)
+        if warning is None:
+            self.queue.release_audio(job)
@@ -0,0 +1,150 @@
+# Évaluation Médicale IA - Transcription en direct pendant l'enregistrement (streamlit-webrtc)
+#
+# Les trames audio du navigateur arrivent côté serveur via WebRTC (mode
+# SENDONLY : elles sont relevées dans ctx.audio_receiver par live_recorder), sont
+# converties en mono 16 kHz et accumulées. Dès qu'un segment d'environ
+# SEGMENT_S secondes est disponible, il est coupé sur un silence et envoyé à
+# Whisper en arrière-plan pendant que l'étudiant continue de parler. À l'arrêt,
+# seul le dernier segment reste à transcrire.
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import av
+import numpy as np
+import streamlit as st
+from openai import OpenAI
+from streamlit_webrtc import WebRtcMode, webrtc_streamer
+
+from audio import (OVERLAP_S, SAMPLE_RATE, chunk_bounds, encode_opus, temp_audio_path,
+                   trim_silence, voiced_frames)
+from evaluation import LANGUAGE, stitch_transcripts, transcribe_chunk
+
+SEGMENT_S = 20.0
+MAX_WORKERS = 4
+RECEIVER_FRAMES = 512   # ~10 s de trames de 20 ms en attente de relève
+
+class LiveTranscriber:
+    """Accumule les trames reçues et transcrit des segments glissants en arrière-plan."""
+
+    def __init__(self, client: OpenAI, language: str = LANGUAGE, segment_s: float = SEGMENT_S):
+        self.client = client
+        self.language = language
+        self.segment_s = segment_s
+        self.resampler = av.AudioResampler(format="flt", layout="mono", rate=SAMPLE_RATE)
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_samples = 0
+        self.recorded_samples = 0
+        self.segments = []  # futures, dans l'ordre de l'enregistrement
+        self.pool = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+    def add_frames(self, frames: list[av.AudioFrame]):
+        """Appelé par live_recorder pour chaque lot de trames relevé dans audio_receiver."""
+        with self.lock:
+            for frame in frames:
+                for out in self.resampler.resample(frame):
+                    samples = out.to_ndarray().reshape(-1)
+                    self.pending.append(samples)
+                    self.pending_samples += len(samples)
+                    self.recorded_samples += len(samples)
+            if self.pending_samples >= (self.segment_s + OVERLAP_S) * SAMPLE_RATE:
+                self._cut_segment()
+
+    def _cut_segment(self):
+        samples = np.concatenate(self.pending)
+        bounds = chunk_bounds(samples, chunk_s=self.segment_s)
+        segment, rest = samples[:bounds[0][1]], samples[bounds[1][0]:]
+        self.segments.append(self.pool.submit(self._transcribe, segment))
+        self.pending, self.pending_samples = [rest], len(rest)
+
+    def _transcribe(self, samples: np.ndarray) -> str:
+        if not voiced_frames(samples).any():
+            return ""
+        path = temp_audio_path()
+        try:
+            encode_opus(trim_silence(samples), path)
+            return transcribe_chunk(self.client, path, self.language)
+        finally:
+            os.remove(path)
+
+    @property
+    def duration(self) -> float:
+        return self.recorded_samples / SAMPLE_RATE
+
+    def partial_text(self) -> str:
+        """Transcription des segments déjà terminés (dans l'ordre)."""
+        texts = []
+        for future in list(self.segments):
+            if not future.done() or future.exception():
+                break
+            texts.append(future.result())
+        return stitch_transcripts([t for t in texts if t])
+
+    def finish(self) -> str:
+        """Transcrit le dernier segment et renvoie la transcription complète."""
+        with self.lock:
+            if self.pending_samples:
+                self.segments.append(self.pool.submit(self._transcribe, np.concatenate(self.pending)))
+                self.pending, self.pending_samples = [], 0
+        try:
+            texts = [future.result() for future in self.segments]
+        finally:
+            self.pool.shutdown(wait=False)
+        return stitch_transcripts([t for t in texts if t])
+
+# ---------------------------
+# COMPOSANT STREAMLIT
+# ---------------------------
+def live_recorder(student_id: str, client: OpenAI):
+    """Enregistrement WebRTC avec transcription au fil de l'eau.
+
+    La transcription complète est placée dans `st.session_state.transcripts[student_id]`
+    quelques secondes après l'arrêt de l'enregistrement : changer d'étudiant ne reprend
+    jamais l'enregistrement ni la transcription du précédent.
+    """
+    transcripts = st.session_state.setdefault("transcripts", {})
+    transcribers = st.session_state.setdefault("live_transcribers", {})
+    transcriber = transcribers.get(student_id)
+    if transcriber is None:
+        transcriber = transcribers[student_id] = LiveTranscriber(client)
+
+    # En SENDONLY, streamlit-webrtc ne livre les trames qu'à ctx.audio_receiver
+    # (aucun callback n'est appelé) : la boucle ci-dessous les relève
+    ctx = webrtc_streamer(
+        key=f"live_{student_id}",
+        mode=WebRtcMode.SENDONLY,
+        media_stream_constraints={"audio": True, "video": False},
+        audio_receiver_size=RECEIVER_FRAMES,
+    )
+
+    if ctx.state.playing:
+        # Nouvel enregistrement : la transcription précédente de cet étudiant est écartée
+        transcripts[student_id] = ""
+        timer, live_text = st.empty(), st.empty()
+        shown_at = 0.0
+        while ctx.state.playing:
+            if ctx.audio_receiver is None:
+                time.sleep(0.1)
+            else:
+                try:
+                    transcriber.add_frames(ctx.audio_receiver.get_frames(timeout=1))
+                except queue.Empty:
+                    pass
+            if time.monotonic() - shown_at >= 1:
+                timer.caption(f"⏱️ Durée : {int(transcriber.duration // 60):02d}:"
+                              f"{int(transcriber.duration % 60):02d}")
+                live_text.info(transcriber.partial_text() or "🎙️ En écoute...")
+                shown_at = time.monotonic()
+    elif transcriber.recorded_samples:
+        with st.spinner("Finalisation de la transcription..."):
+            try:
+                transcripts[student_id] = transcriber.finish()
+                st.success("✅ Transcription réussie")
+            except Exception as e:
+                st.error(f"Erreur Whisper : {e}")
+            finally:
+                del transcribers[student_id]
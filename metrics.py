@@ -0,0 +1,240 @@
+# Évaluation Médicale IA - Mesures par étape (durée, audio, tokens, coût, réessais)
+#
+# Chaque étape (upload, whisper, gpt4, sqlite) est encadrée par `stage(...)` :
+# durée réelle, puis ce que les appels internes y ajoutent avec `record(...)`
+# (tokens renvoyés par l'API, réessais de with_backoff, durée d'audio). L'étape
+# courante suit le contexte (contextvars) : les tâches asyncio en héritent, les
+# threads la reçoivent avec `bind`. L'attente d'un créneau (`slot`, sémaphores
+# du pipeline asynchrone) n'est pas de la latence : le temps où l'étape ne fait
+# qu'attendre, sans requête en vol, est retiré de sa durée. Sans enregistreur
+# (set_recorder), rien n'est écrit ; sinon une ligne par étape dans metrics.db,
+# d'où sont tirés les percentiles p50/p95, l'export Prometheus (texte) et
+# l'export JSON.
+
+import contextvars
+import json
+import sqlite3
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+
+# À côté de evaluations.db ; db (et numpy) ne sont importés qu'à la création du MetricsStore :
+# evaluation.py, importé par db.py, s'instrumente avec ce module, et uploads.py reste léger
+METRICS_DB_PATH = "metrics.db"
+MAX_AGE_DAYS = 30
+QUANTILES = (0.5, 0.95)
+STAGES = ("upload", "whisper", "gpt4", "sqlite")
+
+# Tarifs en USD : (prompt, complétion) pour 1000 tokens ; Whisper à la minute d'audio
+TOKEN_PRICES = {"gpt-4": (0.03, 0.06), "gpt-4-turbo": (0.01, 0.03), "gpt-4o": (0.0025, 0.01),
+                "gpt-4o-mini": (0.00015, 0.0006)}
+WHISPER_PRICE_PER_MINUTE = 0.006
+
+METRICS_MIGRATIONS = [
+    (1, [
+        '''
+        CREATE TABLE mesures (
+            id INTEGER PRIMARY KEY,
+            etape TEXT NOT NULL,
+            debut REAL NOT NULL,
+            duree_s REAL NOT NULL,
+            modele TEXT,
+            audio_s REAL,
+            octets INTEGER,
+            prompt_tokens INTEGER,
+            completion_tokens INTEGER,
+            appels INTEGER,
+            reessais INTEGER,
+            cout_usd REAL,
+            cache INTEGER,
+            succes INTEGER
+        )''',
+        "CREATE INDEX idx_mesures_etape ON mesures(etape, debut)",
+        "CREATE INDEX idx_mesures_debut ON mesures(debut)",
+    ]),
+]
+
+COUNTERS = ("audio_s", "octets", "prompt_tokens", "completion_tokens", "appels", "reessais")
+
+class Span:
+    """Mesures d'une exécution d'étape ; `add` peut être appelé depuis plusieurs threads."""
+
+    def __init__(self, etape: str, modele: str = None):
+        self.etape = etape
+        self.modele = modele
+        self.debut = time.time()
+        self.duree_s = 0.0
+        self.cache = False
+        self.succes = True
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        self.lock = threading.Lock()
+        # Requêtes en attente d'un créneau / en vol ; attente_s : temps passé à attendre sans rien en vol
+        self.waiting = 0
+        self.in_flight = 0
+        self.idle_since = None
+        self.attente_s = 0.0
+
+    def add(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                self.counts[name] += value or 0
+
+    def track(self, waiting: int = 0, in_flight: int = 0):
+        with self.lock:
+            now = time.perf_counter()
+            if self.idle_since is not None:
+                self.attente_s += now - self.idle_since
+                self.idle_since = None
+            self.waiting += waiting
+            self.in_flight += in_flight
+            if self.waiting and not self.in_flight:
+                self.idle_since = now
+
+    @property
+    def cout_usd(self) -> float:
+        if self.etape == "whisper":
+            return self.counts["audio_s"] / 60 * WHISPER_PRICE_PER_MINUTE
+        prompt, completion = TOKEN_PRICES.get(self.modele, (0.0, 0.0))
+        return (self.counts["prompt_tokens"] * prompt + self.counts["completion_tokens"] * completion) / 1000
+
+_current = contextvars.ContextVar("metrics_span", default=None)
+_recorder = None
+
+def set_recorder(recorder):
+    """Active (MetricsStore) ou désactive (None) l'enregistrement des étapes pour le processus."""
+    global _recorder
+    _recorder = recorder
+
+@contextmanager
+def stage(etape: str, modele: str = None):
+    span = Span(etape, modele)
+    token = _current.set(span)
+    start = time.perf_counter()
+    try:
+        yield span
+    except BaseException:
+        span.succes = False
+        raise
+    finally:
+        span.track()
+        span.duree_s = time.perf_counter() - start - span.attente_s
+        _current.reset(token)
+        if _recorder is not None:
+            try:
+                _recorder.record(span)
+            except sqlite3.Error:
+                pass   # une mesure perdue ne doit pas faire échouer l'étape mesurée
+
+@asynccontextmanager
+async def slot(semaphore):
+    """Acquiert un créneau de `semaphore` (None : sans limite) pour une requête de l'étape courante."""
+    span = _current.get()
+    if semaphore is None or span is None:
+        async with semaphore or nullcontext():
+            yield
+        return
+    span.track(waiting=1)
+    try:
+        await semaphore.acquire()
+    except BaseException:
+        span.track(waiting=-1)
+        raise
+    span.track(waiting=-1, in_flight=1)
+    try:
+        yield
+    finally:
+        semaphore.release()
+        span.track(in_flight=-1)
+
+def record(**counts):
+    """Ajoute des compteurs (tokens, réessais...) à l'étape en cours, s'il y en a une."""
+    span = _current.get()
+    if span is not None:
+        span.add(**counts)
+
+def record_usage(response):
+    """Tokens consommés par une réponse (ou le dernier fragment d'un flux) de l'API."""
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        record(prompt_tokens=getattr(usage, "prompt_tokens", 0),
+               completion_tokens=getattr(usage, "completion_tokens", 0))
+
+def mark_cached():
+    span = _current.get()
+    if span is not None:
+        span.cache = True
+
+def bind(fn):
+    """Enveloppe `fn` pour qu'exécutée dans un autre thread, elle compte pour l'étape courante."""
+    span = _current.get()
+
+    def run(*args, **kwargs):
+        token = _current.set(span)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current.reset(token)
+    return run
+
+# ---------------------------
+# STOCKAGE ET EXPORTS
+# ---------------------------
+class MetricsStore:
+    """Une ligne par étape exécutée, dans metrics.db (purgée au-delà de MAX_AGE_DAYS)."""
+
+    def __init__(self, path: str = METRICS_DB_PATH, max_age_days: float = MAX_AGE_DAYS):
+        from db import Database
+        self.db = Database(path, METRICS_MIGRATIONS)
+        with self.db.transaction() as conn:
+            conn.execute("DELETE FROM mesures WHERE debut < ?", (time.time() - max_age_days * 86400,))
+
+    def record(self, span: Span):
+        values = (span.etape, span.debut, span.duree_s, span.modele, *span.counts.values(),
+                  span.cout_usd, int(span.cache), int(span.succes))
+        with self.db.transaction() as conn:
+            conn.execute(f"INSERT INTO mesures (etape, debut, duree_s, modele, {', '.join(COUNTERS)}, "
+                         f"cout_usd, cache, succes) VALUES ({', '.join('?' * len(values))})", values)
+
+    def summary(self, since: float = None) -> dict:
+        """Par étape : nombre, p50/p95 de la durée, totaux (audio, tokens, réessais, coût)."""
+        import numpy as np
+        rows = self.db.query(
+            f"SELECT etape, duree_s, {', '.join(COUNTERS)}, cout_usd, cache, succes FROM mesures "
+            "WHERE debut >= ? ORDER BY etape", (since or 0,))
+        summary = {}
+        for etape in dict.fromkeys(row[0] for row in rows):
+            values = np.array([row[1:] for row in rows if row[0] == etape], dtype=float)
+            durations = values[:, 0]
+            p50, p95 = np.quantile(durations, QUANTILES)
+            totals = values[:, 1:].sum(axis=0)
+            summary[etape] = {
+                "n": len(values), "p50_s": float(p50), "p95_s": float(p95), "total_s": float(durations.sum()),
+                **{name: float(total) for name, total in zip((*COUNTERS, "cout_usd", "cache"), totals)},
+                "echecs": int(len(values) - totals[-1]),
+            }
+        return summary
+
+    def to_json(self, since: float = None) -> str:
+        return json.dumps({"depuis": since, "etapes": self.summary(since)}, ensure_ascii=False, indent=2)
+
+    def to_prometheus(self, since: float = None) -> str:
+        """Format texte d'exposition Prometheus (résumés par étape et compteurs)."""
+        summary = self.summary(since)
+        lines = ["# HELP ecos_stage_duration_seconds Durée des étapes (upload, whisper, gpt4, sqlite)",
+                 "# TYPE ecos_stage_duration_seconds summary"]
+        for etape, s in summary.items():
+            lines += [f'ecos_stage_duration_seconds{{stage="{etape}",quantile="0.5"}} {s["p50_s"]}',
+                      f'ecos_stage_duration_seconds{{stage="{etape}",quantile="0.95"}} {s["p95_s"]}',
+                      f'ecos_stage_duration_seconds_sum{{stage="{etape}"}} {s["total_s"]}',
+                      f'ecos_stage_duration_seconds_count{{stage="{etape}"}} {s["n"]}']
+        counters = [("ecos_audio_seconds_total", "audio_s", "Durée d'audio transcrite"),
+                    ("ecos_prompt_tokens_total", "prompt_tokens", "Tokens de prompt"),
+                    ("ecos_completion_tokens_total", "completion_tokens", "Tokens de complétion"),
+                    ("ecos_api_calls_total", "appels", "Appels API"),
+                    ("ecos_retries_total", "reessais", "Réessais sur erreur transitoire"),
+                    ("ecos_cost_usd_total", "cout_usd", "Coût estimé (USD)"),
+                    ("ecos_stage_failures_total", "echecs", "Étapes terminées en erreur")]
+        for metric, field, help_text in counters:
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+            lines += [f'{metric}{{stage="{etape}"}} {s[field]}' for etape, s in summary.items()]
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,188 @@
+# Évaluation Médicale IA - Pipeline asynchrone Whisper + GPT-4
+#
+# Chaque étudiant passe par deux étapes (transcription puis évaluation).
+# Chaque étape dispose de son propre sémaphore : la transcription de
+# l'étudiant k+1 se fait pendant l'évaluation de l'étudiant k, et au plus
+# `concurrency` requêtes sont en vol par étape. Le prétraitement audio (CPU)
+# a ses propres créneaux, au plus un par cœur.
+
+import asyncio
+import os
+from typing import Callable, Optional
+
+from openai import AsyncOpenAI
+from pydantic import BaseModel
+
+import metrics
+from audio import prepare_chunks
+from evidence import EvidenceIndex
+from evaluation import (GPT_MODEL, LANGUAGE, MAX_TOKENS, TEMPERATURE, WHISPER_MODEL, EvaluationResult,
+                        awith_backoff, build_prompt, cached_result, evaluation_plan, evaluation_steps,
+                        hash_file, plan_shards, prepare_sharded, require_rubric, response_format,
+                        shard_steps, stitch_transcripts, summary_steps)
+
+DEFAULT_CONCURRENCY = 8
+
+# ---------------------------
+# APPELS OPENAI ASYNCHRONES
+# ---------------------------
+async def _awhisper(client: AsyncOpenAI, path: str, language: str, slots: asyncio.Semaphore = None) -> str:
+    async def call():
+        with open(path, "rb") as f:
+            return await client.audio.transcriptions.create(
+                model=WHISPER_MODEL,
+                file=f,
+                language=language
+            )
+    async with metrics.slot(slots):
+        metrics.record(appels=1)
+        transcript = await awith_backoff(call)
+    return transcript.text
+
+async def atranscribe(client: AsyncOpenAI, audio_path: str, language: str = LANGUAGE, cache=None,
+                      preprocess: bool = True, slots: asyncio.Semaphore = None,
+                      prepare_slots: asyncio.Semaphore = None) -> str:
+    """Version asynchrone de evaluation.transcribe ; `slots` borne les requêtes Whisper simultanées
+    (chaque segment d'un long enregistrement compte pour une requête), `prepare_slots` les prétraitements."""
+    with metrics.stage("whisper", WHISPER_MODEL):
+        if cache is not None:
+            audio_hash = hash_file(audio_path)
+            text = cache.get(audio_hash, WHISPER_MODEL, language)
+            if text is not None:
+                metrics.mark_cached()
+                return text
+        # Le prétraitement (décodage, numpy) est fait hors de la boucle d'événements
+        async with metrics.slot(prepare_slots):
+            chunk_paths, duration = await asyncio.to_thread(prepare_chunks, audio_path) if preprocess \
+                else ([audio_path], 0.0)
+        metrics.record(audio_s=duration)
+        try:
+            texts = await asyncio.gather(*(_awhisper(client, path, language, slots) for path in chunk_paths))
+        finally:
+            for path in chunk_paths:
+                if path != audio_path:
+                    os.remove(path)
+        text = stitch_transcripts(list(texts))
+        if cache is not None:
+            cache.put(audio_hash, WHISPER_MODEL, language, text)
+        return text
+
+async def _acreate(client: AsyncOpenAI, messages: list[dict], max_tokens: int = MAX_TOKENS,
+                   schema: type[BaseModel] = EvaluationResult):
+    fmt = response_format(schema=schema) if schema else None
+    metrics.record(appels=1)
+    response = await awith_backoff(client.chat.completions.create, model=GPT_MODEL, messages=messages,
+                                   temperature=TEMPERATURE, max_tokens=max_tokens,
+                                   **({"response_format": fmt} if fmt else {}))
+    metrics.record_usage(response)
+    return response
+
+async def arun_steps(steps, send):
+    """Version asynchrone de evaluation.run_steps (`send` est une coroutine)."""
+    try:
+        request = next(steps)
+        while True:
+            request = steps.send(await send(*request))
+    except StopIteration as done:
+        return done.value
+
+def asender(client: AsyncOpenAI, slots: asyncio.Semaphore = None):
+    """Chaque requête occupe un créneau de `slots` le temps de l'appel."""
+    async def send(messages: list[dict], max_tokens: int, schema: type[BaseModel]) -> str:
+        async with metrics.slot(slots):
+            response = await _acreate(client, messages, max_tokens, schema)
+        return response.choices[0].message.content or ""
+    return send
+
+async def aevaluate(client: AsyncOpenAI, messages: list[dict], max_tokens: int = MAX_TOKENS,
+                    schema: type[BaseModel] = EvaluationResult, slots: asyncio.Semaphore = None) -> dict:
+    """Version asynchrone de evaluation.evaluate (même réparation ciblée, mêmes réessais)."""
+    return await arun_steps(evaluation_steps(messages, max_tokens, schema), asender(client, slots))
+
+# ---------------------------
+# PIPELINE
+# ---------------------------
+class Pipeline:
+    """Limite le nombre de requêtes simultanées par étape (Whisper, GPT-4)."""
+
+    def __init__(self, client: AsyncOpenAI, concurrency: int = DEFAULT_CONCURRENCY, cache=None,
+                 evaluation_cache=None, force: bool = False, shard_size: int = None,
+                 local: bool = False, evidence: bool = False):
+        self.client = client
+        self.cache = cache
+        self.evaluation_cache = evaluation_cache
+        self.force = force
+        self.shard_size = shard_size
+        self.local = local
+        self.evidence = evidence
+        self.whisper_slots = asyncio.Semaphore(concurrency)
+        self.gpt_slots = asyncio.Semaphore(concurrency)
+        self.prepare_slots = asyncio.Semaphore(min(concurrency, os.cpu_count() or 1))
+
+    async def transcribe(self, audio_path: str) -> str:
+        return await atranscribe(self.client, audio_path, cache=self.cache, slots=self.whisper_slots,
+                                 prepare_slots=self.prepare_slots)
+
+    async def evaluate(self, messages: list[dict], max_tokens: int = MAX_TOKENS,
+                       schema: type[BaseModel] = EvaluationResult) -> dict:
+        return await aevaluate(self.client, messages, max_tokens, schema, self.gpt_slots)
+
+    async def evaluate_sharded(self, clinical_text: str, transcript_text: str, rubric: list,
+                               shard_size: int, decided: dict = None,
+                               index: EvidenceIndex = None) -> dict:
+        """Version asynchrone de evaluation.evaluate_sharded (chaque requête occupe un créneau GPT-4)."""
+        send = asender(self.client, self.gpt_slots)
+        rubric, found, shards = plan_shards(rubric, shard_size, decided)
+        steps = [shard_steps(clinical_text, transcript_text, shard, index) for shard in shards]
+        for notes in await asyncio.gather(*(arun_steps(shard, send) for shard in steps)):
+            found.update((note["id"], note) for note in notes)
+        return await arun_steps(summary_steps(clinical_text, transcript_text, rubric, found), send)
+
+    async def process_student(self, audio_path: str, clinical_text: str, rubric: list) -> dict:
+        require_rubric(rubric)
+        transcript_text = await self.transcribe(audio_path)
+        with metrics.stage("gpt4", GPT_MODEL):
+            key, shard_size = evaluation_plan(clinical_text, transcript_text, rubric, self.shard_size,
+                                              self.local, self.evidence)
+            result = cached_result(self.evaluation_cache, key, self.force)
+            if result is not None:
+                return result
+            if shard_size:
+                # Pré-notation et index des extraits (numpy/scipy) hors de la boucle d'événements
+                decided, index = await asyncio.to_thread(prepare_sharded, rubric, transcript_text,
+                                                         self.local, self.evidence)
+                result = await self.evaluate_sharded(clinical_text, transcript_text, rubric, shard_size,
+                                                     decided, index)
+            else:
+                result = await self.evaluate(build_prompt(clinical_text, transcript_text, rubric))
+            if self.evaluation_cache is not None:
+                self.evaluation_cache.put(key, result)
+            return result
+
+    async def run(self, audio_files: list[str], clinical_text: str, rubric: list,
+                  on_done: Optional[Callable[[str, Optional[dict], Optional[Exception]], None]] = None) -> dict:
+        """Traite tous les fichiers ; `on_done(path, result, error)` est appelé dès qu'un étudiant est terminé."""
+        async def one(path):
+            try:
+                result, error = await self.process_student(path, clinical_text, rubric), None
+            except Exception as e:
+                result, error = None, e
+            if on_done:
+                on_done(path, result, error)
+            return path, result if error is None else error
+
+        return dict(await asyncio.gather(*(one(path) for path in audio_files)))
+
+def run_pipeline(audio_files: list[str], clinical_text: str, rubric: list,
+                 concurrency: int = DEFAULT_CONCURRENCY, client: Optional[AsyncOpenAI] = None,
+                 on_done=None, cache=None, evaluation_cache=None, force: bool = False,
+                 shard_size: int = None, local: bool = False, evidence: bool = False) -> dict:
+    """Point d'entrée synchrone (CLI, Streamlit) : exécute le pipeline dans une boucle dédiée."""
+    async def main():
+        if client is not None:
+            pipeline = Pipeline(client, concurrency, cache, evaluation_cache, force, shard_size, local, evidence)
+            return await pipeline.run(audio_files, clinical_text, rubric, on_done)
+        async with AsyncOpenAI() as c:
+            pipeline = Pipeline(c, concurrency, cache, evaluation_cache, force, shard_size, local, evidence)
+            return await pipeline.run(audio_files, clinical_text, rubric, on_done)
+    return asyncio.run(main())
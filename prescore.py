@@ -0,0 +1,138 @@
+# Évaluation Médicale IA - Pré-notation locale des critères (sans appel GPT-4)
+#
+# Beaucoup de critères de la grille_observation sont des vérifications
+# littérales ("Demande une NFS", "Prescrit du paracétamol") : la transcription
+# les mentionne ou non. Chaque critère est comparé aux phrases de la
+# transcription par TF-IDF sur trigrammes de caractères (tolérant aux fautes
+# de Whisper) et par couverture floue de ses termes, le tout en matrices
+# creuses scipy. Seuls les critères clairement mentionnés sont notés
+# localement (1, avec l'extrait qui sert de preuve) ; tout le reste part chez
+# GPT-4 : un critère absent mot pour mot peut avoir été dit autrement ("prise
+# de sang" pour "bilan biologique"), et une négation ("ne prescrit pas")
+# inverse le sens d'une phrase qui reprend les termes du critère.
+
+import re
+import unicodedata
+
+import numpy as np
+from scipy import sparse
+
+# À incrémenter à chaque changement des seuils ou des listes de mots (clé du cache)
+PRESCORE_VERSION = "2"
+MAX_LITERAL_TERMS = 6      # au-delà, le critère relève du jugement : toujours GPT-4
+FUZZY_THRESHOLD = 0.7      # similarité (trigrammes) pour qu'un mot vaille un terme du critère
+PRESENT_COVERAGE = 0.8     # part des termes retrouvés dans une même phrase pour noter 1
+PRESENT_SIMILARITY = 0.3   # similarité TF-IDF minimale de cette phrase
+
+# Mots vides du français et verbes de consigne des grilles ("Recherche une fièvre")
+STOPWORDS = set("""
+a au aux avec ce ces cet cette dans de des du elle en et eux il ils je la le les leur leurs lui
+ma mais me mes moi mon nos notre nous on ou par pour qu que qui sa se ses son sur ta te
+tes toi ton tu un une vos votre vous est sont etre avoir fait faire bien plus tres tout tous
+toute toutes comme si oui donc alors aussi avez avoir etes suis cela ca ici
+recherche rechercher demande demander explique expliquer prescrit prescrire propose proposer
+evoque evoquer cite citer mentionne mentionner interroge interroger examine examiner realise
+realiser presente presenter pose poser precise preciser informe informer annonce annoncer
+identifie identifier elimine eliminer rassure rassurer verifie verifier patient patiente
+""".split())
+
+# Marques de négation : gardées dans les termes, et un critère ou une phrase qui en contient
+# n'est jamais noté localement
+NEGATIONS = {"ne", "n", "pas", "non", "sans", "aucun", "aucune", "jamais", "ni", "rien", "nul", "nulle"}
+
+def _normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+def terms(text: str) -> list[str]:
+    """Mots porteurs de sens, sans accents ni mots vides (les sigles courts sont gardés)."""
+    words = re.findall(r"[a-z0-9]+", _normalize(text))
+    return [w for w in words if w not in STOPWORDS and (len(w) >= 3 or w.isdigit())]
+
+def has_negation(text: str) -> bool:
+    return any(w in NEGATIONS for w in re.findall(r"[a-z0-9]+", _normalize(text)))
+
+def split_sentences(text: str) -> list[tuple[int, int]]:
+    """Bornes (début, fin) des phrases de `text`."""
+    return [(m.start(), m.end()) for m in re.finditer(r"[^\s.!?][^.!?\n]*[.!?]*", text)]
+
+def _trigrams(word: str) -> list[str]:
+    padded = f" {word} "
+    return [padded[i:i + 3] for i in range(len(padded) - 2)]
+
+def _trigram_matrix(docs: list[list[str]], vocabulary: dict) -> sparse.csr_matrix:
+    """Comptes de trigrammes (lignes = documents) sur un vocabulaire partagé."""
+    rows, cols = [], []
+    for row, words in enumerate(docs):
+        for word in words:
+            for gram in _trigrams(word):
+                rows.append(row)
+                cols.append(vocabulary.setdefault(gram, len(vocabulary)))
+    data = np.ones(len(rows), dtype=np.float64)
+    return sparse.csr_matrix((data, (rows, cols)), shape=(len(docs), len(vocabulary) or 1))
+
+def _l2_normalize(matrix: sparse.csr_matrix) -> sparse.csr_matrix:
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.0
+    return sparse.diags(1.0 / norms) @ matrix
+
+def _tfidf(counts: sparse.csr_matrix) -> sparse.csr_matrix:
+    df = np.bincount(counts.indices, minlength=counts.shape[1])
+    idf = np.log((1 + counts.shape[0]) / (1 + df)) + 1.0
+    return _l2_normalize(counts @ sparse.diags(idf))
+
+def tfidf_similarity(queries: list[list[str]], docs: list[list[str]]) -> np.ndarray:
+    """Similarité cosinus TF-IDF (trigrammes, idf commun) de chaque requête à chaque document."""
+    weighted = _tfidf(_trigram_matrix(docs + queries, {}))
+    return (weighted[len(docs):] @ weighted[:len(docs)].T).toarray()
+
+def prescore(rubric: list[dict], transcript_text: str) -> tuple[dict, list[dict]]:
+    """Renvoie ({id: note décidée localement}, [critères ambigus à confier à GPT-4]).
+
+    Seuls les critères retrouvés dans une phrase sans négation sont notés localement (1),
+    avec leur preuve : {"debut", "fin", "extrait"} dans la transcription.
+    """
+    spans = split_sentences(transcript_text)
+    sentences = [terms(transcript_text[start:end]) for start, end in spans]
+    criteria = [terms(item.get("critère", "")) for item in rubric]
+    if not any(sentences):
+        return {}, list(rubric)
+
+    # 1. Similarité TF-IDF critère × phrase
+    similarity = tfidf_similarity(criteria, sentences)
+
+    # 2. Couverture floue : terme du critère ↔ mot de la transcription, puis mot ↔ phrase
+    words = sorted({w for sentence in sentences for w in sentence})
+    word_index = {w: i for i, w in enumerate(words)}
+    flat_terms = [t for crit in criteria for t in crit]
+    vectors = _l2_normalize(_trigram_matrix([[t] for t in flat_terms + words], {}))
+    term_word = (vectors[:len(flat_terms)] @ vectors[len(flat_terms):].T) >= FUZZY_THRESHOLD
+    word_sentence = sparse.csr_matrix(
+        (np.ones(sum(len(set(s)) for s in sentences)),
+         ([word_index[w] for s in sentences for w in set(s)],
+          [i for i, s in enumerate(sentences) for _ in set(s)])),
+        shape=(len(words), len(sentences)))
+    term_in_sentence = ((term_word.astype(np.float64) @ word_sentence).toarray() > 0)
+    negated = [has_negation(transcript_text[start:end]) for start, end in spans]
+
+    decided, ambiguous, offset = {}, [], 0
+    for row, (item, crit) in enumerate(zip(rubric, criteria)):
+        block = slice(offset, offset + len(crit))
+        offset += len(crit)
+        if not crit or len(crit) > MAX_LITERAL_TERMS or has_negation(item.get("critère", "")):
+            ambiguous.append(item)
+            continue
+        coverage = term_in_sentence[block].mean(axis=0)
+        best = int(np.lexsort((similarity[row], coverage))[-1])
+        if (coverage[best] >= PRESENT_COVERAGE and similarity[row, best] >= PRESENT_SIMILARITY
+                and not negated[best]):
+            start, end = spans[best]
+            excerpt = transcript_text[start:end].strip()
+            decided[item["id"]] = {
+                "id": item["id"], "critère": item.get("critère", ""), "score": 1,
+                "justification": f"Mentionné par l'étudiant : « {excerpt} »",
+                "preuve": {"debut": start, "fin": end, "extrait": excerpt}, "local": True,
+            }
+        else:
+            ambiguous.append(item)
+    return decided, ambiguous
@@ -0,0 +1,60 @@
+# Évaluation Médicale IA - Construction des messages GPT-4 et budget de tokens
+#
+# Les messages sont ordonnés du plus stable au plus variable : consignes,
+# cas clinique et grille forment un préfixe identique octet pour octet d'un
+# étudiant à l'autre (mis en cache côté fournisseur), la transcription vient
+# en dernier. Les tokens sont estimés localement et les entrées trop longues
+# sont tronquées avant l'envoi pour ne jamais dépasser la fenêtre du modèle.
+
+import json
+import math
+
+CONTEXT_TOKENS = {"gpt-4": 8192, "gpt-4-turbo": 128000, "gpt-4o": 128000, "gpt-4o-mini": 128000}
+DEFAULT_CONTEXT_TOKENS = 8192
+COMPLETION_TOKENS = 1500
+MESSAGE_OVERHEAD = 4      # tokens de structure par message (rôle, séparateurs)
+CHARS_PER_TOKEN = 3.0     # estimation prudente pour du français (accents, ponctuation)
+PREFIX_SHARE = 0.5        # part maximale du budget laissée au cas clinique + grille
+TRUNCATION_MARK = "\n[...] (passage tronqué : entrée trop longue) [...]\n"
+
+def estimate_tokens(text: str) -> int:
+    """Estimation locale (sans tokenizer) du nombre de tokens de `text`, arrondie au-dessus."""
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Ramène `text` à `max_tokens` en gardant le début et la fin (la conclusion d'une
+    réponse orale compte autant que son introduction)."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    keep = max(0, int(max_tokens * CHARS_PER_TOKEN) - len(TRUNCATION_MARK))
+    head = keep * 2 // 3
+    return text[:head] + TRUNCATION_MARK + text[len(text) - (keep - head):]
+
+def dump_rubric(rubric: list) -> str:
+    """Sérialisation déterministe de la grille (préfixe stable)."""
+    return json.dumps(rubric, ensure_ascii=False, separators=(", ", ": "))
+
+def messages_tokens(messages: list[dict]) -> int:
+    return sum(estimate_tokens(m["content"]) + MESSAGE_OVERHEAD for m in messages)
+
+def build_messages(instructions: str, clinical_text: str, rubric: list, student_text: str,
+                   model: str = "gpt-4", completion_tokens: int = COMPLETION_TOKENS,
+                   student_label: str = "Réponse de l'étudiant") -> list[dict]:
+    """Messages [system, user] : préfixe stable (consignes, cas, grille) puis transcription.
+
+    Le budget est la fenêtre du modèle moins les tokens réservés à la réponse. Le cas
+    clinique est tronqué s'il dépasse PREFIX_SHARE du budget (la grille ne l'est jamais),
+    puis la transcription reçoit tout ce qui reste.
+    """
+    budget = CONTEXT_TOKENS.get(model, DEFAULT_CONTEXT_TOKENS) - completion_tokens - 2 * MESSAGE_OVERHEAD
+    grid = f"\n\nGrille d'évaluation :\n{dump_rubric(rubric)}"
+    head = f"{instructions.strip()}\n\nCas clinique :\n"
+    case_budget = max(0, int(budget * PREFIX_SHARE) - estimate_tokens(head + grid))
+    system = head + truncate_to_tokens(clinical_text.strip(), case_budget) + grid
+
+    header = f"{student_label} :\n"
+    student_budget = budget - estimate_tokens(system) - estimate_tokens(header)
+    if student_budget <= 0:
+        raise ValueError("Grille d'évaluation trop longue pour la fenêtre du modèle")
+    user = header + truncate_to_tokens(student_text.strip(), student_budget)
+    return [{"role": "system", "content": system}, {"role": "user", "content": user}]
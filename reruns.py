@@ -0,0 +1,116 @@
+# Évaluation Médicale IA - Budget de temps des reruns Streamlit
+#
+# Usage :
+#   python reruns.py                      (toutes les apps, code de sortie 1 hors budget)
+#   python reruns.py app4.py --compare benchmarks/20261001-120000-reruns-1b413ea.json
+#
+# Chaque interaction ré-exécute tout le script d'une app : ce coût doit rester
+# faible. Pour chaque app, dans un processus neuf et un dossier vide, on mesure
+# le premier affichage (imports à froid, migrations, ressources mises en cache)
+# puis RERUNS reruns (streamlit.testing). Ce module n'importe que la
+# bibliothèque standard : le processus mesuré ne charge rien d'avance. Le
+# rapport JSON (même format d'un commit à l'autre) va dans BENCH_DIR.
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BENCH_DIR = "benchmarks"
+REPORT_VERSION = 1
+APPS = ("app.py", "app2.py", "app3.py", "app4.py")
+RERUNS = 10
+# Budget en ms (mesuré avec AppTest) : premier affichage dans un processus neuf et rerun médian
+RERUN_BUDGET_MS = {"premier": 1000, "rerun": 75}
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+def rerun_times(app_path: str, reruns: int = RERUNS) -> dict:
+    """Premier affichage puis `reruns` reruns de l'app, dans le processus courant."""
+    from streamlit.testing.v1 import AppTest
+    start = time.perf_counter()
+    at = AppTest.from_file(app_path, default_timeout=60).run()
+    first = time.perf_counter() - start
+    durations = []
+    for _ in range(reruns):
+        start = time.perf_counter()
+        at.run()
+        durations.append(time.perf_counter() - start)
+    return {"app": os.path.basename(app_path), "premier_ms": first * 1000,
+            "rerun_p50_ms": statistics.median(durations) * 1000, "rerun_max_ms": max(durations) * 1000,
+            "erreurs": [str(e.value) for e in at.exception]}
+
+def measure(app: str, reruns: int = RERUNS, budget: dict = RERUN_BUDGET_MS) -> dict:
+    """Mesure une app dans un processus neuf, depuis un dossier temporaire (bases créées
+    et migrées au premier affichage, comme au déploiement)."""
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, (ROOT, os.environ.get("PYTHONPATH"))))}
+    with tempfile.TemporaryDirectory(prefix="eval-med-reruns-") as workdir:
+        child = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", os.path.join(ROOT, app),
+                                "--reruns", str(reruns)],
+                               cwd=workdir, env=env, capture_output=True, text=True)
+    if child.returncode != 0:
+        raise RuntimeError(f"{app} : {child.stderr.strip().splitlines()[-1:]}")
+    result = json.loads(child.stdout.strip().splitlines()[-1])
+    result["dans_budget"] = (not result["erreurs"] and result["premier_ms"] <= budget["premier"]
+                             and result["rerun_p50_ms"] <= budget["rerun"])
+    return result
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=ROOT, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def format_result(result: dict) -> str:
+    status = "✅" if result["dans_budget"] else "❌"
+    errors = f"  erreurs : {result['erreurs']}" if result["erreurs"] else ""
+    return (f"{status} {result['app']:<8} premier {result['premier_ms']:6.0f} ms  "
+            f"rerun p50 {result['rerun_p50_ms']:5.1f} ms  max {result['rerun_max_ms']:5.1f} ms{errors}")
+
+def compare(report: dict, baseline: dict) -> list[str]:
+    old = {r["app"]: r for r in baseline["resultats"]}
+    change = lambda new, before: f"{(new - before) / before * 100:+.0f} %" if before else "n/a"
+    return [f"{r['app']:<8} premier {change(r['premier_ms'], old[r['app']]['premier_ms'])}  "
+            f"rerun p50 {change(r['rerun_p50_ms'], old[r['app']]['rerun_p50_ms'])}"
+            for r in report["resultats"] if r["app"] in old]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Temps de premier affichage et de rerun des apps Streamlit")
+    parser.add_argument("apps", nargs="*", default=list(APPS), help="Apps à mesurer (défaut : toutes)")
+    parser.add_argument("--reruns", type=int, default=RERUNS, help="Reruns mesurés par app")
+    parser.add_argument("--out", default=None, help=f"Rapport JSON (défaut : {BENCH_DIR}/<date>-reruns-<commit>.json)")
+    parser.add_argument("--compare", default=None, help="Rapport JSON précédent à comparer")
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        # Processus mesuré : le résultat est la dernière ligne de la sortie standard
+        print(json.dumps(rerun_times(args.child, args.reruns)))
+        return 0
+
+    results = []
+    for app in args.apps:
+        results.append(measure(app, args.reruns))
+        print(format_result(results[-1]), flush=True)
+    commit = git_commit()
+    report = {"version": REPORT_VERSION, "date": datetime.now().isoformat(timespec="seconds"),
+              "commit": commit, "python": sys.version.split()[0], "budget_ms": RERUN_BUDGET_MS,
+              "resultats": results}
+    out = args.out or os.path.join(BENCH_DIR, f"{datetime.now():%Y%m%d-%H%M%S}-reruns-{commit or 'local'}.json")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"📄 Rapport : {out}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print("\n".join(compare(report, json.load(f))))
+    return 0 if all(result["dans_budget"] for result in results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
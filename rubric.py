@@ -0,0 +1,146 @@
+# Évaluation Médicale IA - Compilation des grilles d'évaluation (DOCX et JSON)
+#
+# Une grille téléversée (Word ou JSON) est compilée une seule fois en un
+# objet Rubric compact et validé : critères numérotés (C1, C2...) avec leur
+# pondération, et barèmes de synthèse / prise en charge. Le résultat est mis
+# en cache par hash du contenu : re-téléverser la même grille ne coûte rien.
+
+import hashlib
+import io
+import json
+import re
+from collections import OrderedDict
+
+from pydantic import BaseModel, Field, ValidationError
+
+CACHE_SIZE = 64
+
+# Numérotation ou pondération en tête de ligne : "1.", "2)", "3 -", "2 pts", "1 point :"
+DOCX_ITEM = re.compile(
+    r"^\s*(?P<token>\d+(?:[.,]\d+)?\s*(?P<unit>pts?|points?)?)\s*[.):\-–]?\s+(?P<text>\S.*)$",
+    re.IGNORECASE,
+)
+LABEL_KEYS = ("critère", "critere", "libelle", "libellé", "item", "description", "intitule", "intitulé")
+POINT_KEYS = ("points", "point", "pts", "bareme", "barème", "score")
+
+class RubricError(ValueError):
+    """Grille illisible ou sans critère."""
+
+# ---------------------------
+# MODÈLE
+# ---------------------------
+class Criterion(BaseModel):
+    id: str
+    libelle: str = Field(min_length=1)
+    points: float = Field(default=1.0, ge=0)
+
+class Rubric(BaseModel):
+    hash: str
+    criteres: list[Criterion] = Field(min_length=1)
+    synthese: dict[str, str] = {}
+    prise_en_charge: dict[str, str] = {}
+
+    @property
+    def total_points(self) -> float:
+        return sum(c.points for c in self.criteres)
+
+    def to_list(self) -> list[dict]:
+        """Forme compacte envoyée à GPT-4 (et utilisée comme clé de cache)."""
+        return [{"id": c.id, "critère": c.libelle, "points": c.points} for c in self.criteres]
+
+# ---------------------------
+# ANALYSEURS
+# ---------------------------
+def _number(value) -> float:
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = re.search(r"\d+(?:[.,]\d+)?", str(value))
+    if not match:
+        raise RubricError(f"Pondération illisible : {value!r}")
+    return float(match.group().replace(",", "."))
+
+def _criteria_from_json(items: list) -> list[tuple[str, float]]:
+    criteria = []
+    for item in items:
+        if isinstance(item, str):
+            criteria.append((item, 1.0))
+            continue
+        if not isinstance(item, dict):
+            raise RubricError(f"Critère illisible : {item!r}")
+        label = next((item[k] for k in LABEL_KEYS if item.get(k)), None)
+        if label is None:
+            raise RubricError(f"Critère sans libellé : {item!r}")
+        points = next((_number(item[k]) for k in POINT_KEYS if item.get(k) is not None), 1.0)
+        criteria.append((str(label), points))
+    return criteria
+
+def _parse_json(data: bytes) -> tuple[list, dict, dict]:
+    try:
+        content = json.loads(data.decode("utf-8-sig"))
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise RubricError(f"JSON invalide : {e}") from e
+    if isinstance(content, list):
+        content = {"grille_observation": content}
+    scales = [{str(k): str(v) for k, v in (content.get(key) or {}).items()}
+              for key in ("synthese", "prise_en_charge")]
+    return _criteria_from_json(content.get("grille_observation", [])), *scales
+
+def _docx_points(items: list[tuple[str, str, str]]) -> list[tuple[str, float]]:
+    """(libellé, nombre de tête, unité) -> (libellé, points). Seule une unité explicite (« 2 pts »)
+    fixe le barème : un nombre nu (« 1. », « 13. ») est une numérotation et vaut 1 point. Exception,
+    l'ancien format où chaque item est préfixé par son barème : que des 1 et des 2, sans unité,
+    et pas la suite 1, 2, 3…"""
+    bare = [token.strip() for _, token, unit in items if not unit]
+    legacy = (len(bare) == len(items) and set(bare) <= {"1", "2"}
+              and bare != [str(i) for i in range(1, len(bare) + 1)])
+    return [(label, _number(token) if unit or legacy else 1.0) for label, token, unit in items]
+
+def _parse_docx(data: bytes) -> tuple[list, dict, dict]:
+    from docx import Document
+    try:
+        document = Document(io.BytesIO(data))
+    except Exception as e:
+        raise RubricError(f"Document Word illisible : {e}") from e
+    matches = [DOCX_ITEM.match(para.text) for para in document.paragraphs]
+    criteria = _docx_points([(m["text"].strip(), m["token"], m["unit"]) for m in matches if m])
+    # Grilles présentées en tableau : libellé dans une cellule, points dans la dernière
+    for table in document.tables:
+        for row in table.rows:
+            cells = [cell.text.strip() for cell in row.cells]
+            if len(cells) >= 2 and re.fullmatch(r"\d+(?:[.,]\d+)?\s*(pts?|points?)?", cells[-1], re.I):
+                label = next((c for c in cells[:-1] if c and not c.isdigit()), "")
+                if label:
+                    criteria.append((label, _number(cells[-1])))
+    return criteria, {}, {}
+
+# ---------------------------
+# COMPILATION
+# ---------------------------
+_cache: "OrderedDict[str, Rubric]" = OrderedDict()
+
+def compile_rubric(data: bytes, filename: str = "") -> Rubric:
+    """Compile une grille (.json ou .docx) ; mis en cache par hash du contenu."""
+    digest = hashlib.sha256(data).hexdigest()
+    if digest in _cache:
+        _cache.move_to_end(digest)
+        return _cache[digest]
+
+    is_docx = filename.lower().endswith(".docx") or data[:2] == b"PK"
+    criteria, synthese, prise_en_charge = _parse_docx(data) if is_docx else _parse_json(data)
+    if not criteria:
+        raise RubricError("Aucun critère trouvé dans la grille")
+    try:
+        rubric = Rubric(
+            hash=digest,
+            criteres=[Criterion(id=f"C{i}", libelle=label, points=points)
+                      for i, (label, points) in enumerate(criteria, start=1)],
+            synthese=synthese,
+            prise_en_charge=prise_en_charge,
+        )
+    except ValidationError as e:
+        raise RubricError(f"Grille invalide : {e}") from e
+
+    _cache[digest] = rubric
+    if len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+    return rubric
@@ -0,0 +1,125 @@
+# Indicateurs d'accord déduits des statistiques suffisantes, comparés au calcul direct ;
+# suivi incrémental partagé entre sessions
+
+import threading
+
+import numpy as np
+import pytest
+
+from agreement import BIN_WIDTH, N_BINS, PAIRS, AgreementStats, AgreementTracker
+from db import NOTES_MIGRATIONS, Database
+
+def direct_icc(x: np.ndarray) -> float:
+    n, k = x.shape
+    mean = x.mean()
+    ms_rows = k * ((x.mean(axis=1) - mean) ** 2).sum() / (n - 1)
+    ms_cols = n * ((x.mean(axis=0) - mean) ** 2).sum() / (k - 1)
+    residual = x - x.mean(axis=1, keepdims=True) - x.mean(axis=0) + mean
+    ms_error = (residual ** 2).sum() / ((n - 1) * (k - 1))
+    return (ms_rows - ms_error) / (ms_rows + (k - 1) * ms_error + k * (ms_cols - ms_error) / n)
+
+def direct_kappa(a: np.ndarray, b: np.ndarray) -> float:
+    bins_a = np.minimum(a // BIN_WIDTH, N_BINS - 1).astype(int)
+    bins_b = np.minimum(b // BIN_WIDTH, N_BINS - 1).astype(int)
+    observed = np.zeros((N_BINS, N_BINS))
+    for i, j in zip(bins_a, bins_b):
+        observed[i, j] += 1
+    expected = np.outer(observed.sum(axis=1), observed.sum(axis=0)) / len(a)
+    weights = np.array([[(i - j) ** 2 for j in range(N_BINS)] for i in range(N_BINS)])
+    return 1 - (weights * observed).sum() / (weights * expected).sum()
+
+@pytest.fixture
+def notes():
+    rng = np.random.default_rng(0)
+    truth = rng.uniform(6, 18, 40)
+    return np.clip(np.column_stack([truth + rng.normal(0, s, 40) for s in (1.5, 1.0, 2.0)]), 0, 20)
+
+def stats_of(notes: np.ndarray) -> AgreementStats:
+    state = AgreementStats()
+    state.update(notes)
+    return state
+
+@pytest.mark.parametrize("raters", [(0, 1, 2), (1, 2)])
+def test_icc(notes, raters):
+    assert stats_of(notes).icc(raters)["icc"] == pytest.approx(direct_icc(notes[:, raters]))
+
+@pytest.mark.parametrize("pair", range(len(PAIRS)))
+def test_weighted_kappa(notes, pair):
+    j, l = PAIRS[pair]
+    assert stats_of(notes).weighted_kappa(pair) == pytest.approx(direct_kappa(notes[:, j], notes[:, l]))
+
+@pytest.mark.parametrize("contrast, column", [((1, -1, 0), 0), ((1, 0, -1), 1), ((0, 1, -1), 2)])
+def test_bland_altman(notes, contrast, column):
+    diff = notes @ np.array(contrast, dtype=float)
+    result = stats_of(notes).bland_altman(contrast)
+    assert result["biais"] == pytest.approx(diff.mean())
+    assert result["ecart_type"] == pytest.approx(diff.std(ddof=1))
+    assert result["limite_haute"] - result["limite_basse"] == pytest.approx(2 * 1.96 * diff.std(ddof=1))
+
+@pytest.mark.parametrize("j, l", PAIRS)
+def test_pearson(notes, j, l):
+    assert stats_of(notes).pearson(j, l) == pytest.approx(np.corrcoef(notes[:, j], notes[:, l])[0, 1])
+
+@pytest.mark.parametrize("rows, method, args, expected", [
+    (1, "icc", (), {"icc": None, "p": None}),
+    (1, "bland_altman", ((1, -1, 0),),
+     {"biais": None, "ecart_type": None, "limite_basse": None, "limite_haute": None}),
+    (1, "pearson", (0, 1), None),
+    (0, "weighted_kappa", (0,), None),
+])
+def test_too_few_rows(rows, method, args, expected):
+    assert getattr(stats_of(np.full((rows, 3), 10.0)), method)(*args) == expected
+
+def test_removed_rows_no_longer_count(notes):
+    state = stats_of(notes)
+    state.update(notes[:10], sign=-1)
+    expected = stats_of(notes[10:])
+    assert state.n == expected.n
+    assert state.icc() == pytest.approx(expected.icc())
+    assert state.weighted_kappa(0) == pytest.approx(expected.weighted_kappa(0))
+
+def test_criteria_table(notes):
+    rng = np.random.default_rng(1)
+    ecg = rng.integers(0, 2, len(notes)).astype(float)
+    criteria = [{"ECG": score, **({"NFS": 1.0} if i % 2 else {})} for i, score in enumerate(ecg)]
+    state = stats_of(notes)
+    state.update_criteria(notes, criteria)
+    rows = {row["critère"]: row for row in AgreementStats.from_json(state.to_json()).criteria_table()}
+    gap = notes[:, 1:].mean(axis=1) - notes[:, 0]
+    assert rows["ECG"]["n"] == len(notes)
+    assert rows["ECG"]["score_ia_moyen"] == pytest.approx(ecg.mean())
+    assert rows["ECG"]["corr_note_humaine"] == pytest.approx(np.corrcoef(ecg, notes[:, 1:].mean(axis=1))[0, 1])
+    assert rows["ECG"]["corr_ecart_humains_ia"] == pytest.approx(np.corrcoef(ecg, gap)[0, 1])
+    # Score constant : corrélations indéfinies
+    assert rows["NFS"]["n"] == len(notes) // 2
+    assert rows["NFS"]["corr_note_humaine"] is None
+
+def add_notes(db: Database, students: range):
+    with db.transaction() as conn:
+        conn.executemany("INSERT OR REPLACE INTO evaluations (id_etudiant, note_ia, eval1, eval2) VALUES (?, ?, ?, ?)",
+                         [(f"e{i}", 10 + i % 7, 11 + i % 5, 12 + i % 3) for i in students])
+
+def test_tracker_shared_between_threads(tmp_path):
+    source = Database(str(tmp_path / "evaluation.db"), NOTES_MIGRATIONS)
+    tracker = AgreementTracker(source, "notes", str(tmp_path / "analytics.db"))
+
+    def session(k):
+        for i in range(20):
+            add_notes(source, range(k * 100 + i, k * 100 + i + 1))
+            tracker.refresh()
+    threads = [threading.Thread(target=session, args=(k,)) for k in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert tracker.refresh().n == 80
+    assert AgreementTracker(source, "notes", str(tmp_path / "analytics.db")).refresh().n == 80
+
+def test_trackers_sharing_an_analytics_db(tmp_path):
+    source = Database(str(tmp_path / "evaluation.db"), NOTES_MIGRATIONS)
+    first, second = (AgreementTracker(source, "notes", str(tmp_path / "analytics.db")) for _ in range(2))
+    add_notes(source, range(5))
+    assert first.refresh().n == 5
+    add_notes(source, range(5, 8))
+    assert second.refresh().n == 8
+    assert first.refresh().n == 8
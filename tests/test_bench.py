@@ -0,0 +1,15 @@
+# Banc d'essai : la latence mesurée par étape ne compte pas l'attente des créneaux
+
+from bench import run_benchmark
+
+LATENCY = 0.2
+
+def test_async_stage_latency_excludes_queue_wait(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    report = run_benchmark([1], modes=("async",), students=6, audio_seconds=2.0, criteria=3,
+                           latency=LATENCY, jitter=0.0)
+    level, = report["resultats"]
+    assert level["reussis"] == 6
+    # Avec un seul créneau, les six étudiants attendent leur tour : seule la requête compte
+    assert LATENCY <= level["etapes"]["whisper"]["p95_s"] < 2 * LATENCY
+    assert LATENCY <= level["etapes"]["gpt4"]["p95_s"] < 2 * LATENCY
@@ -0,0 +1,64 @@
+# Migrations de evaluations.db sur une base au format d'origine (evaluations_ia :
+# une ligne par critère, champs globaux répétés)
+
+import sqlite3
+
+import pytest
+
+from db import MIGRATIONS, connect, migrate
+
+LEGACY_VERSION = 2
+
+def legacy_rows(student_id: str, notes: list[tuple], synthese=0.5, prise=1.0, finale=12.0, commentaire="ok"):
+    return [(student_id, label, score, f"justification {label}", synthese, prise, finale, commentaire)
+            for label, score in notes]
+
+@pytest.fixture
+def legacy_db(tmp_path):
+    """Base evaluations.db telle qu'avant la migration 3."""
+    conn = connect(str(tmp_path / "evaluations.db"))
+    migrate(conn, [m for m in MIGRATIONS if m[0] <= LEGACY_VERSION])
+    yield conn
+    conn.close()
+
+def insert_legacy(conn: sqlite3.Connection, rows: list[tuple]):
+    for student_id in dict.fromkeys(row[0] for row in rows):
+        conn.execute("INSERT OR IGNORE INTO etudiants VALUES (?, ?, ?)", (student_id, "2024-05-01 10:00:00", None))
+    conn.executemany("INSERT INTO evaluations_ia (id_etudiant, critere, score, justification, synthese, "
+                     "prise_en_charge, note_finale, commentaire) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+def runs(conn: sqlite3.Connection) -> list[tuple]:
+    """(étudiant, note finale, [libellés dans l'ordre]) pour chaque run."""
+    result = []
+    for run_id, student_id, finale in conn.execute(
+            "SELECT id, id_etudiant, note_finale FROM evaluation_run ORDER BY id").fetchall():
+        labels = [label for (label,) in conn.execute(
+            "SELECT c.libelle FROM evaluation_critere ec JOIN criteres c ON c.id = ec.critere_id "
+            "WHERE ec.run_id = ? ORDER BY ec.position", (run_id,))]
+        result.append((student_id, finale, labels))
+    return result
+
+def test_one_run_per_legacy_evaluation(legacy_db):
+    insert_legacy(legacy_db, legacy_rows("e1", [("a", 1), ("b", 0)])
+                  + legacy_rows("e2", [("a", 1), ("b", 1)], finale=18.0)
+                  + legacy_rows("e1", [("a", 0), ("b", 0)], finale=4.0))
+    migrate(legacy_db)
+    assert runs(legacy_db) == [("e1", 12.0, ["a", "b"]), ("e2", 18.0, ["a", "b"]), ("e1", 4.0, ["a", "b"])]
+    # La vue de compatibilité rend toutes les lignes d'origine
+    assert legacy_db.execute("SELECT COUNT(*) FROM evaluations_ia").fetchone()[0] == 6
+
+def test_identical_consecutive_evaluations_stay_separate(legacy_db):
+    evaluation = legacy_rows("e1", [("a", 1), ("b", 0), ("c", 1)])
+    insert_legacy(legacy_db, evaluation + evaluation)
+    migrate(legacy_db)
+    assert runs(legacy_db) == [("e1", 12.0, ["a", "b", "c"])] * 2
+    assert legacy_db.execute(
+        "SELECT COUNT(*) FROM evaluation_critere GROUP BY run_id, critere_id HAVING COUNT(*) > 1").fetchall() == []
+
+def test_human_evaluations_are_kept(legacy_db):
+    insert_legacy(legacy_db, legacy_rows("e1", [("a", 1)]))
+    legacy_db.execute("INSERT INTO evaluations_humaines (id_etudiant, eval1, eval2, timestamp) "
+                      "VALUES ('e1', 11, 13, '2024-05-01 11:00:00')")
+    migrate(legacy_db)
+    assert legacy_db.execute("SELECT id_etudiant, eval1, eval2, run_id FROM evaluations_humaines").fetchall() == [
+        ("e1", 11.0, 13.0, None)]
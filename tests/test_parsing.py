@@ -0,0 +1,96 @@
+# Lecture des réponses GPT-4 (JSON tolérant, flux des notes) et recollage des segments Whisper
+
+import json
+
+import pytest
+
+from evaluation import (MalformedResponse, NotesStreamParser, ShardResult, load_json_lenient, parse_result,
+                        stitch_transcripts)
+
+RESULT = {"notes": [{"critère": "ECG", "score": 1, "justification": "Il dit « ECG »"}],
+          "synthese": 0.5, "prise_en_charge": 1.0, "note_finale": 12.0, "commentaire": "ok"}
+
+@pytest.mark.parametrize("content, expected", [
+    ('{"a": 1}', {"a": 1}),
+    ('Voici la grille :\n```json\n{"a": 1}\n```', {"a": 1}),
+    ('{"a": [1, 2,],}', {"a": [1, 2]}),
+    ('{"a": True, "b": None, "c": False}', {"a": True, "b": None, "c": False}),
+    ('{"note": 12,5}', {"note": 12.5}),
+    ('{“a”: «oui»}', {"a": "oui"}),
+    # Les guillemets cités dans une chaîne ne sont pas des délimiteurs
+    ('{"justification": "Il dit « ECG »", "score": 1,}', {"justification": "Il dit « ECG »", "score": 1}),
+    ('{"justification": "“ECG” puis \\"NFS\\"",}', {"justification": "“ECG” puis \"NFS\""}),
+    # Réponse tronquée : chaîne, objets et tableaux refermés
+    ('{"notes": [{"critère": "ECG", "score": 1', {"notes": [{"critère": "ECG", "score": 1}]}),
+    ('{"commentaire": "Bonne prise en', {"commentaire": "Bonne prise en"}),
+])
+def test_load_json_lenient(content, expected):
+    assert load_json_lenient(content) == expected
+
+@pytest.mark.parametrize("content", ["", "Je ne peux pas évaluer cette transcription.", "[1, 2]"])
+def test_load_json_lenient_rejects(content):
+    with pytest.raises(ValueError):
+        load_json_lenient(content)
+
+def test_parse_result_accepts_a_valid_reply():
+    assert parse_result(json.dumps(RESULT, ensure_ascii=False)) == RESULT
+
+@pytest.mark.parametrize("content, base, fields, partial", [
+    ("pas de json", None, ["notes", "synthese", "prise_en_charge", "note_finale", "commentaire"], None),
+    # Champ invalide : seul celui-ci est à redemander, les autres sont gardés
+    (json.dumps({**RESULT, "synthese": "bonne"}), None, ["synthese"],
+     {k: v for k, v in RESULT.items() if k != "synthese"}),
+    # Réparation illisible : on ne redemande que ce qui manque à la réponse partielle
+    ("toujours pas", {"notes": [], "synthese": 1.0}, ["prise_en_charge", "note_finale", "commentaire"],
+     {"notes": [], "synthese": 1.0}),
+])
+def test_parse_result_reports_fields_to_repair(content, base, fields, partial):
+    with pytest.raises(MalformedResponse) as error:
+        parse_result(content, base=base)
+    assert error.value.fields == fields
+    assert error.value.partial == partial
+
+def test_parse_result_completes_a_partial_reply():
+    base = {k: v for k, v in RESULT.items() if k != "note_finale"}
+    assert parse_result('{"note_finale": 12}', base=base) == RESULT
+
+def test_parse_result_with_schema():
+    notes = [{"id": "C1", "score": 1}]
+    assert parse_result(json.dumps({"notes": notes}), schema=ShardResult)["notes"] == notes
+
+NOTES = [{"critère": "ECG {12 dérivations}", "score": 1, "justification": "« ECG » demandé"},
+         {"critère": "Troponine", "score": 0, "justification": "Non citée \"du tout\" ]"},
+         {"critère": "Aspirine", "score": 1, "justification": "", "extraits": [{"debut": 0, "fin": 4}]}]
+STREAM = json.dumps({"notes": NOTES, "synthese": 0.5}, ensure_ascii=False)
+
+@pytest.mark.parametrize("size", [1, 3, 7, 50, len(STREAM)])
+def test_notes_stream_parser(size):
+    parser, received = NotesStreamParser(), []
+    for start in range(0, len(STREAM), size):
+        received += parser.feed(STREAM[start:start + size])
+    assert received == NOTES
+    assert parser.done
+
+def test_notes_stream_parser_yields_each_note_once_it_is_closed():
+    parser = NotesStreamParser()
+    assert parser.feed('{"commentaire": "{}", "notes": [{"critère": "ECG"') == []
+    assert parser.feed(', "score": 1}, {"critère"') == [{"critère": "ECG", "score": 1}]
+    assert parser.feed(': "NFS", "score": 0}]') == [{"critère": "NFS", "score": 0}]
+    assert parser.feed(', "notes": [{"critère": "x"}]}') == []
+
+@pytest.mark.parametrize("texts, expected", [
+    ([], ""),
+    (["seul segment"], "seul segment"),
+    (["bonjour docteur", "le patient tousse"], "bonjour docteur le patient tousse"),
+    # Recouvrement gardé une seule fois
+    (["le patient a mal depuis deux heures", "depuis deux heures et il transpire"],
+     "le patient a mal depuis deux heures et il transpire"),
+    # Casse et ponctuation aux bords des segments
+    (["il a de la fièvre.", "Fièvre et des frissons"], "il a de la fièvre. et des frissons"),
+    # Mot mal reconnu à la jointure (tolérance `slack`)
+    (["douleur thoracique depuis deux heures", "euh deux heures avec irradiation"],
+     "douleur thoracique depuis deux heures avec irradiation"),
+    (["un", "deux", "trois"], "un deux trois"),
+])
+def test_stitch_transcripts(texts, expected):
+    assert stitch_transcripts(texts) == expected
@@ -0,0 +1,37 @@
+# Pré-notation locale : seuls les critères cités dans une phrase sans négation sont notés
+
+import pytest
+
+from prescore import has_negation, prescore
+
+RUBRIC = [{"id": "C1", "critère": "Demande un ECG"},
+          {"id": "C2", "critère": "Prescrit du paracétamol"},
+          {"id": "C3", "critère": "Ne prescrit pas d'AINS"}]
+
+@pytest.mark.parametrize("text, negated", [
+    ("Je demande un ECG", False),
+    ("Je ne demande pas d'ECG", True),
+    ("Je n'ai rien prescrit", True),
+    ("Sans fièvre", True),
+    ("Aucune douleur", True),
+    ("Non.", True),
+    ("Nausées, pas de vomissements", True),
+    ("Je panse la plaie", False),
+])
+def test_has_negation(text, negated):
+    assert has_negation(text) is negated
+
+@pytest.mark.parametrize("transcript, decided, ambiguous", [
+    ("Je demande un ECG. Je prescris du paracétamol.", ["C1", "C2"], ["C3"]),
+    # Phrase niée : le critère part chez GPT-4, même si ses termes y sont
+    ("Je ne demande pas d'ECG. Je prescris du paracétamol.", ["C2"], ["C1", "C3"]),
+    ("Pas d'ECG ici, je prescris sans paracétamol.", [], ["C1", "C2", "C3"]),
+    # Critère formulé avec une négation : jamais noté localement
+    ("Je prescris du paracétamol, je ne donne pas d'AINS.", [], ["C1", "C2", "C3"]),
+    ("", [], ["C1", "C2", "C3"]),
+])
+def test_prescore_negations(transcript, decided, ambiguous):
+    notes, rest = prescore(RUBRIC, transcript)
+    assert sorted(notes) == decided
+    assert [item["id"] for item in rest] == ambiguous
+    assert all(note["score"] == 1 for note in notes.values())
@@ -0,0 +1,31 @@
+# Barème des grilles Word : numérotation, unité explicite, ancien format « barème en tête »
+
+import io
+
+import pytest
+from docx import Document
+
+from rubric import compile_rubric
+
+def docx(lines: list[str]) -> bytes:
+    document = Document()
+    for line in lines:
+        document.add_paragraph(line)
+    buffer = io.BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+@pytest.mark.parametrize("lines, points", [
+    # Liste numérotée : chaque item vaut 1 point, même « 2. », « 12. »
+    ([f"{i}. Critère {i}" for i in range(1, 14)], [1.0] * 13),
+    (["1) Anamnèse", "2) Examen", "3) ECG"], [1.0, 1.0, 1.0]),
+    # Seule une unité explicite fixe le barème
+    (["1. Anamnèse", "2 pts Examen clinique", "1,5 point ECG"], [1.0, 2.0, 1.5]),
+    # Ancien format : chaque item préfixé par son barème (1 ou 2, hors suite 1, 2, 3…)
+    (["2 Anamnèse", "1 Examen", "2 ECG", "1 Troponine"], [2.0, 1.0, 2.0, 1.0]),
+    (["1 Anamnèse", "1 Examen"], [1.0, 1.0]),
+])
+def test_docx_points(lines, points):
+    rubric = compile_rubric(docx(lines), "grille.docx")
+    assert [c.points for c in rubric.criteres] == points
+    assert rubric.total_points == sum(points)
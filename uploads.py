@@ -0,0 +1,84 @@
+# Évaluation Médicale IA - Réception des enregistrements téléversés
+#
+# Un WAV de 8 minutes pèse ~90 Mo : les fichiers reçus (st.file_uploader) sont
+# copiés sur disque par blocs de COPY_CHUNK à travers un tampon réutilisé, et
+# hachés au passage. Aucune copie intégrale en mémoire (ni .read() ni
+# .getvalue()) : la mémoire du processus reste la même quelle que soit la durée
+# de l'enregistrement. Les fichiers temporaires vivent dans UPLOAD_DIR et sont
+# supprimés à la sortie du bloc `with`, erreur ou non ; ceux laissés par un
+# processus tué sont balayés au démarrage (sweep_uploads).
+
+import glob
+import hashlib
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+import metrics
+
+COPY_CHUNK = 1 << 20
+UPLOAD_DIR = os.path.join(tempfile.gettempdir(), "eval-med-uploads")
+STALE_AFTER_S = 6 * 3600   # un fichier temporaire plus ancien a été abandonné
+
+def copy_stream(src, dst, chunk_size: int = COPY_CHUNK) -> str:
+    """Copie `src` dans `dst` par blocs (depuis le début) et renvoie le SHA-256 du contenu."""
+    digest = hashlib.sha256()
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    if hasattr(src, "seek"):
+        src.seek(0)
+    while n := src.readinto(buffer):
+        digest.update(view[:n])
+        dst.write(view[:n])
+    return digest.hexdigest()
+
+def upload_suffix(upload, default: str = ".wav") -> str:
+    return os.path.splitext(getattr(upload, "name", ""))[1].lower() or default
+
+@contextmanager
+def spooled_upload(upload, suffix: str = None, directory: str = UPLOAD_DIR):
+    """Écrit `upload` dans un fichier temporaire et renvoie (chemin, sha256) ; le fichier
+    est supprimé à la sortie du bloc, même en cas d'erreur."""
+    os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=suffix or upload_suffix(upload), dir=directory)
+    try:
+        with metrics.stage("upload"), os.fdopen(fd, "wb") as f:
+            audio_hash = copy_stream(upload, f)
+            metrics.record(octets=f.tell())
+        yield path, audio_hash
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+def store_upload(upload, directory: str, suffix: str = None) -> tuple[str, str]:
+    """Copie `upload` dans `directory` sous le nom <sha256><suffix> et renvoie (chemin, sha256).
+
+    L'écriture passe par un fichier .part renommé à la fin (atomique) : un même contenu
+    n'est stocké qu'une fois et un fichier à moitié écrit n'est jamais visible.
+    """
+    os.makedirs(directory, exist_ok=True)
+    fd, part_path = tempfile.mkstemp(suffix=".part", dir=directory)
+    try:
+        with metrics.stage("upload"), os.fdopen(fd, "wb") as f:
+            audio_hash = copy_stream(upload, f)
+            metrics.record(octets=f.tell())
+        path = os.path.join(directory, f"{audio_hash}{suffix or upload_suffix(upload)}")
+        os.replace(part_path, path)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    return path, audio_hash
+
+def sweep_uploads(directory: str = UPLOAD_DIR, pattern: str = "*", max_age_s: float = STALE_AFTER_S) -> int:
+    """Supprime les fichiers temporaires abandonnés (plus anciens que `max_age_s`)."""
+    removed, limit = 0, time.time() - max_age_s
+    for path in glob.glob(os.path.join(directory, pattern)):
+        try:
+            if os.path.getmtime(path) < limit:
+                os.remove(path)
+                removed += 1
+        except FileNotFoundError:
+            pass
+    return removed